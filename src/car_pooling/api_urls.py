@@ -0,0 +1,52 @@
+from django.urls import path
+
+from journey import plain_views, views
+
+
+urlpatterns = [
+    path(
+        'status/',
+        views.StatusAPIView.as_view(),
+        name='get_status'
+    ),
+    path(
+        'metrics/',
+        views.MetricsAPIView.as_view(),
+        name='get_metrics'
+    ),
+    path(
+        'cars/',
+        views.CarAPIView.as_view(),
+        name='put_cars'
+    ),
+    path(
+        'journey/',
+        plain_views.JourneyView.as_view(),
+        name='post_journey'
+    ),
+    path(
+        'journeys/',
+        views.JourneysAPIView.as_view(),
+        name='post_journeys'
+    ),
+    path(
+        'dropoff/',
+        plain_views.DropOffView.as_view(),
+        name='post_dropoff'
+    ),
+    path(
+        'dropoffs/',
+        views.DropOffsAPIView.as_view(),
+        name='post_dropoffs'
+    ),
+    path(
+        'locate/',
+        plain_views.LocateView.as_view(),
+        name='post_locate'
+    ),
+    path(
+        'locate/wait/',
+        plain_views.LocateWaitView.as_view(),
+        name='post_locate_wait'
+    ),
+]
@@ -0,0 +1,37 @@
+from django.db.backends.sqlite3 import base
+
+# Options of this backend, not passed to sqlite3.connect
+BACKEND_OPTIONS = ('pragmas', 'immediate_transactions')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend tuned at connection time
+
+    OPTIONS accepts, besides the arguments of sqlite3.connect:
+
+    - pragmas: (name, value) pairs run on every new connection, like
+      ('journal_mode', 'WAL').
+    - immediate_transactions: start transactions with BEGIN IMMEDIATE, so a
+      transaction that reads before writing waits for the write lock with
+      the busy timeout up front instead of failing with "database is locked"
+      when it upgrades its lock.
+    """
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        for option in BACKEND_OPTIONS:
+            params.pop(option, None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.settings_dict['OPTIONS'].get('pragmas', ()):
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.settings_dict['OPTIONS'].get('immediate_transactions'):
+            self.cursor().execute('BEGIN IMMEDIATE')
+        else:
+            super()._start_transaction_under_autocommit()
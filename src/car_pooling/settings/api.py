@@ -0,0 +1,49 @@
+from .base import *
+
+# API-only profile: no sessions, auth, messages, templates nor static files,
+# and plain Django views for the journey, dropoff and locate endpoints
+
+DEBUG = False
+
+ALLOWED_HOSTS = [LOCAL_IP, 'web', 'localhost', '0.0.0.0', 'pooling', ]
+
+ROOT_URLCONF = 'car_pooling.api_urls'
+
+INSTALLED_APPS = PROJECT_APPS
+
+MIDDLEWARE = [
+    'journey.tracing.TracingMiddleware',
+    'journey.middleware.MetricsMiddleware',
+    'journey.profiling.ProfilingMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+TEMPLATES = []
+
+USE_I18N = False
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': (),
+    'DEFAULT_PERMISSION_CLASSES': (),
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+    ),
+    'UNAUTHENTICATED_USER': None,
+}
+
+CACHES = {
+    'default': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        },
+    'locations': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'locations',
+            'TIMEOUT': None,
+            'OPTIONS': {
+                'MAX_ENTRIES': 100000,
+            },
+        },
+}
@@ -34,13 +34,16 @@ PROJECT_APPS = [
 INSTALLED_APPS += THIRD_PARTY_APPS + PROJECT_APPS
 
 MIDDLEWARE = [
+    'journey.tracing.TracingMiddleware',
+    'journey.middleware.MetricsMiddleware',
+    'journey.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.middleware.common.CommonMiddleware',
+    'journey.middleware.QueryCountMiddleware',
 ]
 
 TEMPLATES = [
@@ -69,6 +72,100 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+CARS_BATCH_SIZE = 1000
+
+CARS_STREAM_CHUNK_SIZE = 64 * 1024
+
+LOCATION_CACHE = 'locations'
+
+# The filter lives in the process: disable it when several processes
+# register groups in the same database
+GROUP_FILTER_ENABLED = True
+
+GROUP_FILTER_BITS = 2 ** 24
+
+GROUP_FILTER_HASHES = 4
+
+# Directory of the journal of the matching engine, only for profiles that
+# run a single process
+MATCHING_JOURNAL_DIR = os.getenv('MATCHING_JOURNAL_DIR')
+
+MATCHING_SNAPSHOT_EVERY = 10000
+
+MATCHING_JOURNAL_FSYNC = False
+
+# The engine lives in the process: look for cars and groups in the database
+# when it has none, so matches released by other processes are not missed
+MATCHING_DATABASE_FALLBACK = False
+
+# journey.matching.AgingPolicy lets groups that wait too long go first
+MATCHING_QUEUE_POLICY = 'journey.matching.SmallestFirstPolicy'
+
+# Seconds that groups should wait at most
+MATCHING_MAX_WAIT = 300
+
+# Seconds that journeys and dropoffs wait to be written in one transaction
+# with the ones of concurrent requests, None writes every request alone
+GROUP_COMMIT_WINDOW = None
+
+GROUP_COMMIT_MAX_SIZE = 100
+
+# Groups of each size that can wait at once, or a dict of limits by people,
+# POST /journey answers 429 to the groups over the limit
+ADMISSION_WAITING_LIMIT = None
+
+# Seconds that the oldest group of a size can wait before new groups of that
+# size are turned away, None doesn't turn them away
+ADMISSION_MAX_WAIT = None
+
+# Retry-After of queues that didn't give any group a car yet
+ADMISSION_RETRY_AFTER = 5
+
+# File for the spans of the requests in the Zipkin v2 JSON format, one per
+# line, None doesn't trace them
+TRACING_FILE = os.getenv('TRACING_FILE')
+
+TRACING_MAX_BYTES = 10 * 1024 * 1024
+
+TRACING_BACKUP_COUNT = 5
+
+# Groups moved to the archive tables at once, with their finished journeys
+ARCHIVE_BATCH_SIZE = 500
+
+# Seconds between archives in every process that serves requests, None
+# leaves archiving to the archive command
+ARCHIVE_INTERVAL = None
+
+# Seconds that an empty archive is trusted before looking for groups that
+# other processes archived, when groups register
+ARCHIVE_EMPTY_TTL = 1
+
+# Directory for the cProfile dumps of a sample of the requests, one
+# directory per endpoint, None doesn't profile them
+PROFILING_DIR = os.getenv('PROFILING_DIR')
+
+# Fraction of the requests profiled
+PROFILING_RATE = float(os.getenv('PROFILING_RATE', 0.01))
+
+# META key of the header that profiles a request, like X-Profile: 1, None
+# doesn't profile requests on demand
+PROFILING_HEADER = 'HTTP_X_PROFILE'
+
+# Dumps kept per endpoint, the oldest are removed
+PROFILING_MAX_FILES = 50
+
+# Seconds that POST /locate/wait holds a request at most
+LOCATE_WAIT_TIMEOUT = 30
+
+DATABASE_ROUTERS = ['journey.replicas.ReplicaRouter']
+
+# Alias of a read replica for POST /locate, None reads from the primary
+REPLICA_DATABASE = None
+
+# Seconds that the locations of groups just written are read from the
+# primary, it should be longer than the lag of the replica
+REPLICA_READ_YOUR_WRITES = 5
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -82,6 +179,10 @@ LOGGING = {
             'handlers': ['console'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
         },
+        'journey': {
+            'handlers': ['console'],
+            'level': os.getenv('JOURNEY_LOG_LEVEL', 'INFO'),
+        },
     },
 }
 
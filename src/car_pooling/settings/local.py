@@ -9,6 +9,14 @@ ROOT_URLCONF = 'car_pooling.urls'
 CACHES = {
     'default': {
             'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-        }
+        },
+    'locations': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'locations',
+            'TIMEOUT': None,
+            'OPTIONS': {
+                'MAX_ENTRIES': 100000,
+            },
+        },
 }
 
@@ -0,0 +1,44 @@
+from .api import *
+
+# API-only profile on a SQLite database tuned for concurrent requests:
+# readers don't wait for writers in WAL mode, writers wait for each other
+# with a busy timeout and every thread keeps its connection open
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'car_pooling.backends.sqlite3',
+        'NAME': 'mydatabase',
+        'CONN_MAX_AGE': None,
+        'OPTIONS': {
+            # Seconds to wait for a lock before "database is locked"
+            'timeout': 20,
+            'immediate_transactions': True,
+            'pragmas': (
+                ('journal_mode', 'WAL'),
+                # Safe with WAL: only the last commits can be lost on a
+                # power failure, never the consistency of the database
+                ('synchronous', 'NORMAL'),
+                # Negative sizes are KiB: 64MiB of page cache per connection
+                ('cache_size', -64 * 1024),
+                ('temp_store', 'MEMORY'),
+            ),
+        },
+    }
+}
+
+# Every worker process has its own matching engine
+MATCHING_DATABASE_FALLBACK = True
+
+# The journal of the matching engine can't be shared by several workers
+MATCHING_JOURNAL_DIR = None
+
+# Groups registered by other workers are missing from the filter of the
+# process, so it would answer 404 to them
+GROUP_FILTER_ENABLED = False
+
+# A cache of the process would keep locations that other workers changed,
+# so locations are read from the database unless a shared cache like
+# Memcached is configured here
+CACHES = dict(CACHES, locations={
+    'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+})
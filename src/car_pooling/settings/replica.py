@@ -0,0 +1,17 @@
+from .production import *
+from .api import CACHES
+
+# Production profile that serves POST /locate from a local copy of the
+# database, refreshed with `manage.py replicate --interval 1`
+#
+# Run it with a single worker process, threads are fine: the groups written
+# lately are only known by the process that wrote them, so a locate served
+# by another worker would read a location older than the write from the
+# lagging replica. With a single worker the group filter and the locations
+# cache of the process are up to date again, so they are back
+
+DATABASES['replica'] = dict(DATABASES['default'], NAME='mydatabase-replica')
+
+REPLICA_DATABASE = 'replica'
+
+GROUP_FILTER_ENABLED = True
@@ -9,5 +9,13 @@ ROOT_URLCONF = 'car_pooling.urls'
 CACHES = {
     'default': {
             'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-        }
+        },
+    'locations': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'locations',
+            'TIMEOUT': None,
+            'OPTIONS': {
+                'MAX_ENTRIES': 100000,
+            },
+        },
 }
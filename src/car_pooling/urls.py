@@ -10,6 +10,11 @@ urlpatterns = [
         views.StatusAPIView.as_view(),
         name='get_status'
     ),
+    path(
+        'metrics/',
+        views.MetricsAPIView.as_view(),
+        name='get_metrics'
+    ),
     path(
         'cars/',
         views.CarAPIView.as_view(),
@@ -20,14 +25,29 @@ urlpatterns = [
         views.JourneyAPIView.as_view(),
         name='post_journey'
     ),
+    path(
+        'journeys/',
+        views.JourneysAPIView.as_view(),
+        name='post_journeys'
+    ),
     path(
         'dropoff/',
         views.DropOffAPIView.as_view(),
         name='post_dropoff'
     ),
+    path(
+        'dropoffs/',
+        views.DropOffsAPIView.as_view(),
+        name='post_dropoffs'
+    ),
     path(
         'locate/',
         views.LocateAPIView.as_view(),
         name='post_locate'
     ),
+    path(
+        'locate/wait/',
+        views.LocateWaitAPIView.as_view(),
+        name='post_locate_wait'
+    ),
 ]
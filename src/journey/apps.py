@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class JourneyConfig(AppConfig):
     name = 'journey'
+
+    def ready(self):
+        from . import archive, membership  # noqa: F401
@@ -0,0 +1,250 @@
+from array import array
+from bisect import bisect_left
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+
+from .models import ArchivedGroup, ArchivedJourney, Group, Journey
+from .tracing import traced
+
+logger = logging.getLogger(__name__)
+
+
+class Tombstones:
+    """
+    Ids of the groups moved to the archive
+
+    Ids are kept in a sorted array of 64 bit integers, with the ids archived
+    lately in a set until there are enough of them to merge, so millions of
+    dropped off groups take a few megabytes. The ids are loaded from the
+    archive the first time they are needed, and refresh loads the ones that
+    other processes archived since.
+
+    While there are no ids, the archive is trusted to be empty for
+    `empty_ttl` seconds before it is looked up again, so the groups archived
+    by other processes are noticed without a query for every new group.
+    """
+
+    def __init__(self, empty_ttl=1.0, clock=time.monotonic):
+        self.empty_ttl = empty_ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._sorted = array('q')
+        self._recent = set()
+        self._last = 0
+        self._empty_until = 0.0
+
+    def _merge(self):
+        self._sorted = array('q', sorted(self._recent.union(self._sorted)))
+        self._recent = set()
+
+    def _add(self, group_ids):
+        self._recent.update(group_ids)
+        if len(self._recent) > max(4096, len(self._sorted) // 16):
+            self._merge()
+
+    def _load_since(self, last):
+        rows = ArchivedGroup.objects.filter(id__gt=last).order_by('id')
+        for row_id, group_id in rows.values_list('id', 'group_id').iterator():
+            self._add([group_id])
+            self._last = row_id
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._sorted, self._recent, self._last = array('q'), set(), 0
+        self._load_since(0)
+        self._loaded = True
+
+    def refresh(self):
+        """
+        Load the ids archived since the last load, by any process
+        """
+        with self._lock:
+            if self._loaded:
+                self._load_since(self._last)
+            else:
+                self._ensure_loaded()
+
+    def invalidate(self):
+        """
+        Forget the ids, they will be loaded again from the archive
+        """
+        with self._lock:
+            self._loaded = False
+
+    def reset(self):
+        """
+        Restart without archived ids, the archive was just emptied
+        """
+        with self._lock:
+            self._sorted, self._recent, self._last = array('q'), set(), 0
+            self._loaded = True
+            self._empty_until = self.clock() + self.empty_ttl
+
+    def archive_empty(self):
+        """
+        If the archive has no groups, loading the ids archived by other
+        processes when the archive was last seen empty `empty_ttl` seconds
+        ago or more
+
+        :returns: If the archive is empty
+        :type returns: bool
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._recent or self._sorted:
+                return False
+            now = self.clock()
+            if now < self._empty_until:
+                return True
+            self._load_since(self._last)
+            if self._recent or self._sorted:
+                return False
+            self._empty_until = now + self.empty_ttl
+            return True
+
+    def add_many(self, group_ids):
+        """
+        Add the ids that this process archived
+
+        :param group_ids: Ids of the groups
+        :type group_ids: [int]
+        """
+        with self._lock:
+            if self._loaded:
+                self._add(group_ids)
+
+    def __contains__(self, group_id):
+        with self._lock:
+            self._ensure_loaded()
+            if group_id in self._recent:
+                return True
+            index = bisect_left(self._sorted, group_id)
+            return (index < len(self._sorted) and
+                    self._sorted[index] == group_id)
+
+
+tombstones = Tombstones(settings.ARCHIVE_EMPTY_TTL)
+
+
+@traced
+def archive_batch(batch_size=None):
+    """
+    Move finished journeys with their groups, and groups dropped off while
+    they waited, to the archive tables, up to `batch_size` groups
+
+    Only rows that can't change any more are moved, and a batch is moved in
+    a single transaction, so the hot tables are never locked for long.
+
+    :param batch_size: Groups moved at most
+    :type batch_size: int
+
+    :returns: Journeys and groups archived
+    :type returns: (int, int)
+    """
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    with transaction.atomic():
+        journeys = list(
+            Journey.objects.filter(finished__isnull=False)
+            .select_related('group').order_by('id')[:batch_size]
+        )
+        groups = [journey.group for journey in journeys if journey.group]
+        groups += list(
+            Group.objects.filter(is_available=False, journey__isnull=True)
+            .order_by('id')[:batch_size - len(journeys)]
+        )
+        if not journeys and not groups:
+            return 0, 0
+
+        ArchivedJourney.objects.bulk_create([
+            ArchivedJourney(group_id=journey.group_id, car_id=journey.car_id,
+                            started=journey.started, finished=journey.finished)
+            for journey in journeys
+        ])
+        ArchivedGroup.objects.bulk_create([
+            ArchivedGroup(group_id=group.id, created=group.created,
+                          people=group.people)
+            for group in groups
+        ])
+        Journey.objects.filter(
+            id__in=[journey.id for journey in journeys]
+        ).delete()
+        Group.objects.filter(id__in=[group.id for group in groups]).delete()
+
+        group_ids = [group.id for group in groups]
+        transaction.on_commit(lambda: tombstones.add_many(group_ids))
+    return len(journeys), len(groups)
+
+
+def archive(batch_size=None):
+    """
+    Archive batch after batch until nothing is left to archive
+
+    :param batch_size: Groups moved at once
+    :type batch_size: int
+
+    :returns: Journeys and groups archived
+    :type returns: (int, int)
+    """
+    journeys = groups = 0
+    while True:
+        archived = archive_batch(batch_size)
+        journeys += archived[0]
+        groups += archived[1]
+        if not any(archived):
+            return journeys, groups
+
+
+class Archiver:
+    """
+    Thread of the process that archives every `interval` seconds
+    """
+
+    def __init__(self, interval=None, batch_size=None):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """
+        Start the thread once per process, forked processes start their own
+        """
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='archiver',
+                             daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                archive(self.batch_size)
+            except Exception:
+                logger.exception('Archive failed')
+            finally:
+                close_old_connections()
+
+
+archiver = Archiver(settings.ARCHIVE_INTERVAL, settings.ARCHIVE_BATCH_SIZE)
+
+
+@receiver(request_started)
+def start_archiver(sender, **kwargs):
+    """
+    Start archiving with the first request of the process, when
+    ARCHIVE_INTERVAL is set
+    """
+    archiver.start()
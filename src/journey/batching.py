@@ -0,0 +1,121 @@
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+from .matching import engine
+
+
+class Job:
+    """
+    Write of a request waiting for its batch to commit
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Batch:
+    """
+    Jobs that commit together
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class GroupCommit:
+    """
+    Apply the writes of concurrent requests in one transaction
+
+    The first request that arrives when there isn't any open batch becomes
+    the leader: it waits `window` seconds, or until `max_size` jobs join the
+    batch, and runs every job in its own savepoint of a single transaction,
+    so all of them share one commit and a failing job only undoes its own
+    writes. The requests get their results once the batch commits.
+
+    Without `window` every job runs right away, in the thread of its request.
+    """
+
+    def __init__(self, window=None, max_size=100):
+        """
+        :param window: Seconds that a batch waits for more jobs
+        :type window: float
+        :param max_size: Jobs of a batch at most
+        :type max_size: int
+        """
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._batch = None
+
+    @property
+    def enabled(self):
+        return bool(self.window)
+
+    def submit(self, func, *args):
+        """
+        Run a write in the next batch and wait until the batch commits
+
+        :param func: Function that writes
+        :type func: callable
+
+        :returns: What the function returns, its exception is raised
+        :type returns: object
+        """
+        if not self.enabled:
+            return func(*args)
+
+        job = Job(func, args)
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = Batch()
+            batch.jobs.append(job)
+            if len(batch.jobs) >= self.max_size:
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._apply(batch)
+        else:
+            batch.done.wait()
+        return job.result()
+
+    def _apply(self, batch):
+        try:
+            with transaction.atomic():
+                for job in batch.jobs:
+                    try:
+                        with transaction.atomic():
+                            job.value = job.func(*job.args)
+                    except Exception as error:
+                        job.error = error
+        except Exception as error:
+            engine.invalidate()
+            for job in batch.jobs:
+                if job.error is None:
+                    job.value, job.error = None, error
+        finally:
+            batch.done.set()
+
+
+group_commit = GroupCommit(
+    settings.GROUP_COMMIT_WINDOW,
+    settings.GROUP_COMMIT_MAX_SIZE
+)
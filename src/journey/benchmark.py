@@ -0,0 +1,254 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import itertools
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.core.servers.basehttp import (ThreadedWSGIServer,
+                                          WSGIRequestHandler)
+from django.core.wsgi import get_wsgi_application
+from django.urls import reverse
+
+from .matching import CAPACITIES
+from .simulation import summary
+
+ENDPOINTS = ('cars', 'journey', 'dropoff', 'locate', 'status')
+DEFAULT_MIX = {'journey': 40, 'dropoff': 20, 'locate': 35, 'status': 5}
+
+
+def parse_mix(value):
+    """
+    Parse a mix of endpoints like "journey=40,locate=60"
+
+    :param value: Endpoints with their weights
+    :type value: str
+
+    :returns: Weight by endpoint
+    :type returns: dict
+    """
+    mix = {}
+    for item in value.split(','):
+        endpoint, _, weight = item.partition('=')
+        endpoint = endpoint.strip()
+        if endpoint not in ENDPOINTS:
+            raise ValueError('Unknown endpoint {}'.format(endpoint))
+        mix[endpoint] = float(weight)
+    if not any(mix.values()):
+        raise ValueError('The mix has no weight')
+    return mix
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    Request handler that does not log every request
+    """
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server:
+    """
+    The application served in a background thread on a free port
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.httpd = ThreadedWSGIServer((host, port), QuietRequestHandler)
+        self.httpd.set_app(get_wsgi_application())
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class Benchmark:
+    """
+    Load benchmark of the HTTP API
+
+    The fleet is loaded with PUT /cars and then `concurrency` clients send
+    `requests` requests to the endpoints chosen at random with the weights
+    of the mix. New groups are registered with POST /journey, POST /dropoff
+    takes a registered group and POST /locate asks for any registered group.
+    A `cars` weight loads the fleet again in the middle of the traffic.
+    """
+
+    def __init__(self, url, fleet=1000, requests=5000, concurrency=8,
+                 mix=None, seed=None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.fleet = fleet
+        self.requests = requests
+        self.concurrency = concurrency
+        self.mix = mix or DEFAULT_MIX
+        self.seed = seed
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._registered = []
+        self._active = []
+        self._latencies = defaultdict(list)
+        self._statuses = defaultdict(lambda: defaultdict(int))
+        self._errors = defaultdict(int)
+
+    def _cars_payload(self, rng):
+        return json.dumps([
+            {'id': car_id, 'seats': rng.choice(CAPACITIES)}
+            for car_id in range(1, self.fleet + 1)
+        ])
+
+    def _send(self, connection, endpoint, method, path, body, content_type):
+        headers = {'Content-Type': content_type} if content_type else {}
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            with self._lock:
+                self._errors[endpoint] += 1
+            return None
+        latency = time.perf_counter() - start
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+        with self._lock:
+            self._latencies[endpoint].append(latency)
+            self._statuses[endpoint][response.status] += 1
+        return response.status
+
+    def _request(self, connection, rng, endpoint):
+        if endpoint == 'cars':
+            body = self._cars_payload(rng)
+            status = self._send(connection, endpoint, 'PUT',
+                                reverse('put_cars'), body, 'application/json')
+            if status == 200:
+                with self._lock:
+                    self._registered.clear()
+                    self._active.clear()
+        elif endpoint == 'journey':
+            group_id = next(self._ids)
+            body = json.dumps({'id': group_id,
+                               'people': rng.choice(CAPACITIES)})
+            status = self._send(connection, endpoint, 'POST',
+                                reverse('post_journey'), body,
+                                'application/json')
+            if status in (200, 202):
+                with self._lock:
+                    self._registered.append(group_id)
+                    self._active.append(group_id)
+        elif endpoint == 'dropoff':
+            with self._lock:
+                if self._active:
+                    index = rng.randrange(len(self._active))
+                    self._active[index] = self._active[-1]
+                    group_id = self._active.pop()
+                else:
+                    group_id = next(self._ids)
+            self._send(connection, endpoint, 'POST', '{}?id={}'.format(
+                reverse('post_dropoff'), group_id), '', None)
+        elif endpoint == 'locate':
+            with self._lock:
+                group_id = (rng.choice(self._registered)
+                            if self._registered else next(self._ids))
+            self._send(connection, endpoint, 'POST', '{}?id={}'.format(
+                reverse('post_locate'), group_id), '', None)
+        else:
+            self._send(connection, endpoint, 'GET', reverse('get_status'),
+                       None, None)
+
+    def _client(self, index, requests):
+        rng = random.Random(None if self.seed is None else self.seed + index)
+        endpoints = list(self.mix)
+        weights = [self.mix[endpoint] for endpoint in endpoints]
+        connection = http.client.HTTPConnection(self.host, self.port)
+        try:
+            for endpoint in rng.choices(endpoints, weights, k=requests):
+                self._request(connection, rng, endpoint)
+        finally:
+            connection.close()
+
+    def run(self):
+        """
+        Load the fleet and send the traffic
+
+        :returns: Results of the benchmark
+        :type returns: dict
+        """
+        connection = http.client.HTTPConnection(self.host, self.port)
+        try:
+            status = self._send(connection, 'cars', 'PUT',
+                                reverse('put_cars'),
+                                self._cars_payload(random.Random(self.seed)),
+                                'application/json')
+        finally:
+            connection.close()
+        if status != 200:
+            raise RuntimeError('The fleet could not be loaded')
+        fleet_load = self._latencies.pop('cars')[0]
+        self._statuses.pop('cars')
+
+        shares = [self.requests // self.concurrency] * self.concurrency
+        for index in range(self.requests % self.concurrency):
+            shares[index] += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for future in [executor.submit(self._client, index, share)
+                           for index, share in enumerate(shares)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        return self.results(elapsed, fleet_load)
+
+    def results(self, elapsed, fleet_load):
+        """
+        Throughput, latency percentiles and statuses by endpoint
+
+        :param elapsed: Seconds the traffic took
+        :type elapsed: float
+        :param fleet_load: Seconds the first load of the fleet took
+        :type fleet_load: float
+
+        :returns: Results of the benchmark
+        :type returns: dict
+        """
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            latencies = self._latencies.get(endpoint, [])
+            if not latencies and not self._errors.get(endpoint):
+                continue
+            endpoints[endpoint] = dict(
+                summary(latencies, scale=1000),
+                throughput=len(latencies) / elapsed if elapsed else 0.0,
+                statuses={str(status): count for status, count
+                          in sorted(self._statuses[endpoint].items())},
+                errors=self._errors.get(endpoint, 0)
+            )
+        total = sum(len(latencies) for latencies in self._latencies.values())
+        return {
+            'fleet': self.fleet,
+            'requests': self.requests,
+            'concurrency': self.concurrency,
+            'mix': self.mix,
+            'seed': self.seed,
+            'fleet_load': fleet_load * 1000,
+            'elapsed': elapsed,
+            'throughput': total / elapsed if elapsed else 0.0,
+            'endpoints': endpoints,
+        }
@@ -2,5 +2,17 @@ class AssignCarException(Exception):
     pass
 
 
+class CarTakenException(AssignCarException):
+    pass
+
+
 class JourneyException(Exception):
     pass
+
+
+class QueueFullException(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__("Too many groups waiting, retry after {} "
+                         "seconds".format(retry_after))
+        self.retry_after = retry_after
@@ -0,0 +1,161 @@
+from django.conf import settings
+from django.core.exceptions import SuspiciousOperation
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+
+from .archive import tombstones
+from .locations import DROPPED, IN_CAR, locations
+from .membership import group_filter
+from .models import ArchivedGroup, Group
+from .notifications import notifier
+from .replicas import replica_reads
+from .services import (check_admission, drop_off, process_journey_payload,
+                       request_available_car)
+from .tracing import traced
+
+
+def get_group_id(request):
+    """
+    Get the id of a group from the query string
+
+    :param request: Request with the id
+    :type request: django.http.HttpRequest
+
+    :returns: Id of the group
+    :type returns: int
+    """
+    group_id = request.GET.get('id', '')
+    if not group_id.isdigit():
+        raise SuspiciousOperation("Incorrect group id")
+    return int(group_id)
+
+
+def get_wait(request):
+    """
+    Get the seconds to wait for a location from the query string
+
+    :param request: Request with the seconds, up to LOCATE_WAIT_TIMEOUT
+    :type request: django.http.HttpRequest
+
+    :returns: Seconds to wait
+    :type returns: int
+    """
+    wait = request.GET.get('wait', str(settings.LOCATE_WAIT_TIMEOUT))
+    if not wait.isdigit():
+        raise SuspiciousOperation("Incorrect wait")
+    return min(int(wait), settings.LOCATE_WAIT_TIMEOUT)
+
+
+@traced
+def register_journey(data):
+    """
+    Register a group and give it a car if there is any free, unless it would
+    wait in a full queue
+
+    :param data: Data with a journey id and people
+    :type data: dict
+    """
+    group = process_journey_payload(data)
+    check_admission(group.people)
+
+    # The tombstones of the process miss the groups that other processes
+    # archived, the archive doesn't
+    if group.id in tombstones or (
+        not tombstones.archive_empty() and
+        ArchivedGroup.objects.filter(group_id=group.id).exists()
+    ):
+        raise SuspiciousOperation("Incorrect field in payload")
+    try:
+        group.save(force_insert=True)
+    except Exception:
+        raise SuspiciousOperation("Incorrect field in payload")
+
+    request_available_car(group)
+
+
+@traced
+def drop_off_group(group_id):
+    """
+    Drop off a registered group, groups already archived were dropped off
+
+    :param group_id: Id of the group
+    :type group_id: int
+    """
+    if group_id not in group_filter and group_id not in tombstones:
+        raise Http404
+
+    group = Group.objects.select_related('journey__car').filter(
+        id=group_id
+    ).first()
+    if group is None:
+        # It may have been archived by another process meanwhile
+        tombstones.refresh()
+        if group_id in tombstones:
+            return
+        raise Http404
+    drop_off(group)
+
+
+@traced
+def locate_group(group_id):
+    """
+    Locate a registered group that has not been dropped off
+
+    Groups without cached location are read from the replica, if there is
+    any, unless they were written recently. What the replica says is only
+    cached if recent writes are read from the primary, so a lagging replica
+    can't leave an old location in the cache.
+
+    :param group_id: Id of the group
+    :type group_id: int
+
+    :returns: Group and car ids if the group is in a car, None if it waits
+    :type returns: dict
+    """
+    if group_id not in group_filter:
+        raise Http404
+
+    location = locations.get(group_id)
+    if location is None:
+        if group_id in tombstones:
+            raise Http404
+        with replica_reads(group_id) as replica:
+            group = get_object_or_404(
+                Group.objects.select_related('journey__car'),
+                id=group_id
+            )
+            location = group.location()
+        if not replica or settings.REPLICA_READ_YOUR_WRITES:
+            locations.add(group_id, *location)
+
+    state, car_id = location
+    if state == IN_CAR:
+        return {'group': group_id, 'car': car_id}
+    elif state == DROPPED:
+        raise Http404
+    return None
+
+
+@traced
+def wait_location(group_id, timeout):
+    """
+    Locate a registered group, waiting until its location changes if it is
+    waiting
+
+    Only the changes made by this process wake the request up: if another
+    process assigns the group, it is located when the timeout passes.
+
+    :param group_id: Id of the group
+    :type group_id: int
+    :param timeout: Seconds to wait at most
+    :type timeout: float
+
+    :returns: Group and car ids if the group is in a car, None if it still
+        waits
+    :type returns: dict
+    """
+    with notifier.listen(group_id) as changed:
+        location = locate_group(group_id)
+        if location is not None or not changed.wait(timeout):
+            return location
+    return locate_group(group_id)
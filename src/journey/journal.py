@@ -0,0 +1,199 @@
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+SNAPSHOT = 'snapshot.json'
+SEGMENT = 'journal-{:012d}.log'
+
+
+def replay_event(engine, event):
+    """
+    Apply a journal event to a matching engine
+
+    :param engine: Engine to update
+    :type engine: journey.matching.MatchingEngine
+    :param event: Event read from the journal
+    :type event: dict
+    """
+    name = event['event']
+    if name == 'reset':
+        engine.reset()
+    elif name == 'cars_added':
+        for car_id, seats in event['cars']:
+            engine.add_car(car_id, seats)
+    elif name == 'car_removed':
+        engine.remove_car(event['car'])
+    elif name == 'group_enqueued':
+        engine.add_group(event['group'], event['people'],
+                         event.get('enqueued'))
+    elif name == 'assigned':
+        engine.remove_group(event['group'])
+        if 'seats' in event:
+            engine.add_car(event['car'], event['seats'])
+        else:
+            engine.remove_car(event['car'])
+    elif name == 'dropoff':
+        engine.remove_group(event['group'])
+        if event['car'] is not None:
+            engine.add_car(event['car'], event['seats'])
+
+
+class Journal:
+    """
+    Append-only journal of the matching events with periodic snapshots
+
+    Events are appended to numbered segment files once their transaction
+    commits. Every `snapshot_every` events the state of the engine is saved
+    and the older segments are deleted, so restoring the engine only needs
+    the last snapshot and the events after it.
+
+    The journal belongs to a single process: several processes would number
+    their events in the same segments and delete each other's. Snapshots may
+    include changes of transactions still in progress, so the engine is only
+    restored from the journal when the process starts.
+    """
+
+    def __init__(self, directory=None, snapshot_every=10000, fsync=False):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.engine = None
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._file = None
+        self._seq = 0
+        self._pending = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segments(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith('journal-') and name.endswith('.log')]
+        return sorted(names)
+
+    def _read_snapshot(self):
+        try:
+            with open(self._path(SNAPSHOT)) as snapshot:
+                return json.load(snapshot)
+        except FileNotFoundError:
+            return None
+
+    def _read_events(self, after=0):
+        for name in self._segments():
+            with open(self._path(name)) as segment:
+                for line in segment:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        break
+                    if event['seq'] > after:
+                        yield event
+
+    def _open(self):
+        if self._file:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot = self._read_snapshot()
+        self._seq = snapshot['seq'] if snapshot else 0
+        for event in self._read_events(after=self._seq):
+            self._seq = event['seq']
+        self._file = open(self._path(SEGMENT.format(self._seq + 1)), 'a')
+
+    def _rotate(self):
+        self._file.close()
+        self._file = open(self._path(SEGMENT.format(self._seq + 1)), 'a')
+
+    def record(self, event, **data):
+        """
+        Append an event to the journal when the current transaction commits
+
+        :param event: Name of the event
+        :type event: str
+        """
+        if self.enabled:
+            transaction.on_commit(lambda: self._append(event, data))
+
+    def _append(self, event, data):
+        with self._lock:
+            self._open()
+            self._seq += 1
+            data.update(seq=self._seq, event=event)
+            self._file.write(json.dumps(data) + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+            self._pending += 1
+            snapshot_due = self._pending >= self.snapshot_every
+            if snapshot_due:
+                self._pending = 0
+
+        if snapshot_due and self.engine:
+            self.snapshot(self.engine)
+
+    def snapshot(self, engine):
+        """
+        Save the state of the engine and delete the events it includes
+
+        :param engine: Engine to save
+        :type engine: journey.matching.MatchingEngine
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                self._open()
+                seq = self._seq
+                self._rotate()
+                self._pending = 0
+
+            state = engine.dump()
+            state['seq'] = seq
+            path = self._path(SNAPSHOT)
+            with open(path + '.tmp', 'w') as snapshot:
+                json.dump(state, snapshot)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(path + '.tmp', path)
+
+            with self._lock:
+                for name in self._segments():
+                    if int(name[len('journal-'):-len('.log')]) <= seq:
+                        os.remove(self._path(name))
+
+    def restore(self, engine):
+        """
+        Restore the engine from the last snapshot and the events after it
+
+        :param engine: Engine to restore
+        :type engine: journey.matching.MatchingEngine
+
+        :returns: If there was a snapshot to restore
+        :type returns: Bool
+        """
+        if not self.enabled:
+            return False
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            snapshot = self._read_snapshot()
+            if snapshot is None:
+                return False
+
+            engine.restore(snapshot)
+            for event in self._read_events(after=snapshot['seq']):
+                replay_event(engine, event)
+        return True
+
+
+journal = Journal(
+    settings.MATCHING_JOURNAL_DIR,
+    settings.MATCHING_SNAPSHOT_EVERY,
+    settings.MATCHING_JOURNAL_FSYNC
+)
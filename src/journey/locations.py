@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .notifications import notifier
+from .replicas import recent_writes
+
+IN_CAR = 'in_car'
+WAITING = 'waiting'
+DROPPED = 'dropped'
+
+
+class LocationCache:
+    """
+    Cache of the location of every group as a (state, car id) pair
+
+    The cache is updated by the model methods and services that change the
+    location of a group, once their transaction commits, so entries don't
+    need to expire.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def key(group_id):
+        return 'location:{}'.format(group_id)
+
+    def get(self, group_id):
+        """
+        Location of a group
+
+        :param group_id: Id of the group
+        :type group_id: int
+
+        :returns: State and car id, None if it isn't cached
+        :type returns: (str, int)
+        """
+        return self.cache.get(self.key(group_id))
+
+    def set(self, group_id, state, car_id=None):
+        """
+        Cache the location of a group when the current transaction commits
+
+        :param group_id: Id of the group
+        :type group_id: int
+        :param state: IN_CAR, WAITING or DROPPED
+        :type state: str
+        :param car_id: Id of the car of the group
+        :type car_id: int
+        """
+        self.set_many({group_id: (state, car_id)})
+
+    def add(self, group_id, state, car_id=None):
+        """
+        Cache the location of a group read from the database, unless a newer
+        one was cached meanwhile
+
+        :param group_id: Id of the group
+        :type group_id: int
+        :param state: IN_CAR, WAITING or DROPPED
+        :type state: str
+        :param car_id: Id of the car of the group
+        :type car_id: int
+        """
+        self.cache.add(self.key(group_id), (state, car_id), None)
+
+    def set_many(self, locations):
+        """
+        Cache many locations when the current transaction commits
+
+        :param locations: (state, car id) pairs by group id
+        :type locations: dict
+        """
+        data = {self.key(group_id): location
+                for group_id, location in locations.items()}
+        if data:
+            transaction.on_commit(lambda: self._publish(data, locations))
+
+    def _publish(self, data, locations):
+        self.cache.set_many(data, None)
+        recent_writes.add_many(locations)
+        notifier.notify_many(locations)
+
+    def clear(self):
+        """
+        Remove every location
+        """
+        self.cache.clear()
+
+
+locations = LocationCache(settings.LOCATION_CACHE)
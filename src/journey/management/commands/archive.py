@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...archive import archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Move finished journeys and dropped off groups to the archive tables '
+        'in batches, once or every --interval seconds.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.ARCHIVE_BATCH_SIZE,
+                            help='Groups moved in every transaction')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Seconds between archives, archive once if '
+                                 'not given')
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.perf_counter()
+            journeys, groups = archive(options['batch_size'])
+            self.stdout.write(
+                'Archived {} journeys and {} groups in {:.1f}ms'.format(
+                    journeys, groups, (time.perf_counter() - start) * 1000
+                )
+            )
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
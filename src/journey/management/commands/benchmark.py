@@ -0,0 +1,111 @@
+import json
+import os
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from ...benchmark import DEFAULT_MIX, Benchmark, Server, parse_mix
+from ...journal import journal
+
+
+class Command(BaseCommand):
+    help = (
+        'Load benchmark of the HTTP API. The application is served in this '
+        'process on a scratch copy of the database, without journal, unless '
+        '--url is given, and the results can be saved as JSON to compare '
+        'them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url',
+                            help='Benchmark a running server instead')
+        parser.add_argument('--fleet', type=int, default=1000,
+                            help='Cars loaded before the traffic')
+        parser.add_argument('--requests', type=int, default=5000,
+                            help='Requests of the traffic')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Clients sending requests at the same time')
+        parser.add_argument('--mix', default=','.join(
+            '{}={}'.format(endpoint, weight)
+            for endpoint, weight in DEFAULT_MIX.items()
+        ), help='Weights of the endpoints, like journey=40,locate=60')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output',
+                            help='File to save the results as JSON')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        if options['url']:
+            results = self.run(options['url'], mix, options)
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                if connection.vendor == 'sqlite':
+                    # In-memory databases can't wait for locks
+                    connection.settings_dict['TEST']['NAME'] = os.path.join(
+                        directory, 'benchmark.sqlite3'
+                    )
+                old_name = connection.creation.create_test_db(
+                    verbosity=0, autoclobber=True
+                )
+                journal.directory = None
+                try:
+                    with Server() as server:
+                        results = self.run(server.url, mix, options)
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results.update(
+            commit=self.commit(),
+            settings=os.environ.get('DJANGO_SETTINGS_MODULE'),
+            database=settings.DATABASES['default']['ENGINE'],
+            url=options['url'],
+            date=timezone.now().isoformat(),
+        )
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+        self.write_results(results)
+
+    def run(self, url, mix, options):
+        benchmark = Benchmark(
+            url,
+            fleet=options['fleet'],
+            requests=options['requests'],
+            concurrency=options['concurrency'],
+            mix=mix,
+            seed=options['seed']
+        )
+        return benchmark.run()
+
+    def commit(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def write_results(self, results):
+        self.stdout.write(
+            '{requests} requests, concurrency {concurrency}, fleet {fleet} '
+            '(loaded in {fleet_load:.1f}ms): {elapsed:.2f}s, '
+            '{throughput:.1f} req/s'.format(**results)
+        )
+        for endpoint, result in results['endpoints'].items():
+            self.stdout.write(
+                '{:<8} {:>7.1f} req/s  p50={:.2f}ms p95={:.2f}ms '
+                'p99={:.2f}ms max={:.2f}ms  statuses={} errors={}'.format(
+                    endpoint, result['throughput'], result['p50'],
+                    result['p95'], result['p99'], result['max'],
+                    result['statuses'], result['errors']
+                )
+            )
@@ -0,0 +1,60 @@
+import io
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...profiling import dumps
+
+
+class Command(BaseCommand):
+    help = (
+        'Merge the cProfile dumps of ProfilingMiddleware and print the top '
+        'functions of every endpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('endpoints', nargs='*',
+                            help='Names of the endpoints, like post_journey, '
+                                 'every endpoint if not given')
+        parser.add_argument('--directory', default=settings.PROFILING_DIR,
+                            help='Directory of the dumps, PROFILING_DIR by '
+                                 'default')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Functions printed per endpoint')
+        parser.add_argument('--sort', default='cumulative',
+                            help='Order of the functions, like cumulative, '
+                                 'tottime or calls')
+
+    def handle(self, *args, **options):
+        if not options['directory']:
+            raise CommandError('PROFILING_DIR is not set, use --directory')
+        try:
+            paths = dumps(options['directory'], options['endpoints'])
+        except FileNotFoundError:
+            raise CommandError('{} does not exist'.format(
+                options['directory']
+            ))
+
+        for endpoint, endpoint_paths in paths.items():
+            stream = io.StringIO()
+            stats, loaded = None, 0
+            for path in endpoint_paths:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(path, stream=stream)
+                    else:
+                        stats.add(path)
+                    loaded += 1
+                except (OSError, EOFError, ValueError):
+                    # Removed by the rotation meanwhile
+                    continue
+            if stats is None:
+                continue
+            self.stdout.write('{}: {} profiles'.format(
+                endpoint, loaded
+            ))
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(
+                options['limit']
+            )
+            self.stdout.write(stream.getvalue())
@@ -0,0 +1,41 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ...replicas import copy_database
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the SQLite database into the replica of REPLICA_DATABASE, once '
+        'or every --interval seconds.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Seconds between copies, copy once if not '
+                                 'given')
+
+    def handle(self, *args, **options):
+        if not settings.REPLICA_DATABASE:
+            raise CommandError('REPLICA_DATABASE is not set')
+        source = connections[DEFAULT_DB_ALIAS]
+        target = connections[settings.REPLICA_DATABASE]
+        if source.vendor != 'sqlite' or target.vendor != 'sqlite':
+            raise CommandError('Only SQLite databases can be copied, use the '
+                               'replication of the database instead')
+        if not hasattr(sqlite3.Connection, 'backup'):
+            raise CommandError('Copying SQLite databases needs Python 3.7')
+
+        while True:
+            start = time.perf_counter()
+            copy_database(source, target)
+            self.stdout.write('Copied in {:.1f}ms'.format(
+                (time.perf_counter() - start) * 1000
+            ))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,111 @@
+import json
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from ...simulation import (Simulation, read_events, synthetic_events,
+                           synthetic_fleet)
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate the matching of synthetic or recorded traffic on a virtual '
+        'clock and report utilization, waiting times and cost per event. '
+        'It runs on a scratch copy of the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cars', type=int, default=100,
+                            help='Cars of the fleet, with random seats')
+        parser.add_argument('--groups', type=int, default=10000,
+                            help='Synthetic groups to arrive')
+        parser.add_argument('--arrival-rate', type=float, default=0.5,
+                            help='Synthetic groups that arrive per second')
+        parser.add_argument('--trip-mean', type=float, default=None,
+                            help='Mean seconds of a trip, 600 for synthetic '
+                                 'traffic, trips only end with the recorded '
+                                 'dropoffs if not given with --trace')
+        parser.add_argument('--trace',
+                            help='JSON lines file with recorded events')
+        parser.add_argument('--policy',
+                            default=settings.MATCHING_QUEUE_POLICY,
+                            help='Dotted path of the queue policy')
+        parser.add_argument('--max-wait', type=float,
+                            default=settings.MATCHING_MAX_WAIT,
+                            help='Seconds that groups should wait at most')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', action='store_true',
+                            help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        trip_mean = options['trip_mean']
+        if options['trace']:
+            trace = open(options['trace'])
+            events = read_events(trace)
+        else:
+            trace = None
+            events = synthetic_events(options['groups'],
+                                      options['arrival_rate'],
+                                      options['seed'])
+            trip_mean = trip_mean or 600
+
+        trip_time = None
+        if trip_mean:
+            def trip_time(group_id, people):
+                return rng.expovariate(1 / trip_mean)
+
+        policy = import_string(options['policy'])(
+            max_wait=options['max_wait']
+        )
+        simulation = Simulation(
+            synthetic_fleet(options['cars'], options['seed']),
+            events,
+            trip_time=trip_time,
+            policy=policy
+        )
+
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            report = simulation.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if trace:
+                trace.close()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_report(report)
+
+    def write_report(self, report):
+        self.stdout.write(
+            '{events} events, {simulated_time:.0f}s simulated in '
+            '{wall_time:.2f}s ({speedup:.0f}x)'.format(**report)
+        )
+        self.stdout.write(
+            'groups={groups} served={served} waiting={waiting} '
+            'utilization={utilization:.1%}'.format(**report)
+        )
+        self.stdout.write(
+            'wait      ' + self.format_summary(report['wait'], 's')
+        )
+        for people, wait in report['wait_by_size'].items():
+            self.stdout.write(
+                'wait {}   '.format(people) + self.format_summary(wait, 's')
+            )
+        for event, cost in report['cost'].items():
+            self.stdout.write(
+                '{:<10}'.format(event) + self.format_summary(cost, 'ms') +
+                ' queries={:.1f}'.format(cost['queries'])
+            )
+
+    def format_summary(self, summary, unit):
+        return ' '.join(
+            '{}={:.2f}{}'.format(key, summary[key], unit)
+            for key in ('mean', 'p50', 'p90', 'p95', 'p99', 'max')
+        )
@@ -0,0 +1,426 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .journal import journal as default_journal
+
+MIN_CAPACITY = 4
+MAX_CAPACITY = 6
+CAPACITIES = range(MIN_CAPACITY, MAX_CAPACITY + 1)
+WAIT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class QueuePolicy(ABC):
+    """
+    Policy that chooses which waiting group gets a car
+
+    Only the first group of every queue is a candidate, so groups of the same
+    size always keep their arrival order. `max_wait` is the maximum time, in
+    seconds, that groups should wait.
+    """
+
+    def __init__(self, max_wait=None):
+        self.max_wait = max_wait
+
+    @abstractmethod
+    def choose(self, heads, now):
+        """
+        Choose the queue to take a group from
+
+        :param heads: Time the first group of every candidate queue was
+            enqueued, by the people of the queue
+        :type heads: dict
+        :param now: Current time
+        :type now: float
+
+        :returns: People of the chosen queue
+        :type returns: int
+        """
+
+
+class SmallestFirstPolicy(QueuePolicy):
+    """
+    Smaller groups first, so more groups fit in the free cars
+    """
+
+    def choose(self, heads, now):
+        return min(heads)
+
+
+class AgingPolicy(QueuePolicy):
+    """
+    Smaller groups first, but waiting groups age until they go first
+
+    A group ages one size every `max_wait` / number of sizes seconds, so a
+    group that has waited `max_wait` goes before a group of the smallest size
+    that has just arrived. Ties go to the group that has waited more.
+    """
+
+    def __init__(self, max_wait=300):
+        super().__init__(max_wait)
+
+    def choose(self, heads, now):
+        aging = len(CAPACITIES) / self.max_wait
+        return min(
+            heads,
+            key=lambda people: (
+                people - (now - heads[people]) * aging, heads[people]
+            )
+        )
+
+
+def get_queue_policy():
+    """
+    Build the queue policy of the settings
+
+    :returns: Queue policy
+    :type returns: journey.matching.QueuePolicy
+    """
+    policy = import_string(settings.MATCHING_QUEUE_POLICY)
+    return policy(max_wait=settings.MATCHING_MAX_WAIT)
+
+
+class WaitStats:
+    """
+    Waiting times of the groups of a size that got a car
+
+    Times are counted in a cumulative histogram with the upper bounds of
+    WAIT_BUCKETS, plus the groups that waited more than the maximum wait.
+    """
+
+    def __init__(self, max_wait=None):
+        self.max_wait = max_wait
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.over_max_wait = 0
+        self.buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def add(self, wait):
+        """
+        Count the waiting time of a group
+
+        :param wait: Seconds the group waited
+        :type wait: float
+        """
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+        self.buckets[bisect_left(WAIT_BUCKETS, wait)] += 1
+        if self.max_wait is not None and wait > self.max_wait:
+            self.over_max_wait += 1
+
+    def as_dict(self):
+        cumulative = 0
+        histogram = []
+        for bound, count in zip(WAIT_BUCKETS + (None,), self.buckets):
+            cumulative += count
+            histogram.append([bound, cumulative])
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'over_max_wait': self.over_max_wait,
+            'histogram': histogram,
+        }
+
+
+class MatchingEngine:
+    """
+    In-memory index of waiting groups and free cars
+
+    Waiting groups are kept in one FIFO queue per number of people and cars
+    with room for a group in one pool per number of free seats, so finding a
+    match never scans the database. The database is still the durable
+    record: the engine is loaded from it on first use, unless there is a
+    journal snapshot to restore it from, and rebuilt from it after
+    `invalidate`.
+
+    The queue policy chooses which queue gives the next group to a car, and
+    the waiting time of every matched group is counted per size.
+    """
+
+    def __init__(self, journal=None, policy=None, clock=time.time):
+        self.journal = journal
+        if journal is not None:
+            journal.engine = self
+        self.policy = policy or SmallestFirstPolicy()
+        self.clock = clock
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._restored = False
+        self._groups = {}
+        self._cars = {}
+        self._waits = {}
+        self._clear()
+        self.reset_wait_stats()
+
+    def _clear(self):
+        self._groups = {capacity: OrderedDict() for capacity in CAPACITIES}
+        self._cars = {capacity: OrderedDict() for capacity in CAPACITIES}
+
+    def reset_wait_stats(self):
+        """
+        Restart the waiting time counters
+        """
+        with self._lock:
+            self._waits = {
+                capacity: WaitStats(self.policy.max_wait)
+                for capacity in CAPACITIES
+            }
+
+    def wait_stats(self):
+        """
+        Waiting time counters of the matched groups and age of the oldest
+        waiting group, by the people of the groups
+
+        :returns: Counters by people
+        :type returns: dict
+        """
+        with self._lock:
+            self._ensure_loaded()
+            now = self.clock()
+            stats = {}
+            for people, queue in self._groups.items():
+                stats[people] = self._waits[people].as_dict()
+                stats[people]['waiting'] = len(queue)
+                stats[people]['oldest'] = (
+                    now - next(iter(queue.values())) if queue else 0.0
+                )
+            return stats
+
+    def _load(self):
+        from .models import Car, Group
+
+        # A snapshot may include changes that were rolled back later, so it
+        # is only trusted when the process starts
+        restore = not self._restored
+        self._restored = True
+        if restore and self.journal and self.journal.restore(self):
+            return
+
+        self._clear()
+        cars = Car.objects.filter(
+            is_available=True
+        ).order_by('free_seats', 'id').values_list('id', 'free_seats')
+        for car_id, seats in cars.iterator():
+            if seats in self._cars:
+                self._cars[seats][car_id] = None
+
+        groups = Group.objects.filter(
+            is_available=True
+        ).order_by('created', 'id').values_list('id', 'people', 'created')
+        for group_id, people, created in groups.iterator():
+            self._groups[people][group_id] = created.timestamp()
+        self._loaded = True
+
+        if self.journal and self.journal.enabled:
+            self.journal.snapshot(self)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._load()
+
+    def invalidate(self):
+        """
+        Forget the current state, it will be loaded again from the database
+        """
+        with self._lock:
+            self._clear()
+            self._loaded = False
+
+    def reset(self, cars=()):
+        """
+        Restart the engine without waiting groups
+
+        :param cars: Free cars as (id, free seats) pairs
+        :type cars: [(int, int)]
+        """
+        with self._lock:
+            self._clear()
+            for car_id, seats in cars:
+                self._cars[seats][car_id] = None
+            self._loaded = True
+
+    def dump(self):
+        """
+        State of the engine, in matching order
+
+        :returns: Free cars and waiting groups
+        :type returns: dict
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return {
+                'cars': [[car_id, seats]
+                         for seats, pool in self._cars.items()
+                         for car_id in pool],
+                'groups': [[group_id, people, enqueued]
+                           for people, queue in self._groups.items()
+                           for group_id, enqueued in queue.items()],
+            }
+
+    def restore(self, state):
+        """
+        Replace the state of the engine with a dumped one
+
+        :param state: State returned by dump
+        :type state: dict
+        """
+        with self._lock:
+            self._clear()
+            for car_id, seats in state['cars']:
+                self._cars[seats][car_id] = None
+            now = self.clock()
+            for group_id, people, *enqueued in state['groups']:
+                self._groups[people][group_id] = (
+                    enqueued[0] if enqueued else now
+                )
+            self._loaded = True
+
+    def add_car(self, car_id, seats):
+        """
+        Move a car to the pool of its free seats, cars without room for a
+        group are left out of the pools
+
+        :param car_id: Id of the car
+        :type car_id: int
+        :param seats: Free seats of the car
+        :type seats: int
+        """
+        with self._lock:
+            self._ensure_loaded()
+            for pool in self._cars.values():
+                pool.pop(car_id, None)
+            if seats in self._cars:
+                self._cars[seats][car_id] = None
+
+    def remove_car(self, car_id):
+        """
+        Remove a car from the pool of free cars, if it is there
+
+        :param car_id: Id of the car
+        :type car_id: int
+        """
+        with self._lock:
+            self._ensure_loaded()
+            for pool in self._cars.values():
+                pool.pop(car_id, None)
+
+    def add_group(self, group_id, people, enqueued=None):
+        """
+        Enqueue a waiting group at the end of the queue of its size
+
+        :param group_id: Id of the group
+        :type group_id: int
+        :param people: People of the group
+        :type people: int
+        :param enqueued: Time the group was enqueued, now by default
+        :type enqueued: float
+
+        :returns: Time the group was enqueued
+        :type returns: float
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if enqueued is None:
+                enqueued = self.clock()
+            self._groups[people][group_id] = enqueued
+            return enqueued
+
+    def remove_group(self, group_id):
+        """
+        Remove a group from the waiting queues, if it is there
+
+        :param group_id: Id of the group
+        :type group_id: int
+        """
+        with self._lock:
+            self._ensure_loaded()
+            for queue in self._groups.values():
+                queue.pop(group_id, None)
+
+    def pop_car(self, people):
+        """
+        Take the car with fewest free seats that fits a group
+
+        :param people: People of the group
+        :type people: int
+
+        :returns: (id, free seats) of the car, None if there isn't any
+        :type returns: (int, int)
+        """
+        with self._lock:
+            self._ensure_loaded()
+            for seats in range(people, MAX_CAPACITY + 1):
+                pool = self._cars[seats]
+                if pool:
+                    car_id, _ = pool.popitem(last=False)
+                    return car_id, seats
+        return None
+
+    def pop_group(self, seats):
+        """
+        Take the waiting group that fits in a car chosen by the queue policy
+
+        :param seats: Free seats of the car
+        :type seats: int
+
+        :returns: (id, people) of the group, None if there isn't any
+        :type returns: (int, int)
+        """
+        with self._lock:
+            self._ensure_loaded()
+            heads = {}
+            for people in range(MIN_CAPACITY, min(seats, MAX_CAPACITY) + 1):
+                queue = self._groups[people]
+                if queue:
+                    heads[people] = next(iter(queue.values()))
+            if not heads:
+                return None
+
+            now = self.clock()
+            people = self.policy.choose(heads, now)
+            group_id, enqueued = self._groups[people].popitem(last=False)
+            self._waits[people].add(max(now - enqueued, 0.0))
+            return group_id, people
+
+    def waiting_count(self, people=None):
+        """
+        Number of waiting groups
+
+        :param people: Only count groups of this size
+        :type people: int
+
+        :returns: Number of groups
+        :type returns: int
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if people is not None:
+                return len(self._groups[people])
+            return sum(len(queue) for queue in self._groups.values())
+
+    def free_count(self, seats=None):
+        """
+        Number of cars with room for a group
+
+        :param seats: Only count cars with these free seats
+        :type seats: int
+
+        :returns: Number of cars
+        :type returns: int
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if seats is not None:
+                return len(self._cars[seats])
+            return sum(len(pool) for pool in self._cars.values())
+
+
+engine = MatchingEngine(default_journal, get_queue_policy())
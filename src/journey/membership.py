@@ -0,0 +1,128 @@
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+MASK = (1 << 64) - 1
+
+
+def mix(value):
+    """
+    Spread the bits of an integer over 64 bits (splitmix64 finalizer)
+
+    :param value: Integer to mix
+    :type value: int
+
+    :returns: Mixed integer
+    :type returns: int
+    """
+    value = (value + 0x9E3779B97F4A7C15) & MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK
+    return value ^ (value >> 31)
+
+
+class GroupFilter:
+    """
+    Bloom filter of the registered group ids
+
+    A group id that is not in the filter was never registered, so it can be
+    answered with a 404 without reading the database. Ids in the filter may
+    still be unknown and must be looked up as usual.
+    """
+
+    def __init__(self, bits=2 ** 24, hashes=4, enabled=True):
+        self.bits = bits
+        self.hashes = hashes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._array = bytearray(bits // 8)
+
+    def _positions(self, group_id):
+        first = mix(group_id)
+        second = mix(first) | 1
+        for index in range(self.hashes):
+            yield (first + index * second) % self.bits
+
+    def _add(self, group_id):
+        for position in self._positions(group_id):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        from .models import Group
+
+        self._array = bytearray(self.bits // 8)
+        ids = Group.objects.values_list('id', flat=True)
+        for group_id in ids.iterator():
+            self._add(group_id)
+        self._loaded = True
+
+    def invalidate(self):
+        """
+        Forget the registered ids, they will be loaded again from the database
+        """
+        with self._lock:
+            self._loaded = False
+
+    def reset(self):
+        """
+        Restart the filter without registered ids
+        """
+        with self._lock:
+            self._array = bytearray(self.bits // 8)
+            self._loaded = True
+
+    def add(self, group_id):
+        """
+        Register a group id
+
+        :param group_id: Id of the group
+        :type group_id: int
+        """
+        self.add_many([group_id])
+
+    def add_many(self, group_ids):
+        """
+        Register many group ids
+
+        :param group_ids: Ids of the groups
+        :type group_ids: [int]
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._ensure_loaded()
+            for group_id in group_ids:
+                self._add(group_id)
+
+    def __contains__(self, group_id):
+        if not self.enabled:
+            return True
+
+        with self._lock:
+            self._ensure_loaded()
+            return all(
+                self._array[position >> 3] & (1 << (position & 7))
+                for position in self._positions(group_id)
+            )
+
+
+group_filter = GroupFilter(
+    settings.GROUP_FILTER_BITS,
+    settings.GROUP_FILTER_HASHES,
+    settings.GROUP_FILTER_ENABLED
+)
+
+
+@receiver(post_save, sender='journey.Group')
+def register_group(sender, instance, created, **kwargs):
+    """
+    Add every new group to the filter
+    """
+    if created:
+        group_filter.add(instance.id)
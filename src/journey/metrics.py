@@ -0,0 +1,280 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+
+from django.db import transaction
+
+from .matching import CAPACITIES, WAIT_BUCKETS, engine
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_sample(name, labels, value):
+    """
+    Line of a sample in the Prometheus text format
+
+    :param name: Name of the sample
+    :type name: str
+    :param labels: Label values by label name
+    :type labels: dict
+    :param value: Value of the sample
+    :type value: float
+
+    :returns: Line without the line break
+    :type returns: str
+    """
+    if labels:
+        name = '{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(label, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in labels.items()
+        ))
+    return '{} {}'.format(name, format_value(value))
+
+
+def format_histogram(name, labels, bounds, cumulative, total, count):
+    """
+    Lines of the samples of a histogram
+
+    :param bounds: Upper bounds of the buckets, without +Inf
+    :type bounds: tuple
+    :param cumulative: Observations of every bucket and of +Inf, cumulative
+    :type cumulative: list
+
+    :returns: Lines without line breaks
+    :type returns: [str]
+    """
+    lines = []
+    for bound, observations in zip(bounds + (float('inf'),), cumulative):
+        lines.append(format_sample(
+            name + '_bucket', dict(labels, le=format_value(bound)),
+            observations
+        ))
+    lines.append(format_sample(name + '_sum', labels, total))
+    lines.append(format_sample(name + '_count', labels, count))
+    return lines
+
+
+class Metric(ABC):
+    """
+    Metric of this process with a value for every combination of labels
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.description),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+
+    @abstractmethod
+    def collect(self):
+        """
+        Lines of the metric, its header and its samples
+
+        :returns: Samples in the text format
+        :type returns: [str]
+        """
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[self._key(labels)] += amount
+
+    def inc_on_commit(self, amount=1, **labels):
+        """
+        Increment the counter when the current transaction commits
+
+        :param amount: Amount to add
+        :type amount: float
+        """
+        if amount:
+            transaction.on_commit(lambda: self.inc(amount, **labels))
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def collect(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            format_sample(self.name, dict(zip(self.labels, key)), value)
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+                 buckets=DURATION_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def collect(self):
+        lines = self.header()
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = []
+            for count in counts:
+                cumulative.append(count + (cumulative[-1] if cumulative
+                                           else 0))
+            lines.extend(format_histogram(
+                self.name, dict(zip(self.labels, key)), self.buckets,
+                cumulative, total, cumulative[-1]
+            ))
+        return lines
+
+
+class MatchingEngineMetrics:
+    """
+    Waiting groups, free cars and waiting times, read from the matching
+    engine that already keeps them
+
+    Every process has its own engine, so these are only the groups and cars
+    that this process knows, and the groups that it matched.
+    """
+
+    def collect(self):
+        stats = engine.wait_stats()
+        lines = [
+            '# HELP matching_waiting_groups Groups waiting for a car',
+            '# TYPE matching_waiting_groups gauge',
+        ]
+        lines.extend(
+            format_sample('matching_waiting_groups', {'people': people},
+                          stats[people]['waiting'])
+            for people in CAPACITIES
+        )
+        lines.extend([
+            '# HELP matching_oldest_wait_seconds Seconds that the oldest '
+            'waiting group has waited',
+            '# TYPE matching_oldest_wait_seconds gauge',
+        ])
+        lines.extend(
+            format_sample('matching_oldest_wait_seconds', {'people': people},
+                          stats[people]['oldest'])
+            for people in CAPACITIES
+        )
+        lines.extend([
+            '# HELP matching_free_cars Cars with room for a group',
+            '# TYPE matching_free_cars gauge',
+        ])
+        lines.extend(
+            format_sample('matching_free_cars', {'seats': seats},
+                          engine.free_count(seats))
+            for seats in CAPACITIES
+        )
+        lines.extend([
+            '# HELP matching_wait_seconds Seconds that the groups waited '
+            'for a car',
+            '# TYPE matching_wait_seconds histogram',
+        ])
+        for people in CAPACITIES:
+            people_stats = stats[people]
+            lines.extend(format_histogram(
+                'matching_wait_seconds', {'people': people}, WAIT_BUCKETS,
+                [count for _, count in people_stats['histogram']],
+                people_stats['total'], people_stats['count']
+            ))
+        return lines
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds',
+    'Seconds to answer the requests',
+    labels=('endpoint',)
+)
+requests_total = Counter(
+    'http_requests_total',
+    'Requests answered',
+    labels=('endpoint', 'status')
+)
+journeys_started = Counter(
+    'journeys_started_total',
+    'Journeys started by this process'
+)
+journeys_finished = Counter(
+    'journeys_finished_total',
+    'Journeys finished by the dropoffs of this process'
+)
+matching_attempts = Counter(
+    'matching_attempts_total',
+    'Searches of a car for a group, or of groups for a car',
+    labels=('side',)
+)
+matching_hits = Counter(
+    'matching_hits_total',
+    'Groups that got a car',
+    labels=('side',)
+)
+
+METRICS = [
+    request_duration,
+    requests_total,
+    journeys_started,
+    journeys_finished,
+    matching_attempts,
+    matching_hits,
+    MatchingEngineMetrics(),
+]
+
+
+def render():
+    """
+    Every metric in the Prometheus text format
+
+    :returns: Text of the metrics
+    :type returns: str
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,73 @@
+from contextlib import ExitStack
+import logging
+import time
+
+from django.db import connections
+
+from .metrics import request_duration, requests_total
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    """
+    Database execute wrapper that counts queries and the time spent on them
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+class QueryCountMiddleware:
+    """
+    Report the number of SQL queries of every request and the time spent on
+    them in the X-DB-Queries and X-DB-Time (milliseconds) response headers
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+
+        response['X-DB-Queries'] = str(counter.count)
+        response['X-DB-Time'] = '{:.3f}'.format(counter.duration * 1000)
+        logger.debug(
+            '%s %s %s queries=%d db_time=%.3fms',
+            request.method, request.path, response.status_code,
+            counter.count, counter.duration * 1000
+        )
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Count the requests by endpoint and status, and the seconds to answer
+    them by endpoint
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        endpoint = match.url_name if match and match.url_name else 'unknown'
+        request_duration.observe(time.perf_counter() - start,
+                                 endpoint=endpoint)
+        requests_total.inc(endpoint=endpoint, status=response.status_code)
+        return response
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.7
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journey', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(fields=['is_available', 'seats', 'created'], name='car_available_seats_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='group',
+            index=models.Index(fields=['is_available', 'people', 'created'], name='group_available_people_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.7
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journey', '0002_matching_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='journey',
+            name='car',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='journeys', to='journey.Car'),
+        ),
+    ]
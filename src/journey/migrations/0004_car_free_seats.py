@@ -0,0 +1,44 @@
+# Generated by Django 2.2.7
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def fill_free_seats(apps, schema_editor):
+    Car = apps.get_model('journey', 'Car')
+    Journey = apps.get_model('journey', 'Journey')
+    used = dict(
+        Journey.objects.filter(
+            finished__isnull=True,
+            car__isnull=False
+        ).values_list('car').annotate(people=Sum('group__people'))
+    )
+    for car in Car.objects.iterator():
+        car.free_seats = max(car.seats - (used.get(car.id) or 0), 0)
+        car.save(update_fields=['free_seats'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journey', '0003_journey_car_set_null'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='free_seats',
+            field=models.PositiveSmallIntegerField(blank=True, default=0, validators=[django.core.validators.MaxValueValidator(6)]),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_free_seats, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='car',
+            name='car_available_seats_idx',
+        ),
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(fields=['is_available', 'free_seats', 'created'], name='car_available_free_seats_idx'),
+        ),
+    ]
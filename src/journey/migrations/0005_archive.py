@@ -0,0 +1,35 @@
+# Generated by Django 2.2.7
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journey', '0004_car_free_seats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_id', models.BigIntegerField(db_index=True)),
+                ('created', models.DateTimeField()),
+                ('people', models.PositiveSmallIntegerField()),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedJourney',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_id', models.BigIntegerField(blank=True, null=True)),
+                ('car_id', models.BigIntegerField(blank=True, null=True)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField()),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
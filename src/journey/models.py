@@ -1,8 +1,58 @@
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models, transaction
+from django.db.models import Case, F, Value, When
 from django.utils import timezone
 
-from .exceptions import AssignCarException, JourneyException
+from .exceptions import AssignCarException, CarTakenException, JourneyException
+from .locations import DROPPED, IN_CAR, WAITING, locations
+from .matching import MAX_CAPACITY, MIN_CAPACITY, engine
+from .tracing import traced
+
+
+def seats_update(delta):
+    """
+    Fields to update the free seats of cars relative to their current value
+
+    The new availability is computed by the database from the same row, so
+    concurrent updates of the same car never overwrite each other.
+
+    :param delta: Seats to add, negative to take them
+    :type delta: int
+
+    :returns: Values for QuerySet.update
+    :type returns: dict
+    """
+    return {
+        'free_seats': F('free_seats') + delta,
+        'is_available': Case(
+            When(free_seats__gte=MIN_CAPACITY - delta, then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField()
+        ),
+    }
+
+
+def resize_update(seats):
+    """
+    Fields to change the seats of cars keeping the seats taken, relative to
+    their current value like seats_update
+
+    :param seats: New seats of the cars
+    :type seats: int
+
+    :returns: Values for QuerySet.update
+    :type returns: dict
+    """
+    return {
+        'seats': Value(seats),
+        'free_seats': F('free_seats') + seats - F('seats'),
+        'is_available': Case(
+            When(free_seats__gte=F('seats') + MIN_CAPACITY - seats,
+                 then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField()
+        ),
+    }
 
 
 class Car(models.Model):
@@ -13,19 +63,103 @@ class Car(models.Model):
     seats = models.PositiveSmallIntegerField(
         validators=[MinValueValidator(4), MaxValueValidator(6)]
     )
+    free_seats = models.PositiveSmallIntegerField(
+        blank=True,
+        validators=[MaxValueValidator(6)]
+    )
     is_available = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['is_available', 'free_seats', 'created'],
+                name='car_available_free_seats_idx'
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.free_seats is None:
+            self.free_seats = self.seats if self.is_available else 0
+        super().save(*args, **kwargs)
+
+    def take_seats(self, people):
+        """
+        Take the seats of a group that starts a journey
+
+        :param people: People of the group
+        :type people: int
+        """
+        self.free_seats -= people
+        self.is_available = self.free_seats >= MIN_CAPACITY
+
+    def release_seats(self, people):
+        """
+        Release the seats of a group that finishes a journey
+
+        :param people: People of the group
+        :type people: int
+        """
+        self.free_seats += people
+        self.is_available = self.free_seats >= MIN_CAPACITY
+
+    @traced
+    def claim_seats(self, people):
+        """
+        Take seats with a conditional update, so that the seats can't be
+        taken by two workers at the same time
+
+        :param people: People of the group
+        :type people: int
+
+        :returns: If the seats were free and are now taken
+        :type returns: Bool
+        """
+        claimed = Car.objects.filter(
+            id=self.id,
+            is_available=True,
+            free_seats__gte=people
+        ).update(**seats_update(-people))
+        if claimed:
+            self.take_seats(people)
+        return bool(claimed)
+
+    @traced
+    def return_seats(self, people):
+        """
+        Give back the seats of a group with a relative update
+
+        :param people: People of the group
+        :type people: int
+        """
+        Car.objects.filter(id=self.id).update(**seats_update(people))
+        self.release_seats(people)
+
     def get_available_group(self):
         """
-        Detect a available group
+        Detect a available group, the one chosen by the queue policy among
+        the first group of every size that fits
 
         :returns: Available group
         :type returns: journey.Group
         """
-        return Group.objects.filter(
-            people__lte=self.seats,
-            is_available=True
-        ).order_by('people', 'created').first()
+        heads = {}
+        for people in range(MIN_CAPACITY,
+                            min(self.free_seats, MAX_CAPACITY) + 1):
+            group = Group.objects.filter(
+                people=people,
+                is_available=True
+            ).order_by('created').first()
+            if group:
+                heads[people] = group
+        if not heads:
+            return None
+
+        people = engine.policy.choose(
+            {people: group.created.timestamp()
+             for people, group in heads.items()},
+            timezone.now().timestamp()
+        )
+        return heads[people]
 
 
 class Group(models.Model):
@@ -38,6 +172,14 @@ class Group(models.Model):
     )
     is_available = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['is_available', 'people', 'created'],
+                name='group_available_people_idx'
+            ),
+        ]
+
     def is_already_drop_off(self):
         """
         Detect if the group is already drop off
@@ -79,9 +221,22 @@ class Group(models.Model):
             return self.journey.get_car()
         return None
 
+    def location(self):
+        """
+        Location of the group
+
+        :returns: State of the group and id of its car
+        :type returns: (str, int)
+        """
+        if self.is_in_car():
+            return IN_CAR, self.get_car().id
+        elif self.is_already_drop_off():
+            return DROPPED, None
+        return WAITING, None
+
     def get_available_car(self):
         """
-        Get a available car for the group
+        Get a available car for the group, the one that fits it best
 
         :returns: a available car
         :type returns: journey.Car
@@ -91,15 +246,19 @@ class Group(models.Model):
                                    "finished journey".format(self.id))
 
         return Car.objects.filter(
-            seats__gte=self.people,
+            free_seats__gte=self.people,
             is_available=True
-        ).order_by('seats').first()
+        ).order_by('free_seats').first()
 
+    @traced
     @transaction.atomic
     def assign_car(self, car):
         """
         Start a journey assigning a car to the group
 
+        The group and the seats are claimed with conditional updates, so the
+        state read by other workers can't make them assigned twice.
+
         :param car: Car to assign to the group
         :type car: journey.Car
         """
@@ -107,28 +266,59 @@ class Group(models.Model):
             raise JourneyException("Group {} is in a car or "
                                    "finished journey".format(self.id))
 
-        if not(self.is_available and
-               car.is_available and
-               self.people <= car.seats):
+        if not (self.is_available and self.claim()):
             raise AssignCarException("Imposible to assign group "
                                      "{} to car {}".format(self.id, car.id))
+        if not car.claim_seats(self.people):
+            self.is_available = True
+            raise CarTakenException("Imposible to assign group "
+                                    "{} to car {}".format(self.id, car.id))
 
         Journey.objects.create(group=self, car=car)
-        car.is_available = False
-        car.save()
+        locations.set(self.id, IN_CAR, car.id)
+
+    @traced
+    def claim(self):
+        """
+        Mark the group as not available with a conditional update
+
+        :returns: If the group was available
+        :type returns: Bool
+        """
+        claimed = Group.objects.filter(
+            id=self.id,
+            is_available=True
+        ).update(is_available=False)
         self.is_available = False
-        self.save()
+        return bool(claimed)
 
-    @transaction.atomic
+    @traced
+    @transaction.atomic(savepoint=False)
     def finish_journey(self):
         """
         Finish a journey of a group
-        """
-        if self.is_in_car():
-            self.journey.finish()
 
+        The group is marked as not available first, which takes the write
+        lock, and its journey is read again after it, so a journey that
+        another worker started or finished meanwhile is seen.
+
+        :returns: Journey finished, None if the group wasn't in a car
+        :type returns: journey.Journey
+        """
+        Group.objects.filter(id=self.id).update(is_available=False)
         self.is_available = False
-        self.save()
+        journey = Journey.objects.select_related('car').filter(
+            group_id=self.id
+        ).first()
+        self._meta.get_field('journey').set_cached_value(self, journey)
+
+        finished = None
+        if journey is not None:
+            journey.group = self
+            if journey.finished is None and journey.finish():
+                finished = journey
+        locations.set(self.id, *self.location())
+        return finished
 
 
 class Journey(models.Model):
@@ -146,19 +336,56 @@ class Journey(models.Model):
     )
     car = models.ForeignKey(
         'Car',
-        on_delete=models.CASCADE,
-        related_name='journeys'
+        on_delete=models.SET_NULL,
+        related_name='journeys',
+        null=True,
+        blank=True
     )
 
     def get_car(self):
         return self.car
 
-    @transaction.atomic
+    @traced
+    @transaction.atomic(savepoint=False)
     def finish(self):
         """
-        Finish the journey
+        Finish the journey with a conditional update, the seats are only
+        given back by the worker that finishes it
+
+        :returns: If the journey was open and is now finished
+        :type returns: Bool
         """
-        self.finished = timezone.now()
-        self.car.is_available = True
-        self.car.save()
-        self.save()
+        finished = timezone.now()
+        if not Journey.objects.filter(
+            id=self.id,
+            finished__isnull=True
+        ).update(finished=finished):
+            self.refresh_from_db(fields=['finished'])
+            return False
+
+        self.finished = finished
+        self.car.return_seats(self.group.people)
+        if self.group_id:
+            locations.set(self.group_id, DROPPED)
+        return True
+
+
+class ArchivedGroup(models.Model):
+    """
+    Group dropped off and moved out of the group table
+    """
+    group_id = models.BigIntegerField(db_index=True)
+    created = models.DateTimeField()
+    people = models.PositiveSmallIntegerField()
+    archived = models.DateTimeField(default=timezone.now)
+
+
+class ArchivedJourney(models.Model):
+    """
+    Finished journey moved out of the journey table
+    """
+    group_id = models.BigIntegerField(null=True, blank=True)
+    car_id = models.BigIntegerField(null=True, blank=True)
+    started = models.DateTimeField()
+    finished = models.DateTimeField()
+    archived = models.DateTimeField(default=timezone.now)
@@ -0,0 +1,74 @@
+from contextlib import contextmanager
+import threading
+
+
+class LocationNotifier:
+    """
+    Requests of this process waiting for a change in the location of groups
+
+    Waiters of a group share one event, which is set and forgotten when the
+    location of the group changes, so a waiter must listen again to wait for
+    the next change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = {}
+
+    @contextmanager
+    def listen(self, group_id):
+        """
+        Listen to the changes of the location of a group
+
+        Start listening before reading the location, so a change between the
+        read and the wait is not missed.
+
+        :param group_id: Id of the group
+        :type group_id: int
+
+        :returns: Event set when the location changes
+        :type returns: threading.Event
+        """
+        with self._lock:
+            event, listeners = self._waiting.get(group_id, (None, 0))
+            if event is None:
+                event = threading.Event()
+            self._waiting[group_id] = (event, listeners + 1)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                current, listeners = self._waiting.get(group_id, (None, 0))
+                if current is event:
+                    if listeners > 1:
+                        self._waiting[group_id] = (event, listeners - 1)
+                    else:
+                        del self._waiting[group_id]
+
+    def notify_many(self, group_ids):
+        """
+        Wake up the requests waiting for some groups
+
+        :param group_ids: Ids of the groups whose location changed
+        :type group_ids: iterable
+        """
+        if not self._waiting:
+            return
+        with self._lock:
+            events = [self._waiting.pop(group_id)[0] for group_id in group_ids
+                      if group_id in self._waiting]
+        for event in events:
+            event.set()
+
+    def waiting_count(self):
+        """
+        Number of groups with requests waiting
+
+        :returns: Number of groups
+        :type returns: int
+        """
+        with self._lock:
+            return len(self._waiting)
+
+
+notifier = LocationNotifier()
@@ -0,0 +1,106 @@
+import json
+
+from django.core.exceptions import SuspiciousOperation
+from django.http import Http404, HttpResponse, JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from .batching import group_commit
+from .exceptions import QueueFullException
+from .handlers import (drop_off_group, get_group_id, get_wait, locate_group,
+                       register_journey, wait_location)
+
+FORM_CONTENT_TYPES = ('', 'application/x-www-form-urlencoded',
+                      'multipart/form-data')
+
+
+def parse_json(request):
+    """
+    Parse the body of a request like the parsers of the API views
+
+    :param request: Request with a JSON body
+    :type request: django.http.HttpRequest
+
+    :returns: Parsed data, None if the content type isn't supported
+    :type returns: object
+    """
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body.decode(request.encoding or 'utf-8'))
+        except ValueError:
+            raise SuspiciousOperation("JSON parse error")
+    if request.content_type in FORM_CONTENT_TYPES:
+        return request.POST
+    return None
+
+
+class PlainView(View):
+    """
+    View without the API framework that answers missing groups with the
+    body of the API views
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except Http404:
+            return JsonResponse({'detail': 'Not found.'}, status=404)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class JourneyView(PlainView):
+    """
+    POST a new request of a journey, without the API framework
+    """
+
+    def post(self, request):
+        data = parse_json(request)
+        if data is None:
+            return HttpResponse(status=415)
+
+        try:
+            group_commit.submit(register_journey, data)
+        except QueueFullException as error:
+            response = HttpResponse(status=429)
+            response['Retry-After'] = str(error.retry_after)
+            return response
+        return HttpResponse(status=200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class DropOffView(PlainView):
+    """
+    POST drop off a group, without the API framework
+    """
+
+    def post(self, request):
+        group_commit.submit(drop_off_group, get_group_id(request))
+        return HttpResponse(status=200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class LocateView(PlainView):
+    """
+    POST to locate a group in a car, without the API framework
+    """
+
+    def post(self, request):
+        location = locate_group(get_group_id(request))
+        if location is None:
+            return HttpResponse(status=204)
+        return JsonResponse(location, status=200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class LocateWaitView(PlainView):
+    """
+    POST to locate a group in a car, waiting for a change of its location,
+    without the API framework
+    """
+
+    def post(self, request):
+        location = wait_location(get_group_id(request), get_wait(request))
+        if location is None:
+            return HttpResponse(status=204)
+        return JsonResponse(location, status=200)
@@ -0,0 +1,157 @@
+import cProfile
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+EXTENSION = '.pstats'
+
+
+class Profiler:
+    """
+    cProfile dumps of a sample of the requests, one directory per endpoint
+
+    A request is profiled with probability `rate`, or always if it has the
+    `header` (a META key like HTTP_X_PROFILE). Every endpoint keeps its last
+    `max_files` dumps, older ones are removed. Without directory nothing is
+    profiled.
+    """
+
+    def __init__(self, directory=None, rate=0.0, header=None, max_files=50,
+                 random=random.random):
+        self.directory = directory
+        self.rate = rate
+        self.header = header
+        self.max_files = max_files
+        self.random = random
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def sampled(self, request):
+        """
+        If a request has to be profiled
+
+        :param request: Request
+        :type request: django.http.HttpRequest
+
+        :returns: If the request is profiled
+        :type returns: bool
+        """
+        if not self.enabled:
+            return False
+        if self.header and request.META.get(self.header):
+            return True
+        return self.random() < self.rate
+
+    def dump(self, endpoint, profile):
+        """
+        Write the profile of a request and rotate the dumps of its endpoint
+
+        :param endpoint: Name of the endpoint
+        :type endpoint: str
+        :param profile: Profile of the request
+        :type profile: cProfile.Profile
+
+        :returns: Path of the dump
+        :type returns: str
+        """
+        directory = os.path.join(self.directory, endpoint)
+        os.makedirs(directory, exist_ok=True)
+        name = '{:017d}-{}-{}'.format(
+            int(time.time() * 1000000), os.getpid(), next(self._sequence)
+        )
+        path = os.path.join(directory, name + EXTENSION)
+        # Written aside and renamed, so a merge never reads half a dump
+        temporary = os.path.join(directory, '.' + name)
+        profile.dump_stats(temporary)
+        os.replace(temporary, path)
+        with self._lock:
+            self._rotate(directory)
+        return path
+
+    def _rotate(self, directory):
+        dumps = sorted(name for name in os.listdir(directory)
+                       if name.endswith(EXTENSION))
+        for name in dumps[:max(len(dumps) - self.max_files, 0)]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+profiler = Profiler(
+    settings.PROFILING_DIR,
+    settings.PROFILING_RATE,
+    settings.PROFILING_HEADER,
+    settings.PROFILING_MAX_FILES
+)
+
+
+def dumps(directory, endpoints=None):
+    """
+    Dumps of the endpoints in a directory of profiles
+
+    :param directory: Directory of the profiles
+    :type directory: str
+    :param endpoints: Names of the endpoints, every endpoint if not given
+    :type endpoints: [str]
+
+    :returns: Paths of the dumps by endpoint, oldest first
+    :type returns: dict
+    """
+    paths = {}
+    for endpoint in sorted(os.listdir(directory)):
+        endpoint_directory = os.path.join(directory, endpoint)
+        if not os.path.isdir(endpoint_directory):
+            continue
+        if endpoints and endpoint not in endpoints:
+            continue
+        paths[endpoint] = [
+            os.path.join(endpoint_directory, name)
+            for name in sorted(os.listdir(endpoint_directory))
+            if name.endswith(EXTENSION)
+        ]
+    return paths
+
+
+class ProfilingMiddleware:
+    """
+    Profile a sample of the requests with cProfile when PROFILING_DIR is set,
+    see Profiler
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profiler.sampled(request):
+            return self.get_response(request)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another request of the process is being profiled
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.disable()
+
+        match = request.resolver_match
+        endpoint = match.url_name if match and match.url_name else 'unknown'
+        try:
+            profiler.dump(endpoint, profile)
+        except OSError:
+            logger.exception('Profile of %s not written', request.path)
+        return response
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+
+_state = threading.local()
+
+
+class RecentWrites:
+    """
+    Groups whose location changed in the last `window` seconds
+
+    Reads of these groups go to the primary database, so a client sees its
+    own writes even if the replica didn't get them yet. Only the writes of
+    the process are known, so a client only sees its own writes when every
+    request is served by the same process.
+    """
+
+    def __init__(self, window=None, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._groups = OrderedDict()
+
+    def _expire(self, now):
+        while self._groups:
+            group_id, written = next(iter(self._groups.items()))
+            if now - written < self.window:
+                break
+            self._groups.popitem(last=False)
+
+    def add_many(self, group_ids):
+        """
+        Remember the groups just written
+
+        :param group_ids: Ids of the groups
+        :type group_ids: iterable
+        """
+        if not self.window:
+            return
+        with self._lock:
+            now = self.clock()
+            for group_id in group_ids:
+                self._groups[group_id] = now
+                self._groups.move_to_end(group_id)
+            self._expire(now)
+
+    def clear(self):
+        """
+        Forget every group
+        """
+        with self._lock:
+            self._groups.clear()
+
+    def __contains__(self, group_id):
+        if not self.window:
+            return False
+        with self._lock:
+            self._expire(self.clock())
+            return group_id in self._groups
+
+
+recent_writes = RecentWrites(
+    settings.REPLICA_READ_YOUR_WRITES if settings.REPLICA_DATABASE else None
+)
+
+
+@contextmanager
+def replica_reads(group_id=None):
+    """
+    Send the reads of the block to the replica, if there is any and the
+    group wasn't written recently
+
+    :param group_id: Id of the group to read
+    :type group_id: int
+
+    :returns: If the reads go to the replica
+    :type returns: bool
+    """
+    replica = bool(settings.REPLICA_DATABASE) and group_id not in recent_writes
+    previous = getattr(_state, 'replica', False)
+    _state.replica = replica
+    try:
+        yield replica
+    finally:
+        _state.replica = previous
+
+
+class ReplicaRouter:
+    """
+    Route the reads of replica_reads blocks to REPLICA_DATABASE
+
+    Everything else, and every write, goes to the primary database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'replica', False):
+            return settings.REPLICA_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.REPLICA_DATABASE:
+            return False
+        return None
+
+
+def copy_database(source, target):
+    """
+    Copy a SQLite database into another one, page by page, while both are
+    in use
+
+    :param source: Connection to the database to copy
+    :type source: django.db.backends.base.base.BaseDatabaseWrapper
+    :param target: Connection to the copy
+    :type target: django.db.backends.base.base.BaseDatabaseWrapper
+    """
+    source.ensure_connection()
+    target.ensure_connection()
+    source.connection.backup(target.connection)
@@ -1,6 +1,17 @@
-from rest_framework.serializers import Serializer, IntegerField
+from rest_framework.serializers import CharField, IntegerField, Serializer
 
 
 class LocationSerializer(Serializer):
     group = IntegerField()
     car = IntegerField()
+
+
+class JourneyResultSerializer(Serializer):
+    group = IntegerField()
+    status = CharField()
+    car = IntegerField(allow_null=True)
+
+
+class DropOffResultSerializer(Serializer):
+    group = IntegerField()
+    status = CharField()
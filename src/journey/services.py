@@ -1,33 +1,100 @@
+from itertools import islice
+import math
+
+from django.conf import settings
 from django.core.exceptions import SuspiciousOperation
+from django.core.management.color import no_style
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
 
-from .models import Car, Group
+from .archive import tombstones
+from .exceptions import (AssignCarException, CarTakenException,
+                         QueueFullException)
+from .journal import journal
+from .locations import DROPPED, IN_CAR, WAITING, locations
+from .matching import MAX_CAPACITY, MIN_CAPACITY, engine
+from .membership import group_filter
+from .metrics import (journeys_finished, journeys_started, matching_attempts,
+                      matching_hits)
+from .models import (ArchivedGroup, ArchivedJourney, Car, Group, Journey,
+                     resize_update, seats_update)
+from .tracing import traced
 
+ASSIGNED = 'assigned'
+DUPLICATED = 'duplicated'
+NOT_FOUND = 'not_found'
 
-def process_cars_payload(data):
+
+def iter_cars_payload(data):
     """
-    Process payload for cars requests
+    Process payload for cars requests one car at a time
 
     :param data: Data with cars ids and seats
-    :type data: dict
+    :type data: iterable
 
-    :returns: List of cars
-    :type returns: [journey.Car]
+    :returns: Generator of cars
+    :type returns: generator
     """
-    cars = []
     for car in data:
         if (
+            isinstance(car, dict) and
             'id' in car and
             'seats' in car and
             isinstance(car['id'], int) and
             isinstance(car['seats'], int)
         ):
-            cars.append(Car(id=car['id'], seats=car['seats']))
             check_capacity(int(car['seats']))
+            yield Car(id=car['id'], seats=car['seats'],
+                      free_seats=car['seats'])
         else:
             raise SuspiciousOperation('Incorrect payload')
-    return cars
 
 
+@traced
+def process_cars_payload(data):
+    """
+    Process payload for cars requests
+
+    :param data: Data with cars ids and seats
+    :type data: dict
+
+    :returns: List of cars
+    :type returns: [journey.Car]
+    """
+    return list(iter_cars_payload(data))
+
+
+@traced
+def process_fleet_payload(data):
+    """
+    Process payload for fleet delta requests
+
+    :param data: Data with cars to add and resize and car ids to retire
+    :type data: dict
+
+    :returns: Cars to add, cars to resize and ids of cars to retire
+    :type returns: ([journey.Car], [journey.Car], [int])
+    """
+    if not (
+        isinstance(data, dict) and
+        set(data) <= {'add', 'resize', 'retire'} and
+        all(isinstance(value, list) for value in data.values())
+    ):
+        raise SuspiciousOperation('Incorrect payload')
+
+    retired = data.get('retire', [])
+    if not all(isinstance(car_id, int) for car_id in retired):
+        raise SuspiciousOperation('Incorrect payload')
+
+    return (
+        process_cars_payload(data.get('add', [])),
+        process_cars_payload(data.get('resize', [])),
+        retired
+    )
+
+
+@traced
 def process_journey_payload(data):
     """
     Process payload for journey requests
@@ -49,6 +116,47 @@ def process_journey_payload(data):
     raise SuspiciousOperation('Incorrect payload')
 
 
+@traced
+def process_journeys_payload(data):
+    """
+    Process payload for bulk journey requests
+
+    :param data: List of data with a journey id and people
+    :type data: list
+
+    :returns: List of groups
+    :type returns: [journey.Group]
+    """
+    if not isinstance(data, list):
+        raise SuspiciousOperation('Incorrect payload')
+
+    groups = []
+    for journey in data:
+        if not isinstance(journey, dict):
+            raise SuspiciousOperation('Incorrect payload')
+        groups.append(process_journey_payload(journey))
+    return groups
+
+
+@traced
+def process_dropoffs_payload(data):
+    """
+    Process payload for bulk drop off requests
+
+    :param data: List of group ids
+    :type data: list
+
+    :returns: List of group ids
+    :type returns: [int]
+    """
+    if not (
+        isinstance(data, list) and
+        all(isinstance(group_id, int) for group_id in data)
+    ):
+        raise SuspiciousOperation('Incorrect payload')
+    return data
+
+
 def check_capacity(value):
     """
     Check capacity of cars and groups
@@ -56,45 +164,572 @@ def check_capacity(value):
     :param data: Value of capacity
     :type data: int
     """
-    if value > 6 or value < 4:
+    if value > MAX_CAPACITY or value < MIN_CAPACITY:
         raise SuspiciousOperation("Incorrect capacity")
 
 
+def retry_after(stats, places=1):
+    """
+    Seconds until enough groups of a full queue are expected to leave it
+
+    By Little's law groups leave the queue at waiting / mean wait groups per
+    second, so a place is free every mean wait / waiting seconds.
+
+    :param stats: Counters of the queue, from MatchingEngine.wait_stats
+    :type stats: dict
+    :param places: Places of the queue that have to be free
+    :type places: int
+
+    :returns: Seconds, at least 1
+    :type returns: int
+    """
+    if stats['count'] and stats['waiting']:
+        seconds = stats['total'] / stats['count'] / stats['waiting']
+    else:
+        seconds = settings.ADMISSION_RETRY_AFTER
+    return max(1, int(math.ceil(seconds * places)))
+
+
+def check_admission(people, count=1):
+    """
+    Turn away groups that would wait in a full or stalled queue
+
+    A queue with waiting groups means that no car has room for one more
+    group of its size, so only groups that would wait are turned away, and
+    the groups already waiting keep their waiting times while demand
+    outpaces the fleet.
+
+    :param people: People of the groups
+    :type people: int
+    :param count: Number of groups
+    :type count: int
+    """
+    limit = settings.ADMISSION_WAITING_LIMIT
+    if isinstance(limit, dict):
+        limit = limit.get(people)
+    max_wait = settings.ADMISSION_MAX_WAIT
+    if limit is None and max_wait is None:
+        return
+
+    stats = engine.wait_stats()[people]
+    if not stats['waiting']:
+        return
+    if limit is not None and stats['waiting'] + count > limit:
+        raise QueueFullException(
+            retry_after(stats, stats['waiting'] + count - limit)
+        )
+    if max_wait is not None and stats['oldest'] > max_wait:
+        raise QueueFullException(retry_after(stats))
+
+
+@traced
 def clean_system():
     """
     Restart system to the initial status
+
+    Tables are emptied with a single statement each, without loading the
+    rows to delete them one by one. The state kept in the process is only
+    reset once the transaction commits, so a failed restart keeps it; the
+    engine is reset right away, and invalidated by the callers on failure.
+    """
+    tables = [model._meta.db_table for model in
+              (Journey, Group, Car, ArchivedJourney, ArchivedGroup)]
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sql_flush(no_style(), tables, ()):
+            cursor.execute(sql)
+    engine.reset()
+    transaction.on_commit(locations.clear)
+    transaction.on_commit(group_filter.reset)
+    transaction.on_commit(tombstones.reset)
+    journal.record('reset')
+
+
+@traced
+def load_cars(cars, batch_size=None):
+    """
+    Restart the system with a new fleet of cars
+
+    Cars are inserted in batches as they are read, so the fleet is never
+    fully loaded in memory. If any car is wrong the previous fleet is kept.
+
+    :param cars: Cars of the new fleet
+    :type cars: iterable
+    :param batch_size: Cars inserted at once
+    :type batch_size: int
+    """
+    batch_size = batch_size or settings.CARS_BATCH_SIZE
+    cars = iter(cars)
+    try:
+        with transaction.atomic():
+            clean_system()
+            batch = list(islice(cars, batch_size))
+            while batch:
+                Car.objects.bulk_create(batch)
+                for car in batch:
+                    engine.add_car(car.id, car.free_seats)
+                journal.record('cars_added', cars=[
+                    [car.id, car.free_seats] for car in batch
+                ])
+                batch = list(islice(cars, batch_size))
+    except Exception:
+        engine.invalidate()
+        raise
+
+
+def refresh_car(car_id):
+    """
+    Put a car back in the matching engine with the free seats it has in the
+    database, after another worker changed them
+
+    :param car_id: Id of the car
+    :type car_id: int
+    """
+    free_seats = Car.objects.filter(
+        id=car_id,
+        is_available=True
+    ).values_list('free_seats', flat=True).first()
+    if free_seats is None:
+        engine.remove_car(car_id)
+    else:
+        engine.add_car(car_id, free_seats)
+
+
+def pop_car(people):
+    """
+    Take the car with fewest free seats that fits a group from the matching
+    engine, or from the database when the engine has none and
+    MATCHING_DATABASE_FALLBACK is set
+
+    :param people: People of the group
+    :type people: int
+
+    :returns: (id, free seats) of the car, None if there isn't any
+    :type returns: (int, int)
+    """
+    match = engine.pop_car(people)
+    if match or not settings.MATCHING_DATABASE_FALLBACK:
+        return match
+    return Car.objects.filter(
+        is_available=True,
+        free_seats__gte=people
+    ).order_by('free_seats', 'created').values_list('id', 'free_seats').first()
+
+
+def pop_group(car):
+    """
+    Take the waiting group that fits in a car from the matching engine, or
+    from the database when the engine has none and
+    MATCHING_DATABASE_FALLBACK is set
+
+    :param car: Car with free seats
+    :type car: journey.Car
+
+    :returns: (id, people) of the group, None if there isn't any
+    :type returns: (int, int)
+    """
+    match = engine.pop_group(car.free_seats)
+    if match or not settings.MATCHING_DATABASE_FALLBACK:
+        return match
+    group = car.get_available_group()
+    if group is None:
+        return None
+    engine.remove_group(group.id)
+    return group.id, group.people
+
+
+def take_seats(cars):
+    """
+    Write the seats taken from cars whose rows the current transaction
+    already updated, so no other worker can have taken them
+
+    :param cars: Seats taken by car id
+    :type cars: dict
+    """
+    by_seats = {}
+    for car_id, seats in cars.items():
+        by_seats.setdefault(seats, []).append(car_id)
+    for seats, car_ids in by_seats.items():
+        updated = Car.objects.filter(
+            id__in=car_ids,
+            free_seats__gte=seats
+        ).update(**seats_update(-seats))
+        if updated != len(car_ids):
+            raise CarTakenException('Seats taken by another worker')
+
+
+def release_seats(cars):
     """
-    Car.objects.all().delete()
-    Group.objects.all().delete()
+    Write the seats released in cars, relative to the seats they have in the
+    database
 
+    :param cars: Seats released by car id
+    :type cars: dict
+    """
+    by_seats = {}
+    for car_id, seats in cars.items():
+        by_seats.setdefault(seats, []).append(car_id)
+    for seats, car_ids in by_seats.items():
+        Car.objects.filter(id__in=car_ids).update(**seats_update(seats))
 
+
+@traced
 def request_available_car(group):
     """
     Detect and, if is possible, assign a car for a group
 
+    The group waits in the matching engine if there isn't any car with
+    enough free seats. A car that still has room for another group after the
+    assignment stays in the engine with its remaining seats. If another
+    worker took the seats of the car first, the next car is tried, and if
+    it gave the group a car first nothing is assigned. If the assignment
+    fails the engine is loaded again from the database, so the car taken
+    from it is not lost.
+
     :param group: Group that wants a car
     :type group: journey.Group
 
     :returns: Car assigned if is possible, None if isn't
     :type returns: journey.Car
     """
-    car = group.get_available_car()
-    if car:
-        group.assign_car(car)
+    matching_attempts.inc(side='group')
+    try:
+        while True:
+            match = pop_car(group.people)
+            if not match:
+                enqueued = engine.add_group(group.id, group.people)
+                journal.record('group_enqueued', group=group.id,
+                               people=group.people, enqueued=enqueued)
+                locations.set(group.id, WAITING)
+                return None
+
+            car_id, free_seats = match
+            car = Car(id=car_id, free_seats=free_seats)
+            try:
+                group.assign_car(car)
+                break
+            except CarTakenException:
+                refresh_car(car_id)
+            except AssignCarException:
+                # Another worker gave the group a car from the database
+                refresh_car(car_id)
+                return None
+    except Exception:
+        engine.invalidate()
+        raise
+
+    engine.remove_group(group.id)
+    engine.add_car(car.id, car.free_seats)
+    journal.record('assigned', group=group.id, car=car.id,
+                   seats=car.free_seats)
+    matching_hits.inc(side='group')
+    journeys_started.inc_on_commit()
     return car
 
 
-def get_available_group(car):
+@traced
+def request_available_cars(groups):
     """
-    Detect and, if is possible, assign a group to a car
+    Register many groups and assign free cars to as many as possible
 
-    :param car: Available car that wants a group
-    :type car: journey.Car
+    Groups with an id already registered, in the database, in the archive or
+    earlier in the same list, are not registered again. Everything is
+    written in a single transaction. The whole list is turned away if its
+    new groups would wait in a full or stalled queue.
 
-    :returns: Group assigned if is possible, None if isn't
-    :type returns: journey.Group
+    :param groups: Groups that want a car
+    :type groups: [journey.Group]
+
+    :returns: Result for every group with its id, status and car id
+    :type returns: [dict]
     """
-    group = car.get_available_group()
-    if group:
-        group.assign_car(car)
-    return group
+    ids = [group.id for group in groups]
+    seen = set(Group.objects.filter(id__in=ids).values_list('id', flat=True))
+    if not tombstones.archive_empty():
+        seen.update(ArchivedGroup.objects.filter(
+            group_id__in=ids
+        ).values_list('group_id', flat=True))
+
+    counts = {}
+    for group in groups:
+        if group.id not in seen:
+            counts.setdefault(group.people, set()).add(group.id)
+    for people, group_ids in sorted(counts.items()):
+        check_admission(people, len(group_ids))
+
+    results = []
+    new_groups = []
+    journeys = []
+    try:
+        with transaction.atomic():
+            for group in groups:
+                if group.id in seen:
+                    results.append({'group': group.id, 'status': DUPLICATED,
+                                    'car': None})
+                    continue
+                seen.add(group.id)
+                new_groups.append(group)
+                matching_attempts.inc(side='group')
+
+                car = None
+                while car is None:
+                    match = pop_car(group.people)
+                    if not match:
+                        break
+                    car_id, free_seats = match
+                    car = Car(id=car_id, free_seats=free_seats)
+                    if not car.claim_seats(group.people):
+                        refresh_car(car_id)
+                        car = None
+
+                if car is None:
+                    enqueued = engine.add_group(group.id, group.people)
+                    journal.record('group_enqueued', group=group.id,
+                                   people=group.people, enqueued=enqueued)
+                    results.append({'group': group.id, 'status': WAITING,
+                                    'car': None})
+                    continue
+
+                engine.add_car(car.id, car.free_seats)
+                group.is_available = False
+                journeys.append(Journey(group=group, car=car))
+                journal.record('assigned', group=group.id, car=car.id,
+                               seats=car.free_seats)
+                results.append({'group': group.id, 'status': ASSIGNED,
+                                'car': car.id})
+
+            try:
+                Group.objects.bulk_create(new_groups)
+            except IntegrityError:
+                raise SuspiciousOperation("Incorrect field in payload")
+            group_filter.add_many(group.id for group in new_groups)
+            Journey.objects.bulk_create(journeys)
+            matching_hits.inc(len(journeys), side='group')
+            journeys_started.inc_on_commit(len(journeys))
+            locations.set_many({
+                result['group']: (
+                    IN_CAR if result['car'] else WAITING, result['car']
+                )
+                for result in results if result['status'] != DUPLICATED
+            })
+    except Exception:
+        engine.invalidate()
+        raise
+    return results
+
+
+@traced
+def drop_off(group):
+    """
+    Drop off a group and give the seats it released, if any, to waiting groups
+
+    :param group: Group to drop off
+    :type group: journey.Group
+
+    :returns: Groups assigned to the released seats
+    :type returns: [journey.Group]
+    """
+    try:
+        with transaction.atomic():
+            journey = group.finish_journey()
+            engine.remove_group(group.id)
+
+            if journey is None:
+                journal.record('dropoff', group=group.id, car=None,
+                               seats=None)
+                return []
+
+            car = journey.car
+            engine.remove_car(car.id)
+            journal.record('dropoff', group=group.id, car=car.id,
+                           seats=car.free_seats)
+            journeys_finished.inc_on_commit()
+            return get_available_groups([car])
+    except Exception:
+        engine.invalidate()
+        raise
+
+
+@traced
+def get_available_groups(cars):
+    """
+    Assign waiting groups to many released cars in a single matching round
+
+    Cars with fewer free seats are matched first, so bigger cars are kept for
+    bigger groups. Every car takes groups while it has room for them, and
+    cars with room left go back to the pool of free cars.
+
+    The cars must have been written in the current transaction, which keeps
+    their seats from other workers. Every group is claimed with a
+    conditional update, and groups that another worker assigned or dropped
+    off first are skipped.
+
+    :param cars: Cars with released seats that want groups
+    :type cars: [journey.Car]
+
+    :returns: Groups assigned
+    :type returns: [journey.Group]
+    """
+    journeys = []
+    taken = {}
+    for car in sorted(cars, key=lambda car: car.free_seats):
+        matching_attempts.inc(side='car')
+        while car.is_available:
+            match = pop_group(car)
+            if not match:
+                break
+
+            group_id, people = match
+            group = Group(id=group_id, people=people)
+            if not group.claim():
+                continue
+
+            journeys.append(Journey(group=group, car=car))
+            car.take_seats(people)
+            taken[car.id] = taken.get(car.id, 0) + people
+            journal.record('assigned', group=group.id, car=car.id,
+                           seats=car.free_seats)
+        engine.add_car(car.id, car.free_seats)
+
+    Journey.objects.bulk_create(journeys)
+    take_seats(taken)
+    matching_hits.inc(len(journeys), side='car')
+    journeys_started.inc_on_commit(len(journeys))
+    locations.set_many({
+        journey.group_id: (IN_CAR, journey.car_id) for journey in journeys
+    })
+    return [journey.group for journey in journeys]
+
+
+@traced
+def drop_offs(group_ids):
+    """
+    Drop off many groups and give the released cars to waiting groups
+
+    :param group_ids: Ids of the groups to drop off
+    :type group_ids: [int]
+
+    :returns: Result for every group id with its status
+    :type returns: [dict]
+    """
+    candidates = [group_id for group_id in group_ids
+                  if group_id in group_filter]
+    try:
+        with transaction.atomic():
+            # Marking the groups first takes the write lock, so the groups,
+            # journeys and cars read after it can't change meanwhile
+            Group.objects.filter(
+                id__in=candidates
+            ).update(is_available=False)
+            groups = Group.objects.filter(
+                id__in=candidates
+            ).select_related('journey__car')
+            found = {group.id for group in groups}
+            journeys = []
+            cars = {}
+            freed = {}
+            released = {}
+            for group in groups:
+                if group.is_in_car():
+                    journey = group.journey
+                    car = cars.setdefault(journey.car_id, journey.car)
+                    car.release_seats(group.people)
+                    freed[car.id] = freed.get(car.id, 0) + group.people
+                    journeys.append(journey)
+                    released[group.id] = car
+
+            finished = timezone.now()
+            Journey.objects.filter(
+                id__in=[journey.id for journey in journeys],
+                finished__isnull=True
+            ).update(finished=finished)
+            for journey in journeys:
+                journey.finished = finished
+            release_seats(freed)
+            journeys_finished.inc_on_commit(len(journeys))
+
+            for group_id in found:
+                engine.remove_group(group_id)
+                car = released.get(group_id)
+                journal.record('dropoff', group=group_id,
+                               car=car and car.id,
+                               seats=car and car.free_seats)
+            locations.set_many({
+                group.id: group.location() for group in groups
+            })
+            get_available_groups(cars.values())
+    except Exception:
+        engine.invalidate()
+        raise
+
+    if any(group_id not in found and group_id not in tombstones
+           for group_id in group_ids):
+        # They may have been archived by another process meanwhile
+        tombstones.refresh()
+    return [
+        {'group': group_id,
+         'status': (DROPPED if group_id in found or group_id in tombstones
+                    else NOT_FOUND)}
+        for group_id in group_ids
+    ]
+
+
+@traced
+def update_fleet(added, resized, retired):
+    """
+    Add, resize and retire cars keeping journeys and waiting groups
+
+    Cars in a journey can't be retired nor resized below the people in them.
+    Both are checked by conditional updates that write the seats relative
+    to the current row, so journeys started meanwhile are never lost. New
+    and resized cars are matched against the waiting groups right away with
+    their free seats.
+
+    :param added: New cars
+    :type added: [journey.Car]
+    :param resized: Cars with their new seats
+    :type resized: [journey.Car]
+    :param retired: Ids of the cars to retire
+    :type retired: [int]
+
+    :returns: Groups assigned to the new and resized cars
+    :type returns: [journey.Group]
+    """
+    ids = retired + [car.id for car in resized]
+    if len(set(ids)) != len(ids):
+        raise SuspiciousOperation('Incorrect car')
+    try:
+        with transaction.atomic():
+            # Retiring first takes the write lock, so the cars read after it
+            # can't change meanwhile, and only cars without groups match
+            retiring = Car.objects.filter(
+                id__in=retired,
+                free_seats=F('seats')
+            ).update(is_available=False, free_seats=0)
+            if retiring != len(retired):
+                raise SuspiciousOperation('Incorrect car or car in a journey')
+            for car in resized:
+                updated = Car.objects.filter(
+                    id=car.id,
+                    free_seats__gte=F('seats') - car.seats
+                ).update(**resize_update(car.seats))
+                if not updated:
+                    raise SuspiciousOperation(
+                        'Incorrect car or car in a journey'
+                    )
+            resized = list(Car.objects.filter(
+                id__in=[car.id for car in resized]
+            ))
+            released = list(added) + resized
+
+            for car_id in ids:
+                engine.remove_car(car_id)
+                journal.record('car_removed', car=car_id)
+            Journey.objects.filter(car__in=retired).update(car=None)
+            Car.objects.filter(id__in=retired).delete()
+            Car.objects.bulk_create(added)
+            journal.record('cars_added',
+                           cars=[[car.id, car.free_seats] for car in released])
+            return get_available_groups(released)
+    except Exception:
+        engine.invalidate()
+        raise
@@ -0,0 +1,299 @@
+from contextlib import ExitStack
+from datetime import datetime, timezone as dt_timezone
+import heapq
+import json
+import random
+import time
+
+from django.db import connections
+
+from .journal import journal
+from .matching import CAPACITIES, engine
+from .middleware import QueryCounter
+from .models import Car, Group
+from .services import drop_off, load_cars, request_available_car
+
+ARRIVAL = 'journey'
+DROPOFF = 'dropoff'
+PERCENTILES = (50, 90, 95, 99)
+
+
+class VirtualClock:
+    """
+    Clock of a simulation, it only moves when the simulation says so
+    """
+
+    def __init__(self, start=0.0):
+        self.start = start
+        self.current = start
+
+    def time(self):
+        return self.current
+
+    def now(self):
+        return datetime.fromtimestamp(self.current, dt_timezone.utc)
+
+    def advance(self, to):
+        self.current = max(self.current, to)
+
+
+def percentile(values, rank):
+    """
+    Nearest rank percentile of sorted values
+
+    :param values: Sorted values
+    :type values: list
+    :param rank: Percentile, from 0 to 100
+    :type rank: float
+
+    :returns: Value of the percentile, 0 without values
+    :type returns: float
+    """
+    if not values:
+        return 0.0
+    index = max(int(round(rank / 100 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summary(values, scale=1):
+    """
+    Mean, percentiles and max of some values
+
+    :param values: Values to summarize
+    :type values: list
+    :param scale: Factor to apply to the values
+    :type scale: float
+
+    :returns: Summary with count, mean, p50... and max
+    :type returns: dict
+    """
+    values = sorted(value * scale for value in values)
+    result = {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else 0.0,
+    }
+    for rank in PERCENTILES:
+        result['p{}'.format(rank)] = percentile(values, rank)
+    result['max'] = values[-1] if values else 0.0
+    return result
+
+
+def synthetic_fleet(cars, seed=None):
+    """
+    Cars with random seats
+
+    :param cars: Number of cars
+    :type cars: int
+    :param seed: Seed of the random generator
+    :type seed: int
+
+    :returns: (id, seats) of every car
+    :type returns: [(int, int)]
+    """
+    rng = random.Random(seed)
+    return [(car_id, rng.choice(CAPACITIES)) for car_id in range(1, cars + 1)]
+
+
+def synthetic_events(groups, arrival_rate, seed=None):
+    """
+    Arrivals of groups of random size with exponential inter-arrival times
+
+    :param groups: Number of groups
+    :type groups: int
+    :param arrival_rate: Groups that arrive per second
+    :type arrival_rate: float
+    :param seed: Seed of the random generator
+    :type seed: int
+
+    :returns: Generator of (time, event, group id, people)
+    :type returns: generator
+    """
+    rng = random.Random(seed)
+    now = 0.0
+    for group_id in range(1, groups + 1):
+        now += rng.expovariate(arrival_rate)
+        yield now, ARRIVAL, group_id, rng.choice(CAPACITIES)
+
+
+def read_events(stream):
+    """
+    Read recorded events, one JSON object per line with the keys time,
+    event (journey or dropoff), id and, for journeys, people
+
+    :param stream: Text stream with the events
+    :type stream: io.TextIOBase
+
+    :returns: Generator of (time, event, group id, people)
+    :type returns: generator
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        event = json.loads(line)
+        if event['event'] not in (ARRIVAL, DROPOFF):
+            raise ValueError('Unknown event {}'.format(event['event']))
+        yield (float(event['time']), event['event'], event['id'],
+               event.get('people'))
+
+
+class Simulation:
+    """
+    Discrete-event simulation of the matching services
+
+    Arrivals and dropoffs are applied in time order through journey.services
+    against the configured database, while the matching engine runs on a
+    virtual clock, so a day of traffic is replayed as fast as the services
+    can go. Groups that get a car leave after `trip_time` seconds, if given,
+    besides the dropoffs of the events.
+
+    The journal is disabled during the run, and the database and the
+    matching engine are left with the state of the simulation: run it on a
+    scratch database.
+    """
+
+    def __init__(self, cars, events, trip_time=None, policy=None):
+        """
+        :param cars: (id, seats) of every car
+        :type cars: [(int, int)]
+        :param events: (time, event, group id, people) in time order
+        :type events: iterable
+        :param trip_time: Function that returns the seconds of the trip of
+            a group, given its id and people
+        :type trip_time: callable
+        :param policy: Queue policy of the engine, the current one if None
+        :type policy: journey.matching.QueuePolicy
+        """
+        self.cars = list(cars)
+        self.events = events
+        self.trip_time = trip_time
+        self.policy = policy
+        self.clock = VirtualClock()
+        self._queue = []
+        self._seq = 0
+        self._arrivals = {}
+        self._waits = []
+        self._waits_by_size = {capacity: [] for capacity in CAPACITIES}
+        self._costs = {ARRIVAL: [], DROPOFF: []}
+        self._queries = {ARRIVAL: 0, DROPOFF: 0}
+        self._occupied = 0
+        self._seat_time = 0.0
+        self._last = 0.0
+
+    def _push(self, when, event, group_id, people=None):
+        self._seq += 1
+        heapq.heappush(self._queue, (when, self._seq, event, group_id, people))
+
+    def _board(self, group_id, people):
+        now = self.clock.time()
+        wait = now - self._arrivals[group_id]
+        self._waits.append(wait)
+        self._waits_by_size[people].append(wait)
+        self._occupied += people
+        if self.trip_time:
+            self._push(now + self.trip_time(group_id, people), DROPOFF,
+                       group_id)
+
+    def _arrive(self, group_id, people):
+        group = Group(id=group_id, people=people, created=self.clock.now())
+        group.save(force_insert=True)
+        self._arrivals[group_id] = self.clock.time()
+        if request_available_car(group):
+            self._board(group_id, people)
+
+    def _drop_off(self, group_id):
+        group = Group.objects.select_related(
+            'journey__car'
+        ).filter(id=group_id).first()
+        if group is None or not (group.is_available or group.is_in_car()):
+            return
+        if group.is_in_car():
+            self._occupied -= group.people
+        for assigned in drop_off(group):
+            self._board(assigned.id, assigned.people)
+
+    def _apply(self, event, group_id, people):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            if event == ARRIVAL:
+                self._arrive(group_id, people)
+            else:
+                self._drop_off(group_id)
+        self._costs[event].append(time.perf_counter() - start)
+        self._queries[event] += counter.count
+
+    def run(self):
+        """
+        Run the simulation until there aren't more events
+
+        :returns: Report of the simulation
+        :type returns: dict
+        """
+        clock, policy = engine.clock, engine.policy
+        directory = journal.directory
+        engine.clock = self.clock.time
+        engine.policy = self.policy or policy
+        journal.directory = None
+        started = time.perf_counter()
+        try:
+            load_cars(Car(id=car_id, seats=seats, free_seats=seats)
+                      for car_id, seats in self.cars)
+            engine.reset_wait_stats()
+            for when, event, group_id, people in self.events:
+                self._push(when, event, group_id, people)
+            if self._queue:
+                self._last = self._queue[0][0]
+                self.clock = VirtualClock(self._last)
+                engine.clock = self.clock.time
+            while self._queue:
+                when, _, event, group_id, people = heapq.heappop(self._queue)
+                self._seat_time += self._occupied * (when - self._last)
+                self._last = when
+                self.clock.advance(when)
+                self._apply(event, group_id, people)
+            return self.report(time.perf_counter() - started)
+        finally:
+            engine.clock, engine.policy = clock, policy
+            journal.directory = directory
+
+    def report(self, wall_time):
+        """
+        Utilization, waiting times and cost of the simulation
+
+        :param wall_time: Seconds the simulation took
+        :type wall_time: float
+
+        :returns: Report of the simulation
+        :type returns: dict
+        """
+        duration = self.clock.time() - self.clock.start
+        seats = sum(seats for _, seats in self.cars)
+        events = sum(len(costs) for costs in self._costs.values())
+        return {
+            'events': events,
+            'simulated_time': duration,
+            'wall_time': wall_time,
+            'speedup': duration / wall_time if wall_time else 0.0,
+            'groups': len(self._arrivals),
+            'served': len(self._waits),
+            'waiting': engine.waiting_count(),
+            'utilization': (
+                self._seat_time / (seats * duration)
+                if seats and duration else 0.0
+            ),
+            'wait': summary(self._waits),
+            'wait_by_size': {
+                people: summary(waits)
+                for people, waits in self._waits_by_size.items()
+            },
+            'cost': {
+                event: dict(
+                    summary(costs, scale=1000),
+                    queries=(self._queries[event] / len(costs)
+                             if costs else 0.0)
+                )
+                for event, costs in self._costs.items()
+            },
+        }
@@ -0,0 +1,82 @@
+import codecs
+import json
+
+WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """
+    Yield the items of a JSON array read incrementally from a stream
+
+    Only the item being decoded is kept in memory, so arrays of any size
+    are parsed in constant memory.
+
+    :param stream: Binary file-like object with a JSON array
+    :type stream: file
+    :param chunk_size: Bytes read from the stream at once
+    :type chunk_size: int
+
+    :returns: Generator of the items of the array
+    :type returns: generator
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    eof = stream is None
+    expect = '['
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + utf8.decode(chunk, final=eof)
+        position = 0
+
+    while True:
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            fill()
+
+        if position == len(buffer):
+            if expect in ('[', 'end'):
+                return
+            raise ValueError('Unexpected end of JSON array')
+
+        char = buffer[position]
+        if expect == '[':
+            if char != '[':
+                raise ValueError('Expecting a JSON array')
+            position += 1
+            expect = 'first'
+        elif expect in ('first', 'item'):
+            if expect == 'first' and char == ']':
+                position += 1
+                expect = 'end'
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if end == len(buffer) and not eof:
+                fill()
+                continue
+            position = end
+            expect = 'separator'
+            yield item
+        elif expect == 'separator':
+            position += 1
+            if char == ']':
+                expect = 'end'
+            elif char == ',':
+                expect = 'item'
+            else:
+                raise ValueError('Expecting , or ] in JSON array')
+        else:
+            raise ValueError('Extra data after JSON array')
@@ -0,0 +1,46 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+
+class ConcurrentTrafficBenchmark(SimpleTestCase):
+    """
+    Wall-clock benchmarks of the production profile, out of the default
+    suite, run them with --pattern="benchmarks.py"
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_concurrent_traffic(self):
+        """Concurrent writers get no "database is locked" errors"""
+        output = os.path.join(self.directory, 'benchmark.json')
+        process = subprocess.run(
+            [sys.executable, 'manage.py', 'benchmark',
+             '--settings=car_pooling.settings.production',
+             '--fleet=50', '--requests=1000', '--concurrency=8',
+             '--mix=journey=45,dropoff=35,locate=20', '--seed=1',
+             '--output={}'.format(output)],
+            cwd=os.path.dirname(settings.BASE_DIR),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        self.assertEqual(process.returncode, 0, process.stderr)
+        with open(output) as results:
+            endpoints = json.load(results)['endpoints']
+        self.assertEqual(
+            sum(result['count'] for result in endpoints.values()), 1000
+        )
+        for result in endpoints.values():
+            self.assertEqual(result['errors'], 0, process.stderr)
+            self.assertNotIn('500', result['statuses'], process.stderr)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
@@ -0,0 +1,58 @@
+from django.db.utils import ConnectionHandler
+
+from ..archive import tombstones
+from ..locations import locations
+from ..matching import engine
+from ..membership import group_filter
+from ..replicas import recent_writes
+
+QUERY_BUDGETS = {
+    'get_status': 0,
+    'put_cars': 7,
+    'post_journey': 5,
+    'post_dropoff': 9,
+    'post_locate': 1,
+}
+
+
+class QueryBudgetMixin:
+    """
+    Assertions about the SQL queries reported by QueryCountMiddleware
+    """
+
+    def assertWithinQueryBudget(self, url_name, response):
+        """The response didn't run more queries than its endpoint budget"""
+        queries = int(response['X-DB-Queries'])
+        self.assertLessEqual(
+            queries,
+            QUERY_BUDGETS[url_name],
+            '{} ran {} queries, budget is {}'.format(
+                url_name, queries, QUERY_BUDGETS[url_name]
+            )
+        )
+
+
+def reset_state():
+    """
+    Forget the state kept in the process between requests
+    """
+    engine.invalidate()
+    engine.reset_wait_stats()
+    locations.clear()
+    group_filter.reset()
+    tombstones.reset()
+    recent_writes.clear()
+
+
+def sqlite_connection(name, options):
+    """
+    New connection to a SQLite file with the backend of the project, apart
+    from the connections of the tests
+    """
+    return ConnectionHandler({
+        'default': {
+            'ENGINE': 'car_pooling.backends.sqlite3',
+            'NAME': name,
+            'OPTIONS': options,
+        }
+    })['default']
@@ -1,14 +1,74 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
 from model_mommy import mommy
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 
-from django.test import TransactionTestCase
+from django.conf import settings
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import (LiveServerTestCase, SimpleTestCase,
+                         TransactionTestCase, override_settings)
 from django.urls import reverse
 
-from ..models import Car, Group, Journey
+from car_pooling.settings import production
+
+from ..archive import tombstones
+from ..batching import group_commit
+from ..benchmark import Benchmark, parse_mix
+from ..locations import locations
+from ..matching import engine
+from ..metrics import (journeys_finished, journeys_started, matching_attempts,
+                       matching_hits, request_duration, requests_total)
+from ..models import ArchivedGroup, Car, Group, Journey
+from ..notifications import notifier
+from ..profiling import profiler
+from ..tracing import tracer
+from .helpers import QueryBudgetMixin, reset_state, sqlite_connection
+
 
+class GetMetricsTest(TransactionTestCase):
+    """ Test module for GET metrics API """
 
-class GetStatusTest(APITestCase):
+    def test_get_metrics(self):
+        """Get metrics kept up to date without counting rows"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 2, 'people': 6}, content_type='application/json')
+        self.client.get(reverse('get_metrics'))
+        self.client.post("{}?id={}".format(reverse('post_locate'), 3))
+
+        response = self.client.get(reverse('get_metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertEqual(response['X-DB-Queries'], '0')
+        lines = response.content.decode().splitlines()
+        for line in (
+                'http_requests_total{endpoint="post_journey",status="200"} 2',
+                'http_requests_total{endpoint="post_locate",status="404"} 1',
+                'http_request_duration_seconds_count{endpoint="post_journey"} 2',
+                'journeys_started_total 1',
+                'matching_waiting_groups{people="6"} 1',
+                'matching_free_cars{seats="4"} 0',
+                'matching_hits_total{side="group"} 1'):
+            self.assertIn(line, lines)
+
+    def setUp(self):
+        for metric in (request_duration, requests_total, matching_attempts,
+                       matching_hits, journeys_started, journeys_finished):
+            metric.reset()
+
+    def tearDown(self):
+        reset_state()
+
+
+class GetStatusTest(QueryBudgetMixin, APITestCase):
     """ Test module for GET status API """
 
     def setUp(self):
@@ -18,9 +78,10 @@ class GetStatusTest(APITestCase):
         """Get status valid"""
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('get_status', response)
 
 
-class PutCarsTest(TransactionTestCase):
+class PutCarsTest(QueryBudgetMixin, TransactionTestCase):
     """ Test module for PUT cars API """
     client = APIClient
 
@@ -41,6 +102,7 @@ class PutCarsTest(TransactionTestCase):
         ]
         response = self.client.put(self.url, data=payload, format='json', content_type='application/json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('put_cars', response)
 
     def test_put_cars_duplicate_id_invalid(self):
         """Put cars with same id"""
@@ -94,6 +156,22 @@ class PutCarsTest(TransactionTestCase):
         response = self.client.put(self.url, data=payload, format='json', content_type='application/json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_put_cars_invalid_keeps_groups(self):
+        """A failed put of cars keeps the groups registered"""
+        self.client.put(self.url, data=[{'id': 1, 'seats': 4}], format='json', content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 2, 'people': 6}, content_type='application/json')
+        payload = [{'id': 1, 'seats': 4}, {'id': 2, 'seats': 9}]
+        response = self.client.put(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post("{}?id={}".format(reverse('post_locate'), 1))
+        self.assertEqual(response.json(), {'group': 1, 'car': 1})
+        response = self.client.post("{}?id={}".format(reverse('post_locate'), 2))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = self.client.post("{}?id={}".format(reverse('post_dropoff'), 2))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_put_cars_less_seats_invalid(self):
         """Put cars with less seats"""
         payload = [
@@ -109,9 +187,100 @@ class PutCarsTest(TransactionTestCase):
     def tearDown(self):
         Car.objects.all().delete()
         Group.objects.all().delete()
+        reset_state()
+
+
+class PatchCarsTest(TransactionTestCase):
+    """ Test module for PATCH cars API """
+    client = APIClient
+
+    def setUp(self):
+        self.url = reverse('put_cars')
+        self.client.put(self.url, data=[{'id': 1, 'seats': 4}, {'id': 2, 'seats': 4}], format='json', content_type='application/json')
+        payload = [{'id': group_id, 'people': people} for group_id, people in ((1, 4), (2, 6), (3, 5))]
+        self.client.post(reverse('post_journeys'), data=payload, format='json', content_type='application/json')
+
+    def test_patch_cars_add_valid(self):
+        """Patch cars adding a car that gets a waiting group"""
+        payload = {
+            'add': [
+                {
+                    'id': 3,
+                    'seats': 6
+                },
+            ]
+        }
+
+        response = self.client.patch(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Group.objects.get(id=3).get_car().id, 3)
+        self.assertTrue(Group.objects.get(id=2).is_available)
+        self.assertEqual(Car.objects.count(), 3)
+
+    def test_patch_cars_resize_valid(self):
+        """Patch cars resizing a free car that gets a waiting group"""
+        payload = {
+            'resize': [
+                {
+                    'id': 2,
+                    'seats': 6
+                },
+            ]
+        }
+
+        response = self.client.patch(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Car.objects.get(id=2).seats, 6)
+        self.assertEqual(Group.objects.get(id=3).get_car().id, 2)
+
+    def test_patch_cars_retire_valid(self):
+        """Patch cars retiring a free car"""
+        response = self.client.patch(self.url, data={'retire': [2]}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(Car.objects.filter(id=2).exists())
+        self.assertEqual(Group.objects.filter(is_available=True).count(), 2)
+
+    def test_patch_cars_retire_finished_journey_valid(self):
+        """Patch cars retiring a car whose group was dropped off"""
+        self.client.post("{}?id=1".format(reverse('post_dropoff')))
+        self.client.patch(self.url, data={'retire': [2]}, format='json', content_type='application/json')
+        response = self.client.patch(self.url, data={'retire': [1]}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post("{}?id=1".format(reverse('post_locate')))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_patch_cars_retire_in_journey_invalid(self):
+        """Patch cars retiring a car in a journey"""
+        response = self.client.patch(self.url, data={'retire': [1]}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(Car.objects.filter(id=1).exists())
+
+    def test_patch_cars_resize_in_journey_invalid(self):
+        """Patch cars resizing a car in a journey below its people"""
+        self.client.patch(self.url, data={'resize': [{'id': 1, 'seats': 6}]}, format='json', content_type='application/json')
+        self.client.post("{}?id=1".format(reverse('post_dropoff')))
+        response = self.client.patch(self.url, data={'resize': [{'id': 1, 'seats': 4}]}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Car.objects.get(id=1).seats, 6)
+
+    def test_patch_cars_unknown_car_invalid(self):
+        """Patch cars retiring a car that doesn't exist"""
+        response = self.client.patch(self.url, data={'retire': [9]}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_cars_duplicate_id_invalid(self):
+        """Patch cars adding a car with an existing id"""
+        response = self.client.patch(self.url, data={'add': [{'id': 1, 'seats': 6}]}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Car.objects.get(id=1).seats, 4)
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
 
 
-class PostJourneyTest(TransactionTestCase):
+class PostJourneyTest(QueryBudgetMixin, TransactionTestCase):
     """ Test module for POST journey API """
     client = APIClient
 
@@ -127,6 +296,37 @@ class PostJourneyTest(TransactionTestCase):
 
         response = self.client.post(self.url, data=payload, format='json', content_type='application/json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('post_journey', response)
+
+    def test_post_journey_group_commit(self):
+        """Post journeys written in batches"""
+        mommy.make('journey.car', seats=4)
+        payload = {
+            'id': 1,
+            'people': 4
+        }
+        group_commit.window = 0.01
+        try:
+            response = self.client.post(self.url, data=payload,
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(self.url, data=payload,
+                                        content_type='application/json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        finally:
+            group_commit.window = None
+        self.assertTrue(Group.objects.get(id=1).is_in_car())
+
+    @override_settings(ADMISSION_WAITING_LIMIT=1)
+    def test_post_journey_queue_full(self):
+        """Post a journey that would wait in a full queue"""
+        response = self.client.post(self.url, data={'id': 1, 'people': 4}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(self.url, data={'id': 2, 'people': 4}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertFalse(Group.objects.filter(id=2).exists())
 
     def test_post_journey_duplicate_id_invalid(self):
         """Post a journey with a duplicate id"""
@@ -182,9 +382,117 @@ class PostJourneyTest(TransactionTestCase):
     def tearDown(self):
         Car.objects.all().delete()
         Group.objects.all().delete()
+        reset_state()
+
 
+class PostJourneysTest(TransactionTestCase):
+    """ Test module for POST journeys API """
+    client = APIClient
+
+    def setUp(self):
+        self.url = reverse('post_journeys')
+        mommy.make('journey.car', id=1, seats=5)
+        engine.invalidate()
 
-class PostDropOffTest(TransactionTestCase):
+    def test_post_journeys_valid(self):
+        """Post many journeys, the first one gets the car"""
+        payload = [
+            {
+                'id': 1,
+                'people': 4
+            },
+            {
+                'id': 2,
+                'people': 5
+            },
+        ]
+
+        response = self.client.post(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), [
+            {'group': 1, 'status': 'assigned', 'car': 1},
+            {'group': 2, 'status': 'waiting', 'car': None},
+        ])
+        self.assertEqual(Group.objects.get(id=1).get_car().id, 1)
+        self.assertFalse(Car.objects.get(id=1).is_available)
+        self.assertTrue(Group.objects.get(id=2).is_available)
+
+    def test_post_journeys_duplicate_id(self):
+        """Post journeys with ids already registered"""
+        mommy.make('journey.group', id=1, people=4)
+        payload = [
+            {
+                'id': 1,
+                'people': 4
+            },
+            {
+                'id': 2,
+                'people': 4
+            },
+            {
+                'id': 2,
+                'people': 6
+            },
+        ]
+
+        response = self.client.post(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result['status'] for result in response.json()],
+            ['duplicated', 'assigned', 'duplicated']
+        )
+        self.assertEqual(Group.objects.get(id=2).people, 4)
+
+    def test_post_journeys_incorrect_payload_invalid(self):
+        """Post journeys with an incorrect group"""
+        payload = [
+            {
+                'id': 1,
+                'people': 4
+            },
+            {
+                'id': 2,
+                'people': 7
+            },
+        ]
+
+        response = self.client.post(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Group.objects.exists())
+
+    def test_post_journeys_not_list_invalid(self):
+        """Post journeys without a list"""
+        payload = {
+            'id': 1,
+            'people': 4
+        }
+
+        response = self.client.post(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(ADMISSION_WAITING_LIMIT=2)
+    def test_post_journeys_queue_full(self):
+        """Post journeys that would wait in a full queue"""
+        payload = [{'id': 1, 'people': 6}]
+        response = self.client.post(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        payload = [{'id': 2, 'people': 6}, {'id': 3, 'people': 6}, {'id': 4, 'people': 6}, {'id': 1, 'people': 6}]
+        response = self.client.post(self.url, data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '10')
+        self.assertFalse(Group.objects.filter(id__in=[2, 3, 4]).exists())
+
+        response = self.client.post(self.url, data=payload[:1], format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
+
+
+class PostDropOffTest(QueryBudgetMixin, TransactionTestCase):
     """ Test module for POST drop off API """
     client = APIClient
 
@@ -197,6 +505,7 @@ class PostDropOffTest(TransactionTestCase):
         self.url = "{}{}".format(self.url, self.group.id)
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('post_dropoff', response)
 
     def test_post_dropoff_incorrect_id_invalid(self):
         """Post drop off with not exists id"""
@@ -204,6 +513,54 @@ class PostDropOffTest(TransactionTestCase):
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_post_dropoff_assigns_waiting_group(self):
+        """Post drop off gives the car to the waiting group"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], format='json', content_type='application/json')
+        for group_id in (10, 11):
+            payload = {'id': group_id, 'people': 4}
+            self.client.post(reverse('post_journey'), data=payload, format='json', content_type='application/json')
+
+        response = self.client.post("{}{}".format(self.url, 10))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('post_dropoff', response)
+        self.assertEqual(Group.objects.get(id=11).get_car().id, 1)
+
+    @override_settings(MATCHING_DATABASE_FALLBACK=True)
+    def test_post_dropoff_assigns_group_of_other_worker(self):
+        """Post drop off gives the car to a group waiting in another worker"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], format='json', content_type='application/json')
+        for group_id in (10, 11):
+            payload = {'id': group_id, 'people': 4}
+            self.client.post(reverse('post_journey'), data=payload, format='json', content_type='application/json')
+        # Registered by another worker, this engine never saw it
+        engine.remove_group(11)
+
+        response = self.client.post("{}{}".format(self.url, 10))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Group.objects.get(id=11).get_car().id, 1)
+
+    @override_settings(MATCHING_DATABASE_FALLBACK=True)
+    def test_post_journey_assigns_car_of_other_worker(self):
+        """Post journey takes a car released by another worker"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], format='json', content_type='application/json')
+        payload = {'id': 10, 'people': 4}
+        self.client.post(reverse('post_journey'), data=payload, format='json', content_type='application/json')
+        self.client.post("{}{}".format(self.url, 10))
+        # Released by another worker, this engine never saw it
+        engine.remove_car(1)
+
+        payload = {'id': 11, 'people': 4}
+        response = self.client.post(reverse('post_journey'), data=payload, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Group.objects.get(id=11).get_car().id, 1)
+
+    def test_post_dropoff_unknown_id_invalid(self):
+        """Post drop off with a never registered id"""
+        self.url = "{}{}".format(self.url, 10 ** 9)
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response['X-DB-Queries'], '0')
+
     def test_post_dropoff_wrong_id_invalid(self):
         """Post drop off with wrong id"""
         self.url = "{}{}".format(self.url, "a")
@@ -213,9 +570,190 @@ class PostDropOffTest(TransactionTestCase):
     def tearDown(self):
         Car.objects.all().delete()
         Group.objects.all().delete()
+        reset_state()
+
+
+class ProfilingTest(TransactionTestCase):
+    """ Test module for the profiling of the API """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        profiler.directory, profiler.rate = self.directory, 0
 
+    def test_profile_journey(self):
+        """Post a journey profiled on demand and print its top functions"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        response = self.client.post(reverse('post_journey'), data={'id': 2, 'people': 4}, content_type='application/json', HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(os.listdir(self.directory), ['post_journey'])
+
+        output = io.StringIO()
+        call_command('profiles', 'post_journey', directory=self.directory,
+                     limit=50, stdout=output)
+        self.assertIn('post_journey: 1 profiles', output.getvalue())
+        self.assertIn('register_journey', output.getvalue())
+
+    def tearDown(self):
+        profiler.directory, profiler.rate = None, settings.PROFILING_RATE
+        shutil.rmtree(self.directory)
+        reset_state()
 
-class PostLocateTest(TransactionTestCase):
+
+class TracingTest(TransactionTestCase):
+    """ Test module for the tracing of the API """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        tracer.path = os.path.join(self.directory, 'spans.json')
+
+    def test_trace_dropoff(self):
+        """Post a dropoff traced down to the models"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        response = self.client.post("{}?id={}".format(reverse('post_dropoff'), 1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        tracer.close()
+        with open(tracer.path) as lines:
+            spans = [json.loads(line) for line in lines]
+        root = spans[-1]
+        self.assertEqual(root['name'], 'post_dropoff')
+        self.assertEqual(root['tags']['http.status_code'], '200')
+        self.assertEqual(root['tags']['db.queries'], response['X-DB-Queries'])
+        trace = {span['id']: span for span in spans
+                 if span['traceId'] == root['traceId']}
+        finish, = [span for span in trace.values()
+                   if span['name'] == 'Journey.finish']
+        names = []
+        span = finish
+        while span is not None:
+            names.append(span['name'])
+            span = trace.get(span.get('parentId'))
+        self.assertEqual(names, ['Journey.finish', 'Group.finish_journey',
+                                 'drop_off', 'drop_off_group',
+                                 'post_dropoff'])
+
+    def tearDown(self):
+        tracer.close()
+        tracer.path = None
+        shutil.rmtree(self.directory)
+        reset_state()
+
+
+class PostDropOffsTest(TransactionTestCase):
+    """ Test module for POST drop offs API """
+    client = APIClient
+
+    def setUp(self):
+        self.url = reverse('post_dropoffs')
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}, {'id': 2, 'seats': 6}], format='json', content_type='application/json')
+        payload = [{'id': group_id, 'people': people} for group_id, people in ((1, 4), (2, 6), (3, 6), (4, 4))]
+        self.client.post(reverse('post_journeys'), data=payload, format='json', content_type='application/json')
+
+    def test_post_dropoffs_valid(self):
+        """Post drop offs and the released cars get the waiting groups"""
+        response = self.client.post(self.url, data=[1, 2, 9], format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), [
+            {'group': 1, 'status': 'dropped'},
+            {'group': 2, 'status': 'dropped'},
+            {'group': 9, 'status': 'not_found'},
+        ])
+        self.assertTrue(Group.objects.get(id=1).is_already_drop_off())
+        self.assertEqual(Group.objects.get(id=4).get_car().id, 1)
+        self.assertEqual(Group.objects.get(id=3).get_car().id, 2)
+        self.assertEqual(Journey.objects.filter(finished__isnull=True).count(), 2)
+
+    def test_post_dropoffs_waiting_group(self):
+        """Post drop offs of a waiting group"""
+        response = self.client.post(self.url, data=[3], format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(Group.objects.get(id=3).is_available)
+        self.assertEqual(engine.waiting_count(), 1)
+
+    def test_post_dropoffs_twice(self):
+        """Post drop offs of a dropped off group keeps it dropped off"""
+        self.client.post(self.url, data=[1], format='json', content_type='application/json')
+        response = self.client.post(self.url, data=[1], format='json', content_type='application/json')
+        self.assertEqual(response.json(), [{'group': 1, 'status': 'dropped'}])
+
+        response = self.client.post("{}?id={}".format(reverse('post_locate'), 1))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_post_dropoffs_wrong_id_invalid(self):
+        """Post drop offs with a wrong id"""
+        response = self.client.post(self.url, data=[1, "a"], format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
+
+
+class ArchiveTest(TransactionTestCase):
+    """ Test module for the API with archived groups """
+
+    def setUp(self):
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 2, 'people': 4}, content_type='application/json')
+        self.client.post("{}?id={}".format(reverse('post_dropoff'), 1))
+        output = io.StringIO()
+        call_command('archive', stdout=output)
+        self.assertIn('Archived 1 journeys and 1 groups', output.getvalue())
+
+    def test_archived_group(self):
+        """Archived groups are still dropped off"""
+        locations.clear()
+        response = self.client.post("{}?id={}".format(reverse('post_locate'), 1))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response['X-DB-Queries'], '0')
+        response = self.client.post("{}?id={}".format(reverse('post_locate'), 2))
+        self.assertEqual(response.json(), {'group': 2, 'car': 1})
+        response = self.client.post("{}?id={}".format(reverse('post_dropoff'), 1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('post_dropoffs'), data=[1, 3], content_type='application/json')
+        self.assertEqual(response.json(), [
+            {'group': 1, 'status': 'dropped'},
+            {'group': 3, 'status': 'not_found'},
+        ])
+
+    def test_archived_by_another_process(self):
+        """Groups archived after the tombstones were loaded are dropped off"""
+        tombstones.reset()
+        response = self.client.post("{}?id={}".format(reverse('post_dropoff'), 1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_archived_by_another_process_registered_again(self):
+        """Groups archived after the tombstones were loaded aren't registered again"""
+        # Once the empty archive is no longer trusted
+        self.addCleanup(setattr, tombstones, 'empty_ttl', tombstones.empty_ttl)
+        tombstones.empty_ttl = 0
+        tombstones.reset()
+        response = self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('post_journeys'), data=[{'id': 1, 'people': 4}], content_type='application/json')
+        self.assertEqual(response.json(), [{'group': 1, 'status': 'duplicated', 'car': None}])
+        response = self.client.post(reverse('post_dropoffs'), data=[1], content_type='application/json')
+        self.assertEqual(response.json(), [{'group': 1, 'status': 'dropped'}])
+        self.assertFalse(Group.objects.filter(id=1).exists())
+
+    def test_put_cars(self):
+        """Putting cars empties the archive"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], content_type='application/json')
+        self.assertFalse(ArchivedGroup.objects.exists())
+        response = self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def tearDown(self):
+        reset_state()
+
+
+class PostLocateTest(QueryBudgetMixin, TransactionTestCase):
     """ Test module for POST locate API """
     client = APIClient
 
@@ -234,12 +772,37 @@ class PostLocateTest(TransactionTestCase):
         mommy.make('journey.journey', car=self.car, group=self.group)
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('post_locate', response)
 
     def test_post_locate_group_without_car_invalid(self):
         """Post to locate a group without car"""
         self.url = "{}{}".format(self.url, self.group.id)
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertWithinQueryBudget('post_locate', response)
+
+    def test_post_locate_cached(self):
+        """Post to locate groups assigned and dropped off without queries"""
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], format='json', content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 5, 'people': 4}, format='json', content_type='application/json')
+        response = self.client.post("{}{}".format(self.url, 5))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'group': 5, 'car': 1})
+        self.assertEqual(response['X-DB-Queries'], '0')
+
+        self.client.post("{}?id={}".format(reverse('post_dropoff'), 5))
+        response = self.client.post("{}{}".format(self.url, 5))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response['X-DB-Queries'], '0')
+
+    def test_post_locate_cache_miss(self):
+        """Post to locate a group not cached reads it once"""
+        self.url = "{}{}".format(self.url, self.group.id)
+        response = self.client.post(self.url)
+        self.assertEqual(response['X-DB-Queries'], '1')
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(response['X-DB-Queries'], '0')
 
     def test_post_locate_incorrect_id_invalid(self):
         """Post to locate a group with invalid id"""
@@ -247,6 +810,13 @@ class PostLocateTest(TransactionTestCase):
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_post_locate_unknown_id_invalid(self):
+        """Post to locate a never registered id"""
+        self.url = "{}{}".format(self.url, 10 ** 9)
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response['X-DB-Queries'], '0')
+
     def test_post_locate_wrong_id_invalid(self):
         """Post to locate a group with wrong id"""
         self.url = "{}{}".format(self.url, "a")
@@ -256,3 +826,228 @@ class PostLocateTest(TransactionTestCase):
     def tearDown(self):
         Car.objects.all().delete()
         Group.objects.all().delete()
+        reset_state()
+
+
+class PostLocateWaitTest(TransactionTestCase):
+    """ Test module for POST locate wait API """
+
+    def setUp(self):
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 1, 'people': 4}, content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 2, 'people': 4}, content_type='application/json')
+        self.url = "{}?id=".format(reverse('post_locate_wait'))
+
+    def drop_off_later(self, group_id):
+        def drop_off():
+            try:
+                self.client.post("{}?id={}".format(reverse('post_dropoff'), group_id))
+            finally:
+                connection.close()
+
+        timer = threading.Timer(0.1, drop_off)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_post_locate_wait_in_car(self):
+        """Post to locate a group in a car answers right away"""
+        response = self.client.post("{}{}".format(self.url, 1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'group': 1, 'car': 1})
+
+    def test_post_locate_wait_assigned(self):
+        """Post to locate a waiting group answers when it gets a car"""
+        self.drop_off_later(1)
+        response = self.client.post("{}{}&wait=10".format(self.url, 2))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'group': 2, 'car': 1})
+        self.assertEqual(notifier.waiting_count(), 0)
+
+    def test_post_locate_wait_dropped_off(self):
+        """Post to locate a waiting group answers when it is dropped off"""
+        self.drop_off_later(2)
+        start = time.monotonic()
+        response = self.client.post("{}{}&wait=10".format(self.url, 2))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_post_locate_wait_timeout(self):
+        """Post to locate a waiting group answers when the wait passes"""
+        response = self.client.post("{}{}&wait=0".format(self.url, 2))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_post_locate_wait_invalid(self):
+        """Post to locate waiting a wrong time"""
+        response = self.client.post("{}{}&wait=a".format(self.url, 2))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def tearDown(self):
+        reset_state()
+
+
+@override_settings(ROOT_URLCONF='car_pooling.api_urls')
+class PlainPostLocateWaitTest(PostLocateWaitTest):
+    """ Test module for POST locate wait of the API-only profile """
+
+
+@override_settings(ROOT_URLCONF='car_pooling.api_urls')
+class PlainViewsTest(QueryBudgetMixin, TransactionTestCase):
+    """ Test module for the plain views of the API-only profile """
+    client = APIClient
+
+    def setUp(self):
+        self.client.put(reverse('put_cars'), data=[{'id': 1, 'seats': 4}], format='json', content_type='application/json')
+
+    def test_post_journey_valid(self):
+        """Post journey assigns the car"""
+        response = self.client.post(reverse('post_journey'), data={'id': 5, 'people': 4}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('post_journey', response)
+        self.assertEqual(Group.objects.get(id=5).get_car().id, 1)
+
+    def test_post_journey_invalid(self):
+        """Post journey with wrong payloads"""
+        response = self.client.post(reverse('post_journey'), data='{"id": ', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('post_journey'), data={'id': 5, 'people': 7}, format='json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('post_journey'), data='id=5', content_type='text/plain')
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        response = self.client.get(reverse('post_journey'))
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_post_locate_and_dropoff(self):
+        """Locate a group in its car, drop it off and locate it again"""
+        self.client.post(reverse('post_journey'), data={'id': 5, 'people': 4}, format='json', content_type='application/json')
+        self.client.post(reverse('post_journey'), data={'id': 6, 'people': 4}, format='json', content_type='application/json')
+
+        response = self.client.post("{}?id=5".format(reverse('post_locate')))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'group': 5, 'car': 1})
+        response = self.client.post("{}?id=6".format(reverse('post_locate')))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.post("{}?id=5".format(reverse('post_dropoff')))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget('post_dropoff', response)
+        response = self.client.post("{}?id=5".format(reverse('post_locate')))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.json(), {'detail': 'Not found.'})
+        response = self.client.post("{}?id=6".format(reverse('post_locate')))
+        self.assertEqual(response.json(), {'group': 6, 'car': 1})
+
+    def test_post_dropoff_invalid(self):
+        """Post drop off with wrong and unknown ids"""
+        response = self.client.post("{}?id=a".format(reverse('post_dropoff')))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('post_dropoff'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post("{}?id=9".format(reverse('post_dropoff')))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.json(), {'detail': 'Not found.'})
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
+
+class BenchmarkTest(LiveServerTestCase):
+    """ Test module for the load benchmark of the API """
+
+    def test_benchmark(self):
+        """Benchmark every endpoint of the mix"""
+        benchmark = Benchmark(
+            self.live_server_url,
+            fleet=10,
+            requests=60,
+            concurrency=1,
+            mix=parse_mix('cars=1,journey=40,dropoff=20,locate=30,status=9'),
+            seed=1
+        )
+        results = benchmark.run()
+        self.assertEqual(
+            sum(result['count'] for result in results['endpoints'].values()),
+            60
+        )
+        for result in results['endpoints'].values():
+            self.assertEqual(result['errors'], 0)
+            self.assertNotIn('500', result['statuses'])
+        self.assertLessEqual(results['endpoints']['journey']['p50'],
+                             results['endpoints']['journey']['p99'])
+
+    def test_parse_mix_unknown_endpoint(self):
+        """A mix with an unknown endpoint is rejected"""
+        with self.assertRaises(ValueError):
+            parse_mix('journey=1,journeys=1')
+
+    def tearDown(self):
+        reset_state()
+
+
+class ProductionSettingsTest(SimpleTestCase):
+    """ Test module for the state shared by the production workers """
+
+    def test_no_process_state(self):
+        """Workers don't answer from state that other workers can't change"""
+        self.assertFalse(production.GROUP_FILTER_ENABLED)
+        self.assertIsNone(production.MATCHING_JOURNAL_DIR)
+        self.assertTrue(production.MATCHING_DATABASE_FALLBACK)
+        self.assertNotEqual(
+            production.CACHES['locations']['BACKEND'],
+            'django.core.cache.backends.locmem.LocMemCache'
+        )
+
+
+class SQLiteConcurrencyTest(SimpleTestCase):
+    """ Stress test of the production database profile """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.connections = []
+
+    def connect(self, options):
+        connection = sqlite_connection(
+            os.path.join(self.directory, 'db.sqlite3'), options
+        )
+        connection.ensure_connection()
+        self.connections.append(connection)
+        return connection
+
+    def lock_for_writing(self, options):
+        """Create the tables and keep the lock of a commit in progress"""
+        writer = self.connect(options)
+        with writer.schema_editor(atomic=False) as editor:
+            for model in (Car, Group, Journey):
+                editor.create_model(model)
+        reader = self.connect(options)
+        with writer.cursor() as cursor:
+            cursor.execute('BEGIN EXCLUSIVE')
+        return reader
+
+    def locate(self, connection, group_id):
+        """Run the query of POST /locate without cached location"""
+        query = Group.objects.select_related(
+            'journey__car'
+        ).filter(id=group_id).query
+        sql, params = query.get_compiler(connection=connection).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def test_writer_blocks_readers_by_default(self):
+        """Without WAL a commit in progress locks the readers out"""
+        reader = self.lock_for_writing({'timeout': 0.1})
+        with self.assertRaises(OperationalError):
+            self.locate(reader, 1)
+
+    def test_writer_does_not_block_readers(self):
+        """With the production profile readers don't wait for writers"""
+        options = dict(production.DATABASES['default']['OPTIONS'],
+                       timeout=0.1)
+        reader = self.lock_for_writing(options)
+        self.assertEqual(self.locate(reader, 1), [])
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        shutil.rmtree(self.directory)
@@ -1,10 +1,46 @@
+import cProfile
+from datetime import timedelta
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+
 from model_mommy import mommy
 
-from django.test import TestCase
+from car_pooling.settings import production
+
+from django.core.exceptions import SuspiciousOperation
+from django.db import IntegrityError, connection, transaction
+from django.test import (SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from ..exceptions import AssignCarException, JourneyException
-from ..models import Car, Group, Journey
+from ..archive import Tombstones, archive, archive_batch, tombstones
+from ..batching import GroupCommit
+from ..exceptions import (AssignCarException, CarTakenException,
+                          JourneyException, QueueFullException)
+from ..journal import SNAPSHOT, Journal, replay_event
+from ..matching import (AgingPolicy, MatchingEngine, QueuePolicy,
+                        SmallestFirstPolicy, engine, get_queue_policy)
+from ..membership import GroupFilter
+from ..metrics import (Counter, Histogram, Metric, format_sample,
+                       journeys_finished, journeys_started)
+from ..models import ArchivedGroup, ArchivedJourney, Car, Group, Journey
+from ..notifications import LocationNotifier
+from ..profiling import Profiler, dumps
+from ..replicas import (RecentWrites, ReplicaRouter, copy_database,
+                        recent_writes, replica_reads)
+from ..services import (check_admission, clean_system, drop_off,
+                        iter_cars_payload, load_cars, request_available_car,
+                        retry_after, update_fleet)
+from ..simulation import (Simulation, read_events, synthetic_events,
+                          synthetic_fleet)
+from ..streaming import iter_json_array
+from ..tracing import Tracer, traced
+from .helpers import reset_state, sqlite_connection
 
 
 class CarTestCase(TestCase):
@@ -38,9 +74,41 @@ class CarTestCase(TestCase):
         mommy.make('journey.group', people=self.seats, is_available=False)
         self.assertIsNone(self.car.get_available_group())
 
+    def test_get_available_group_aging(self):
+        """Get group that waited too long before smaller groups"""
+        car = mommy.make('journey.car', seats=6)
+        old = mommy.make('journey.group', people=6,
+                         created=timezone.now() - timedelta(hours=1))
+        mommy.make('journey.group', people=self.seats)
+        policy = engine.policy
+        engine.policy = AgingPolicy(max_wait=300)
+        try:
+            self.assertEqual(car.get_available_group(), old)
+        finally:
+            engine.policy = policy
+
+    def test_free_seats_default(self):
+        """New cars have all their seats free"""
+        self.assertEqual(self.car.free_seats, self.seats)
+        car = mommy.make('journey.car', seats=self.seats, is_available=False)
+        self.assertEqual(car.free_seats, 0)
+
+    def test_claim_seats(self):
+        """Seats taken by another copy of the car can't be claimed"""
+        stale = Car.objects.get(id=self.car.id)
+        self.assertTrue(self.car.claim_seats(self.seats))
+        self.assertFalse(self.car.is_available)
+        self.assertFalse(stale.claim_seats(self.seats))
+        self.assertEqual(stale.free_seats, self.seats)
+        stale.return_seats(self.seats)
+        self.car.refresh_from_db()
+        self.assertEqual(self.car.free_seats, self.seats)
+        self.assertTrue(self.car.is_available)
+
     def tearDown(self):
         Car.objects.all().delete()
         Group.objects.all().delete()
+        reset_state()
 
 
 class GroupTestCase(TestCase):
@@ -146,6 +214,7 @@ class GroupTestCase(TestCase):
         self.group.finish_journey()
         self.assertRaises(JourneyException, lambda: self.group.assign_car(car))
         self.assertFalse(self.group.is_available)
+        car.refresh_from_db()
         self.assertTrue(car.is_available)
 
     def test_assign_car_with_group_in_car(self):
@@ -168,9 +237,14 @@ class GroupTestCase(TestCase):
         self.group.save()
         car = mommy.make('journey.car', seats=self.people, is_available=False)
         journey = mommy.make('journey.journey', group=self.group, car=car)
-        self.group.finish_journey()
+        self.assertEqual(self.group.finish_journey(), journey)
+        car.refresh_from_db()
+        journey.refresh_from_db()
         self.assertTrue(car.is_available)
         self.assertIsNotNone(journey.finished)
+        self.assertIsNone(self.group.finish_journey())
+        car.refresh_from_db()
+        self.assertEqual(car.free_seats, self.people)
 
     def test_finish_journey_without_journey(self):
         """Try to finish a journey without a journey"""
@@ -185,6 +259,7 @@ class GroupTestCase(TestCase):
     def tearDown(self):
         Car.objects.all().delete()
         Group.objects.all().delete()
+        reset_state()
 
 
 class JourneyTestCase(TestCase):
@@ -206,3 +281,1056 @@ class JourneyTestCase(TestCase):
     def tearDown(self):
         Car.objects.all().delete()
         Group.objects.all().delete()
+        reset_state()
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    Tests for the query plans of the matching queries
+    """
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plans are checked on SQLite')
+        self.car = mommy.make('journey.car', seats=4)
+        self.group = mommy.make('journey.group', people=4)
+
+    def assertIndexBacked(self, method):
+        """Every query run by the method is answered with an index"""
+        with CaptureQueriesContext(connection) as queries:
+            method()
+
+        for query in queries.captured_queries:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN {}'.format(query['sql']))
+                plan = [row[-1] for row in cursor.fetchall()]
+            for detail in plan:
+                self.assertFalse(
+                    detail.startswith('SCAN') and 'INDEX' not in detail,
+                    'Full scan in {}: {}'.format(query['sql'], plan)
+                )
+                self.assertNotIn('TEMP B-TREE', detail)
+
+    def test_get_available_group_plan(self):
+        """Get available group uses an index"""
+        self.assertIndexBacked(self.car.get_available_group)
+
+    def test_get_available_car_plan(self):
+        """Get available car uses an index"""
+        self.assertIndexBacked(self.group.get_available_car)
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+
+
+class MatchingEngineTestCase(TestCase):
+    """
+    Tests for the in-memory matching engine
+    """
+    def setUp(self):
+        engine.reset()
+
+    def test_pop_car_fewest_seats(self):
+        """Take the car with fewest seats that fits the group"""
+        engine.add_car(1, 6)
+        engine.add_car(2, 5)
+        self.assertEqual(engine.pop_car(5), (2, 5))
+        self.assertEqual(engine.pop_car(5), (1, 6))
+        self.assertIsNone(engine.pop_car(4))
+
+    def test_pop_car_not_enough_seats(self):
+        """There isn't any car for the group"""
+        engine.add_car(1, 4)
+        self.assertIsNone(engine.pop_car(5))
+        self.assertEqual(engine.free_count(), 1)
+
+    def test_aging_policy(self):
+        """Groups that wait long enough go before smaller groups"""
+        now = [30.0]
+        aging = MatchingEngine(policy=AgingPolicy(max_wait=60),
+                               clock=lambda: now[0])
+        aging.reset()
+        aging.add_group(1, 6, enqueued=0.0)
+        aging.add_group(2, 4, enqueued=25.0)
+        self.assertEqual(aging.pop_group(6), (2, 4))
+        now[0] = 100.0
+        aging.add_group(3, 4, enqueued=95.0)
+        self.assertEqual(aging.pop_group(6), (1, 6))
+        self.assertEqual(aging.pop_group(6), (3, 4))
+
+    def test_wait_stats(self):
+        """Waiting times are counted by the size of the groups"""
+        now = [0.0]
+        timed = MatchingEngine(policy=SmallestFirstPolicy(max_wait=60),
+                               clock=lambda: now[0])
+        timed.reset()
+        timed.add_group(1, 4)
+        timed.add_group(2, 6)
+        now[0] = 10.0
+        timed.pop_group(4)
+        now[0] = 100.0
+        stats = timed.wait_stats()
+        self.assertEqual(stats[4]['count'], 1)
+        self.assertEqual(stats[4]['max'], 10.0)
+        self.assertEqual(stats[4]['histogram'][2], [15, 1])
+        self.assertEqual(stats[6]['waiting'], 1)
+        self.assertEqual(stats[6]['oldest'], 100.0)
+        timed.pop_group(6)
+        self.assertEqual(timed.wait_stats()[6]['over_max_wait'], 1)
+
+    def test_policy_without_choose(self):
+        """Policies that don't choose a queue can't be created"""
+        class Unfinished(QueuePolicy):
+            pass
+        with self.assertRaises(TypeError):
+            Unfinished(max_wait=60)
+
+    @override_settings(MATCHING_QUEUE_POLICY='journey.matching.AgingPolicy',
+                       MATCHING_MAX_WAIT=120)
+    def test_get_queue_policy(self):
+        """The queue policy is chosen in the settings"""
+        policy = get_queue_policy()
+        self.assertIsInstance(policy, AgingPolicy)
+        self.assertEqual(policy.max_wait, 120)
+
+    def test_add_car_moves_pool(self):
+        """Adding a car again moves it to the pool of its free seats"""
+        engine.add_car(1, 6)
+        engine.add_car(1, 4)
+        self.assertEqual(engine.free_count(6), 0)
+        self.assertEqual(engine.free_count(4), 1)
+        engine.add_car(1, 2)
+        self.assertEqual(engine.free_count(), 0)
+
+    def test_pop_group_smaller_first(self):
+        """Take smaller groups first and in arrival order"""
+        engine.add_group(1, 5)
+        engine.add_group(2, 4)
+        engine.add_group(3, 4)
+        self.assertEqual(engine.pop_group(6), (2, 4))
+        self.assertEqual(engine.pop_group(6), (3, 4))
+        self.assertEqual(engine.pop_group(6), (1, 5))
+
+    def test_pop_group_too_big(self):
+        """Groups bigger than the car keep waiting"""
+        engine.add_group(1, 6)
+        self.assertIsNone(engine.pop_group(5))
+        self.assertEqual(engine.waiting_count(6), 1)
+
+    def test_remove_group(self):
+        """A removed group is not matched"""
+        engine.add_group(1, 4)
+        engine.add_group(2, 4)
+        engine.remove_group(1)
+        self.assertEqual(engine.pop_group(4), (2, 4))
+
+    def test_load_from_database(self):
+        """The engine is loaded from the database after invalidate it"""
+        car = mommy.make('journey.car', seats=5)
+        mommy.make('journey.car', seats=5, is_available=False)
+        group = mommy.make('journey.group', people=4)
+        mommy.make('journey.group', people=4, is_available=False)
+        engine.invalidate()
+        self.assertEqual(engine.free_count(), 1)
+        self.assertEqual(engine.waiting_count(), 1)
+        self.assertEqual(engine.pop_car(5), (car.id, 5))
+        self.assertEqual(engine.pop_group(5), (group.id, 4))
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
+
+
+class MatchingServicesTestCase(TestCase):
+    """
+    Tests for the matching services
+    """
+    def setUp(self):
+        self.car = mommy.make('journey.car', seats=5)
+        engine.invalidate()
+
+    def test_request_available_car(self):
+        """A group gets the free car"""
+        group = mommy.make('journey.group', people=4)
+        self.assertEqual(request_available_car(group), self.car)
+        group.refresh_from_db()
+        self.assertTrue(group.is_in_car())
+        self.assertEqual(group.get_car(), self.car)
+        self.assertFalse(Car.objects.get(id=self.car.id).is_available)
+        self.assertEqual(Car.objects.get(id=self.car.id).free_seats, 1)
+
+    def test_drop_off_releases_seats(self):
+        """Dropping off a group gives its seats back to the car"""
+        group = mommy.make('journey.group', people=4)
+        request_available_car(group)
+        drop_off(group)
+        car = Car.objects.get(id=self.car.id)
+        self.assertEqual(car.free_seats, 5)
+        self.assertTrue(car.is_available)
+        self.assertEqual(engine.pop_car(5), (self.car.id, 5))
+
+    def test_car_shared_by_groups(self):
+        """A car takes groups while it has free seats for them"""
+        car = mommy.make('journey.car', seats=6)
+        first = mommy.make('journey.group', people=4)
+        second = mommy.make('journey.group', people=4)
+        first.assign_car(car)
+        self.assertEqual(car.free_seats, 2)
+        self.assertFalse(car.is_available)
+        with self.assertRaises(CarTakenException), transaction.atomic():
+            second.assign_car(car)
+        car.refresh_from_db()
+        self.assertEqual(car.free_seats, 2)
+
+        first.refresh_from_db()
+        first.finish_journey()
+        car.refresh_from_db()
+        self.assertEqual(car.free_seats, 6)
+        self.assertTrue(car.is_available)
+        second.refresh_from_db()
+        second.assign_car(car)
+        self.assertEqual(car.free_seats, 2)
+        self.assertEqual(second.get_car(), car)
+
+    def test_request_available_car_taken_by_other_worker(self):
+        """A car taken by another worker is skipped for the next one"""
+        other = mommy.make('journey.car', seats=6)
+        self.assertEqual(engine.free_count(), 2)
+        Car.objects.filter(id=self.car.id).update(free_seats=0,
+                                                  is_available=False)
+        group = mommy.make('journey.group', people=4)
+        self.assertEqual(request_available_car(group), other)
+        self.assertEqual(engine.free_count(), 0)
+        self.assertEqual(Car.objects.get(id=other.id).free_seats, 2)
+
+    def test_drop_off_skips_group_assigned_by_other_worker(self):
+        """A waiting group assigned by another worker is not assigned again"""
+        group = mommy.make('journey.group', people=4)
+        request_available_car(group)
+        waiting = mommy.make('journey.group', people=5)
+        request_available_car(waiting)
+        Group.objects.filter(id=waiting.id).update(is_available=False)
+        self.assertEqual(drop_off(group), [])
+        self.assertFalse(Journey.objects.filter(group=waiting).exists())
+        self.assertEqual(Car.objects.get(id=self.car.id).free_seats, 5)
+        self.assertEqual(engine.pop_car(5), (self.car.id, 5))
+
+    def test_request_available_car_failure(self):
+        """A car is not lost from the engine when its assignment fails"""
+        group = mommy.make('journey.group', people=4)
+        other = mommy.make('journey.car', seats=4, free_seats=0,
+                           is_available=False)
+        mommy.make('journey.journey', group=group, car=other)
+        with self.assertRaises(IntegrityError):
+            request_available_car(group)
+        self.assertEqual(engine.pop_car(4), (self.car.id, 5))
+
+    def test_request_available_car_group_claimed(self):
+        """A group that another worker gave a car keeps it"""
+        group = mommy.make('journey.group', people=4)
+        Group.objects.filter(id=group.id).update(is_available=False)
+        self.assertIsNone(request_available_car(group))
+        self.assertFalse(Journey.objects.filter(group=group).exists())
+        self.assertEqual(engine.pop_car(4), (self.car.id, 5))
+
+    def test_update_fleet_keeps_taken_seats(self):
+        """Resizes keep the seats taken and cars in a journey aren't retired"""
+        group = mommy.make('journey.group', people=4)
+        request_available_car(group)
+        update_fleet([], [Car(id=self.car.id, seats=6)], [])
+        car = Car.objects.get(id=self.car.id)
+        self.assertEqual((car.seats, car.free_seats, car.is_available),
+                         (6, 2, False))
+        with self.assertRaises(SuspiciousOperation):
+            update_fleet([], [], [self.car.id])
+        self.assertEqual(Journey.objects.get(group=group).car_id, car.id)
+
+    def test_drop_off_group_assigned_meanwhile(self):
+        """A group assigned after it was read is dropped off from its car"""
+        group = mommy.make('journey.group', people=4)
+        stale = Group.objects.select_related('journey__car').get(id=group.id)
+        request_available_car(group)
+        self.assertEqual(drop_off(stale), [])
+        self.assertIsNotNone(Journey.objects.get(group=group).finished)
+        car = Car.objects.get(id=self.car.id)
+        self.assertEqual((car.free_seats, car.is_available), (5, True))
+
+    def test_drop_off_twice_at_once(self):
+        """Seats are given back once when a group is dropped off twice"""
+        group = mommy.make('journey.group', people=4)
+        request_available_car(group)
+        first, second = [
+            Group.objects.select_related('journey__car').get(id=group.id)
+            for _ in range(2)
+        ]
+        drop_off(first)
+        drop_off(second)
+        self.assertEqual(Car.objects.get(id=self.car.id).free_seats, 5)
+        self.assertEqual(engine.pop_car(5), (self.car.id, 5))
+
+    @override_settings(ADMISSION_WAITING_LIMIT={6: 2})
+    def test_check_admission_limit(self):
+        """Groups that would wait in a full queue are turned away"""
+        check_admission(6)
+        for group_id in (1, 2):
+            request_available_car(mommy.make('journey.group', id=group_id,
+                                             people=6))
+        check_admission(4)
+        check_admission(5)
+        with self.assertRaises(QueueFullException):
+            check_admission(6)
+
+    @override_settings(ADMISSION_WAITING_LIMIT=2)
+    def test_check_admission_many(self):
+        """Groups of a batch count as many places of the queue"""
+        request_available_car(mommy.make('journey.group', people=6))
+        check_admission(6)
+        with self.assertRaises(QueueFullException):
+            check_admission(6, count=2)
+
+    @override_settings(ADMISSION_MAX_WAIT=60)
+    def test_check_admission_max_wait(self):
+        """Groups are turned away while the oldest one waits too long"""
+        request_available_car(mommy.make('journey.group', people=6))
+        check_admission(6)
+        clock = engine.clock
+        engine.clock = lambda: clock() + 120
+        try:
+            with self.assertRaises(QueueFullException):
+                check_admission(6)
+        finally:
+            engine.clock = clock
+
+    def test_retry_after(self):
+        """A place of the queue is free every mean wait / waiting seconds"""
+        self.assertEqual(retry_after({'count': 10, 'total': 300.0,
+                                      'waiting': 4}), 8)
+        self.assertEqual(retry_after({'count': 10, 'total': 1.0,
+                                      'waiting': 4}), 1)
+        with override_settings(ADMISSION_RETRY_AFTER=7):
+            self.assertEqual(retry_after({'count': 0, 'total': 0.0,
+                                          'waiting': 4}), 7)
+        self.assertEqual(retry_after({'count': 10, 'total': 300.0,
+                                      'waiting': 4}, places=3), 23)
+
+    def test_request_available_car_waiting(self):
+        """A group without car waits in the queue"""
+        group = mommy.make('journey.group', people=6)
+        self.assertIsNone(request_available_car(group))
+        self.assertEqual(engine.waiting_count(6), 1)
+
+    def test_drop_off_assigns_waiting_group(self):
+        """Dropping off a group gives the car to a waiting group"""
+        group = mommy.make('journey.group', people=4)
+        request_available_car(group)
+        waiting = mommy.make('journey.group', people=5)
+        request_available_car(waiting)
+        self.assertEqual(drop_off(group), [waiting])
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.get_car(), self.car)
+        self.assertEqual(engine.waiting_count(), 0)
+
+    def test_drop_off_waiting_group(self):
+        """Dropping off a waiting group removes it from the queue"""
+        group = mommy.make('journey.group', people=6)
+        request_available_car(group)
+        self.assertEqual(drop_off(group), [])
+        self.assertEqual(engine.waiting_count(), 0)
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
+
+
+class StreamingTestCase(TestCase):
+    """
+    Tests for the incremental JSON array parser
+    """
+    def parse(self, data, chunk_size=3):
+        return list(iter_json_array(io.BytesIO(data.encode()), chunk_size))
+
+    def test_iter_json_array(self):
+        """Items are parsed across chunk boundaries"""
+        data = ' [{"id": 1, "seats": 4}, {"id": 22, "seats": 6}, 333]\n'
+        self.assertEqual(
+            self.parse(data),
+            [{'id': 1, 'seats': 4}, {'id': 22, 'seats': 6}, 333]
+        )
+
+    def test_iter_json_array_empty(self):
+        """Empty arrays and empty bodies have no items"""
+        self.assertEqual(self.parse('[ ]'), [])
+        self.assertEqual(self.parse(''), [])
+
+    def test_iter_json_array_invalid(self):
+        """Malformed arrays raise an error"""
+        for data in ('{"id": 1}', '[1, 2', '[1 2]', '[1,]', '[1] 2'):
+            with self.assertRaises(ValueError):
+                self.parse(data)
+
+
+class LoadCarsTestCase(TestCase):
+    """
+    Tests for the fleet loading services
+    """
+    def setUp(self):
+        self.car = mommy.make('journey.car', seats=4, is_available=False)
+        self.group = mommy.make('journey.group', people=4, is_available=False)
+        mommy.make('journey.journey', car=self.car, group=self.group)
+
+    def test_clean_system(self):
+        """Clean system empties every table"""
+        clean_system()
+        self.assertFalse(Car.objects.exists())
+        self.assertFalse(Group.objects.exists())
+        self.assertFalse(Journey.objects.exists())
+
+    def test_load_cars_in_batches(self):
+        """Load cars replaces the fleet inserting the cars in batches"""
+        payload = ({'id': car_id, 'seats': 5} for car_id in range(10, 15))
+        with CaptureQueriesContext(connection) as queries:
+            load_cars(iter_cars_payload(payload), batch_size=2)
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(Car.objects.count(), 5)
+        self.assertFalse(Group.objects.exists())
+        self.assertEqual(engine.free_count(5), 5)
+
+    def test_load_cars_invalid_keeps_fleet(self):
+        """A wrong car in a later batch keeps the previous fleet"""
+        payload = [{'id': 10, 'seats': 5}, {'id': 11, 'seats': 5},
+                   {'id': 12, 'seats': 7}]
+        with self.assertRaises(SuspiciousOperation):
+            load_cars(iter_cars_payload(payload), batch_size=2)
+        self.assertEqual(list(Car.objects.all()), [self.car])
+        self.assertTrue(Journey.objects.exists())
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
+
+
+class JournalTestCase(TransactionTestCase):
+    """
+    Tests for the matching journal and its snapshots
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = Journal(self.directory, snapshot_every=100)
+        self.engine = MatchingEngine(self.journal)
+        self.engine.reset()
+        self.journal.snapshot(self.engine)
+
+    def record(self, event, **data):
+        replay_event(self.engine, dict(data, event=event))
+        self.journal.record(event, **data)
+
+    def record_traffic(self):
+        self.record('cars_added', cars=[[1, 4], [2, 6]])
+        self.record('group_enqueued', group=1, people=6, enqueued=10.0)
+        self.record('group_enqueued', group=2, people=5, enqueued=20.0)
+        self.record('group_enqueued', group=3, people=4, enqueued=30.0)
+        self.record('assigned', group=3, car=1)
+        self.record('assigned', group=1, car=2)
+        self.record('dropoff', group=1, car=2, seats=6)
+        self.record('group_enqueued', group=4, people=4, enqueued=40.0)
+        self.record('car_removed', car=2)
+
+    def restore(self):
+        engine = MatchingEngine(Journal(self.directory))
+        with self.assertNumQueries(0):
+            return engine.dump()
+
+    def test_restore(self):
+        """The engine is restored from the snapshot and the journal"""
+        self.record_traffic()
+        self.assertEqual(self.restore(), self.engine.dump())
+        self.assertEqual(self.restore()['groups'],
+                         [[4, 4, 40.0], [2, 5, 20.0]])
+
+    def test_restore_compacted(self):
+        """Snapshots delete the journal events they include"""
+        self.journal.snapshot_every = 3
+        self.record_traffic()
+        segments = [name for name in os.listdir(self.directory)
+                    if name.endswith('.log')]
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(self.restore(), self.engine.dump())
+
+    def test_restore_torn_event(self):
+        """An event half written when the process died is ignored"""
+        self.record_traffic()
+        self.journal._file.write('{"seq": 99, "ev')
+        self.journal._file.flush()
+        self.assertEqual(self.restore(), self.engine.dump())
+
+    def test_invalidate_loads_database(self):
+        """After invalidate the engine is loaded from the database"""
+        self.record_traffic()
+        engine = MatchingEngine(Journal(self.directory))
+        self.assertEqual(engine.dump(), self.engine.dump())
+        engine.invalidate()
+        self.assertEqual(engine.dump(), {'cars': [], 'groups': []})
+
+    def test_load_without_snapshot(self):
+        """Without snapshot the engine is loaded from the database"""
+        os.remove(os.path.join(self.directory, SNAPSHOT))
+        group = mommy.make('journey.group', id=7, people=5)
+        engine = MatchingEngine(Journal(self.directory))
+        self.assertEqual(engine.dump()['groups'],
+                         [[7, 5, group.created.timestamp()]])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, SNAPSHOT)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+
+
+class GroupFilterTestCase(TestCase):
+    """
+    Tests for the filter of registered group ids
+    """
+    def setUp(self):
+        self.filter = GroupFilter(bits=2 ** 16, hashes=4)
+        self.filter.reset()
+
+    def test_registered_ids(self):
+        """Registered ids are always in the filter"""
+        self.filter.add_many(range(0, 20000, 3))
+        self.assertTrue(all(group_id in self.filter
+                            for group_id in range(0, 20000, 3)))
+
+    def test_unknown_ids(self):
+        """Most ids never registered are not in the filter"""
+        self.filter.add_many(range(1000))
+        unknown = sum(group_id in self.filter
+                      for group_id in range(10 ** 6, 10 ** 6 + 10000))
+        self.assertLess(unknown, 100)
+
+    def test_reset(self):
+        """Reset forgets every id"""
+        self.filter.add(7)
+        self.filter.reset()
+        self.assertNotIn(7, self.filter)
+
+    def test_load_from_database(self):
+        """The filter is loaded from the database after invalidate it"""
+        group = mommy.make('journey.group')
+        self.filter.invalidate()
+        self.assertIn(group.id, self.filter)
+
+    def test_disabled(self):
+        """A disabled filter contains every id"""
+        self.filter.enabled = False
+        self.assertIn(7, self.filter)
+
+    def tearDown(self):
+        Group.objects.all().delete()
+
+
+class SimulationTestCase(TestCase):
+    """
+    Tests for the discrete-event simulation of the matching
+    """
+    def test_synthetic_traffic(self):
+        """Every synthetic group gets a car and leaves"""
+        simulation = Simulation(
+            synthetic_fleet(5, seed=1),
+            synthetic_events(50, arrival_rate=1, seed=1),
+            trip_time=lambda group_id, people: 2
+        )
+        report = simulation.run()
+        self.assertEqual(report['groups'], 50)
+        self.assertEqual(report['served'], 50)
+        self.assertEqual(report['waiting'], 0)
+        self.assertEqual(report['cost']['journey']['count'], 50)
+        self.assertEqual(report['cost']['dropoff']['count'], 50)
+        self.assertGreater(report['utilization'], 0)
+        self.assertLessEqual(report['utilization'], 1)
+
+    def test_recorded_traffic(self):
+        """Recorded dropoffs free the seats on the virtual clock"""
+        trace = io.StringIO(
+            '{"time": 100, "event": "journey", "id": 1, "people": 4}\n'
+            '{"time": 101, "event": "journey", "id": 2, "people": 4}\n'
+            '{"time": 105, "event": "dropoff", "id": 1}\n'
+            '{"time": 110, "event": "dropoff", "id": 2}\n'
+            '{"time": 120, "event": "journey", "id": 3, "people": 6}\n'
+        )
+        report = Simulation([(1, 4)], read_events(trace)).run()
+        self.assertEqual(report['simulated_time'], 20)
+        self.assertEqual(report['served'], 2)
+        self.assertEqual(report['waiting'], 1)
+        self.assertEqual(report['wait']['max'], 4)
+        self.assertEqual(report['wait_by_size'][4]['count'], 2)
+        self.assertEqual(report['utilization'], 0.5)
+        self.assertEqual(engine.wait_stats()[4]['max'], 4)
+
+    def tearDown(self):
+        Car.objects.all().delete()
+        Group.objects.all().delete()
+        reset_state()
+
+
+class SQLiteBackendTestCase(SimpleTestCase):
+    """
+    Tests for the SQLite backend of the production profile
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        options = production.DATABASES['default']['OPTIONS']
+        self.connection = sqlite_connection(
+            os.path.join(self.directory, 'db.sqlite3'), options
+        )
+
+    def pragma(self, name):
+        with self.connection.cursor() as cursor:
+            cursor.execute('PRAGMA {}'.format(name))
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        """Every connection runs the pragmas of its options"""
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('cache_size'), -64 * 1024)
+        self.assertEqual(self.pragma('temp_store'), 2)
+
+    def test_immediate_transactions(self):
+        """Transactions take the write lock when they begin"""
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        with self.connection.execute_wrapper(record):
+            self.connection._start_transaction_under_autocommit()
+        self.assertEqual(statements, ['BEGIN IMMEDIATE'])
+        self.connection.rollback()
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+
+class GroupCommitTestCase(TransactionTestCase):
+    """
+    Tests for the group commit of concurrent writes
+    """
+    def create_group(self, group_id, people=4):
+        Group.objects.create(id=group_id, people=people)
+        return threading.get_ident(), connection.in_atomic_block
+
+    def create_group_and_fail(self, group_id):
+        self.create_group(group_id)
+        raise ValueError('Failing write')
+
+    def submit_concurrently(self, group_commit, jobs):
+        results = [None] * len(jobs)
+
+        def submit(index, job):
+            try:
+                results[index] = group_commit.submit(*job)
+            except Exception as error:
+                results[index] = error
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=submit, args=(index, job))
+                   for index, job in enumerate(jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_disabled(self):
+        """Without window every write runs alone in its request"""
+        group_commit = GroupCommit()
+        self.assertEqual(group_commit.submit(self.create_group, 1),
+                         (threading.get_ident(), False))
+
+    def test_one_transaction(self):
+        """Concurrent writes run in the same transaction"""
+        group_commit = GroupCommit(window=5, max_size=4)
+        results = self.submit_concurrently(
+            group_commit,
+            [(self.create_group, group_id) for group_id in range(1, 5)]
+        )
+        self.assertEqual(len(set(results)), 1)
+        self.assertTrue(results[0][1])
+        self.assertEqual(Group.objects.count(), 4)
+
+    def test_failing_write(self):
+        """A failing write only undoes itself"""
+        group_commit = GroupCommit(window=5, max_size=3)
+        results = self.submit_concurrently(
+            group_commit,
+            [(self.create_group, 1), (self.create_group_and_fail, 2),
+             (self.create_group, 3)]
+        )
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(set(Group.objects.values_list('id', flat=True)),
+                         {1, 3})
+
+    def tearDown(self):
+        reset_state()
+
+
+class ReplicasTestCase(SimpleTestCase):
+    """
+    Tests for the routing of reads to the replica
+    """
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.window = recent_writes.window
+        recent_writes.window = 5
+
+    def test_without_replica(self):
+        """Everything is read from the primary without replica"""
+        with replica_reads(1) as replica:
+            self.assertFalse(replica)
+            self.assertIsNone(self.router.db_for_read(Group))
+
+    @override_settings(REPLICA_DATABASE='replica')
+    def test_replica_reads(self):
+        """Reads of the block go to the replica, writes to the primary"""
+        self.assertIsNone(self.router.db_for_read(Group))
+        with replica_reads(1) as replica:
+            self.assertTrue(replica)
+            self.assertEqual(self.router.db_for_read(Group), 'replica')
+            self.assertIsNone(self.router.db_for_write(Group))
+        self.assertIsNone(self.router.db_for_read(Group))
+        self.assertFalse(self.router.allow_migrate('replica', 'journey'))
+
+    @override_settings(REPLICA_DATABASE='replica')
+    def test_read_your_writes(self):
+        """Groups just written are read from the primary"""
+        recent_writes.add_many([1])
+        with replica_reads(1) as replica:
+            self.assertFalse(replica)
+            self.assertIsNone(self.router.db_for_read(Group))
+
+    def test_recent_writes_expire(self):
+        """Groups are only recent during the window"""
+        now = [0]
+        writes = RecentWrites(window=5, clock=lambda: now[0])
+        writes.add_many([1, 2])
+        now[0] = 3
+        writes.add_many([1])
+        now[0] = 6
+        self.assertIn(1, writes)
+        self.assertNotIn(2, writes)
+        self.assertNotIn(2, RecentWrites())
+
+    def test_copy_database(self):
+        """The replica gets the rows of the primary"""
+        directory = tempfile.mkdtemp()
+        options = production.DATABASES['default']['OPTIONS']
+        primary = sqlite_connection(os.path.join(directory, 'primary'),
+                                    options)
+        replica = sqlite_connection(os.path.join(directory, 'replica'),
+                                    options)
+        try:
+            with primary.cursor() as cursor:
+                cursor.execute('CREATE TABLE cars (id integer)')
+                cursor.execute('INSERT INTO cars VALUES (1)')
+            copy_database(primary, replica)
+            with replica.cursor() as cursor:
+                cursor.execute('SELECT id FROM cars')
+                self.assertEqual(cursor.fetchall(), [(1,)])
+        finally:
+            primary.close()
+            replica.close()
+            shutil.rmtree(directory)
+
+    def tearDown(self):
+        recent_writes.window = self.window
+        reset_state()
+
+
+class LocationNotifierTestCase(SimpleTestCase):
+    """
+    Tests for the notifications of location changes
+    """
+    def setUp(self):
+        self.notifier = LocationNotifier()
+
+    def test_notify(self):
+        """Every listener of a group is notified"""
+        with self.notifier.listen(1) as first, \
+                self.notifier.listen(1) as second, \
+                self.notifier.listen(2) as other:
+            self.notifier.notify_many([1, 3])
+            self.assertTrue(first.is_set())
+            self.assertTrue(second.is_set())
+            self.assertFalse(other.is_set())
+        self.assertEqual(self.notifier.waiting_count(), 0)
+
+    def test_listen_again(self):
+        """A notified group has new events for the next change"""
+        with self.notifier.listen(1) as first:
+            self.notifier.notify_many([1])
+            with self.notifier.listen(1) as second:
+                self.assertFalse(second.is_set())
+                self.assertEqual(self.notifier.waiting_count(), 1)
+            self.assertTrue(first.is_set())
+        self.assertEqual(self.notifier.waiting_count(), 0)
+
+    def test_wait_in_other_thread(self):
+        """A waiting thread wakes up when the location changes"""
+        with self.notifier.listen(1) as changed:
+            threading.Timer(0.05, self.notifier.notify_many, [[1]]).start()
+            self.assertTrue(changed.wait(5))
+
+
+class TracerTestCase(SimpleTestCase):
+    """
+    Tests for the tracing spans
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spans.json')
+        self.tracer = Tracer(self.path)
+
+    def spans(self):
+        self.tracer.close()
+        with open(self.path) as spans:
+            return [json.loads(line) for line in spans]
+
+    def test_nested_spans(self):
+        """Spans are exported with their trace and parent"""
+        with self.tracer.span('root', kind='SERVER', path='/') as root:
+            with self.tracer.span('child'):
+                pass
+            root['name'] = 'renamed'
+        child, root = self.spans()
+        self.assertEqual(root['name'], 'renamed')
+        self.assertEqual(root['kind'], 'SERVER')
+        self.assertEqual(root['tags'], {'path': '/', 'db.queries': '0'})
+        self.assertNotIn('parentId', root)
+        self.assertEqual(child['traceId'], root['traceId'])
+        self.assertEqual(child['parentId'], root['id'])
+        self.assertEqual(len(root['traceId']), 32)
+        self.assertGreaterEqual(root['duration'], child['duration'])
+
+    def test_error(self):
+        """Spans of failing blocks have the error"""
+        with self.assertRaises(ValueError):
+            with self.tracer.span('root'):
+                raise ValueError
+        span, = self.spans()
+        self.assertEqual(span['tags']['error'], 'ValueError')
+
+    def test_disabled(self):
+        """Without path nothing is traced"""
+        with Tracer().span('root') as span:
+            self.assertIsNone(span)
+
+    def test_traced(self):
+        """Traced functions are named after them"""
+        @traced
+        def function():
+            return 1
+
+        self.assertEqual(function(), 1)
+        self.assertEqual(function.__name__, 'function')
+
+    def test_rotation(self):
+        """The file of the spans is rotated"""
+        self.tracer = Tracer(self.path, max_bytes=512, backup_count=2)
+        for index in range(20):
+            with self.tracer.span('span'):
+                pass
+        self.tracer.close()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['spans.json', 'spans.json.1', 'spans.json.2'])
+
+    def tearDown(self):
+        self.tracer.close()
+        shutil.rmtree(self.directory)
+
+
+class MetricsTestCase(TestCase):
+    """
+    Tests for the metrics in the Prometheus text format
+    """
+    def test_format_sample(self):
+        """Samples have their labels escaped"""
+        self.assertEqual(format_sample('up', {}, 1.0), 'up 1')
+        self.assertEqual(
+            format_sample('requests', {'path': 'a"b'}, 0.5),
+            'requests{path="a\\"b"} 0.5'
+        )
+
+    def test_counter(self):
+        """Counters add up by labels"""
+        counter = Counter('hits', 'Hits', labels=('side',))
+        counter.inc(side='car')
+        counter.inc(2, side='car')
+        self.assertEqual(counter.collect(), [
+            '# HELP hits Hits', '# TYPE hits counter', 'hits{side="car"} 3'
+        ])
+
+    def test_metric_without_collect(self):
+        """Metrics that don't collect their samples can't be created"""
+        class Unfinished(Metric):
+            pass
+        with self.assertRaises(TypeError):
+            Unfinished('hits', 'Hits')
+
+    def test_histogram(self):
+        """Histograms have cumulative buckets"""
+        histogram = Histogram('latency', 'Latency', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(histogram.collect()[2:], [
+            'latency_bucket{le="0.1"} 1',
+            'latency_bucket{le="1"} 2',
+            'latency_bucket{le="+Inf"} 3',
+            'latency_sum 5.55',
+            'latency_count 3',
+        ])
+
+    def test_journeys_counters(self):
+        """Journeys started and finished are counted when they commit"""
+        car = mommy.make('journey.car', seats=6)
+        group = mommy.make('journey.group', people=4)
+        request_available_car(group)
+        self.assertEqual(journeys_started.value(), 0)
+        self.run_commit_hooks()
+        self.assertEqual(journeys_started.value(), 1)
+        group.refresh_from_db()
+        drop_off(group)
+        self.run_commit_hooks()
+        self.assertEqual(journeys_finished.value(), 1)
+        self.assertTrue(Car.objects.get(id=car.id).is_available)
+
+    def run_commit_hooks(self):
+        hooks = connection.run_on_commit
+        connection.run_on_commit = []
+        for _, hook in hooks:
+            hook()
+
+    def tearDown(self):
+        journeys_started.reset()
+        journeys_finished.reset()
+        reset_state()
+
+
+class ProfilerTestCase(SimpleTestCase):
+    """
+    Tests for the sampled cProfile dumps
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def request(self, **meta):
+        return type('Request', (), {'META': meta})()
+
+    def test_sampled(self):
+        """Requests are profiled by rate or by header"""
+        profiler = Profiler(self.directory, rate=0.5, header='HTTP_X_PROFILE',
+                            random=lambda: 0.7)
+        self.assertFalse(profiler.sampled(self.request()))
+        self.assertTrue(profiler.sampled(self.request(HTTP_X_PROFILE='1')))
+        profiler.random = lambda: 0.3
+        self.assertTrue(profiler.sampled(self.request()))
+        self.assertFalse(Profiler().sampled(self.request(HTTP_X_PROFILE='1')))
+
+    def test_rotation(self):
+        """Endpoints keep their last dumps"""
+        profiler = Profiler(self.directory, max_files=2)
+        paths = []
+        for index in range(3):
+            profile = cProfile.Profile()
+            profile.runcall(sum, range(10))
+            paths.append(profiler.dump('post_journey', profile))
+        profiler.dump('post_dropoff', profile)
+        found = dumps(self.directory)
+        self.assertEqual(found['post_journey'], paths[1:])
+        self.assertEqual(len(found['post_dropoff']), 1)
+        self.assertEqual(list(dumps(self.directory, ['post_dropoff'])),
+                         ['post_dropoff'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class ArchiveTestCase(TransactionTestCase):
+    """
+    Tests for the archive of finished journeys and dropped off groups
+    """
+    def setUp(self):
+        reset_state()
+        self.car = mommy.make('journey.car', seats=6)
+        self.in_car, self.finished = mommy.make('journey.group', people=4,
+                                                _quantity=2)
+        self.dropped, self.waiting = mommy.make('journey.group', people=6,
+                                                _quantity=2)
+        for group in (self.finished, self.dropped):
+            group.is_available = False
+            group.save()
+        mommy.make('journey.journey', group=self.in_car, car=self.car)
+        mommy.make('journey.journey', group=self.finished, car=self.car,
+                   finished=timezone.now())
+
+    def test_archive_batch(self):
+        """Only finished journeys and dropped off groups are archived"""
+        self.assertEqual(archive_batch(), (1, 2))
+        self.assertEqual(set(Group.objects.values_list('id', flat=True)),
+                         {self.in_car.id, self.waiting.id})
+        self.assertEqual(Journey.objects.get().group_id, self.in_car.id)
+        archived = ArchivedJourney.objects.get()
+        self.assertEqual((archived.group_id, archived.car_id),
+                         (self.finished.id, self.car.id))
+        self.assertEqual(
+            set(ArchivedGroup.objects.values_list('group_id', flat=True)),
+            {self.finished.id, self.dropped.id}
+        )
+        self.assertIn(self.dropped.id, tombstones)
+        self.assertNotIn(self.waiting.id, tombstones)
+        self.assertEqual(archive_batch(), (0, 0))
+
+    def test_bounded_batches(self):
+        """Batches move a bounded number of groups"""
+        self.assertEqual(archive_batch(batch_size=1), (1, 1))
+        self.assertEqual(archive_batch(batch_size=1), (0, 1))
+        self.assertEqual(archive(batch_size=1), (0, 0))
+
+    def test_tombstones(self):
+        """Tombstones are loaded from the archive and refreshed"""
+        ids = Tombstones()
+        ids.reset()
+        ids.add_many(range(0, 20000, 2))
+        self.assertIn(19998, ids)
+        self.assertNotIn(19999, ids)
+        mommy.make('journey.archivedgroup', group_id=19999)
+        self.assertNotIn(19999, ids)
+        ids.refresh()
+        self.assertIn(19999, ids)
+        ids.invalidate()
+        self.assertIn(19999, ids)
+        self.assertNotIn(19998, ids)
+
+    def test_tombstones_empty_archive(self):
+        """An empty archive is trusted for a while before it is looked up"""
+        now = [0.0]
+        ids = Tombstones(empty_ttl=1, clock=lambda: now[0])
+        ids.reset()
+        self.assertTrue(ids.archive_empty())
+        mommy.make('journey.archivedgroup', group_id=7)
+        with self.assertNumQueries(0):
+            self.assertTrue(ids.archive_empty())
+        now[0] = 1.0
+        self.assertFalse(ids.archive_empty())
+        self.assertIn(7, ids)
+
+    def tearDown(self):
+        reset_state()
@@ -0,0 +1,168 @@
+from contextlib import ExitStack, contextmanager
+import functools
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from .middleware import QueryCounter
+
+_state = threading.local()
+
+
+def new_id(size=8):
+    """
+    Random hexadecimal id of a trace (16 bytes) or a span (8 bytes)
+    """
+    return os.urandom(size).hex()
+
+
+class Tracer:
+    """
+    Nested spans of the requests with their durations and queries
+
+    Spans are exported in the Zipkin v2 JSON format, one span per line, to a
+    file rotated every `max_bytes`. Without path nothing is traced.
+    """
+
+    def __init__(self, path=None, max_bytes=10 * 1024 * 1024, backup_count=5,
+                 service='car-pooling'):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.service = service
+        self._lock = threading.Lock()
+        self._handler = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _export(self, span):
+        if self._handler is None:
+            with self._lock:
+                if self._handler is None:
+                    handler = RotatingFileHandler(
+                        self.path, maxBytes=self.max_bytes,
+                        backupCount=self.backup_count, delay=True
+                    )
+                    handler.setFormatter(logging.Formatter('%(message)s'))
+                    self._handler = handler
+        self._handler.handle(logging.makeLogRecord({
+            'msg': json.dumps(span, separators=(',', ':'))
+        }))
+
+    def close(self):
+        """
+        Close the file of the spans, it is opened again by the next span
+        """
+        with self._lock:
+            if self._handler is not None:
+                self._handler.close()
+                self._handler = None
+
+    @contextmanager
+    def span(self, name, kind=None, **tags):
+        """
+        Trace a block as a child of the current span, or as the root of a
+        new trace if there isn't any
+
+        :param name: Name of the span
+        :type name: str
+        :param kind: Zipkin kind of the span, like SERVER
+        :type kind: str
+
+        :returns: The span, to rename it or tag it, None if disabled
+        :type returns: dict
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        parent = getattr(_state, 'span', None)
+        with ExitStack() as stack:
+            if parent is None:
+                _state.counter = QueryCounter()
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(_state.counter)
+                    )
+            span = {
+                'traceId': parent['traceId'] if parent else new_id(16),
+                'id': new_id(),
+                'name': name,
+                'timestamp': int(time.time() * 1000000),
+                'localEndpoint': {'serviceName': self.service},
+                'tags': {key: str(value) for key, value in tags.items()},
+            }
+            if parent:
+                span['parentId'] = parent['id']
+            if kind:
+                span['kind'] = kind
+            counter = _state.counter
+            queries = counter.count
+            start = time.perf_counter()
+            _state.span = span
+            try:
+                yield span
+            except Exception as error:
+                span['tags']['error'] = type(error).__name__
+                raise
+            finally:
+                span['duration'] = max(
+                    int((time.perf_counter() - start) * 1000000), 1
+                )
+                span['tags']['db.queries'] = str(counter.count - queries)
+                _state.span = parent
+                self._export(span)
+
+
+tracer = Tracer(
+    settings.TRACING_FILE,
+    settings.TRACING_MAX_BYTES,
+    settings.TRACING_BACKUP_COUNT
+)
+
+
+def traced(func):
+    """
+    Trace every call of a function in a span named after it
+    """
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return func(*args, **kwargs)
+        with tracer.span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class TracingMiddleware:
+    """
+    Root span of every request, named after its URL, when tracing is enabled
+    with TRACING_FILE
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not tracer.enabled:
+            return self.get_response(request)
+
+        with tracer.span(request.path, kind='SERVER',
+                         **{'http.method': request.method,
+                            'http.path': request.path}) as span:
+            response = self.get_response(request)
+            match = request.resolver_match
+            if match and match.url_name:
+                span['name'] = match.url_name
+            span['tags']['http.status_code'] = str(response.status_code)
+        return response
@@ -2,15 +2,23 @@ from rest_framework.views import APIView
 from rest_framework import status
 from rest_framework.response import Response
 
+from django.conf import settings
 from django.core.exceptions import SuspiciousOperation
-from django.http import Http404
-from django.shortcuts import get_object_or_404
-
-from .models import Car, Group, Journey
-from .serializers import LocationSerializer
-from .services import (clean_system, request_available_car,
-                       get_available_group, process_cars_payload,
-                       process_journey_payload)
+from django.db import IntegrityError
+from django.http import HttpResponse
+
+from .batching import group_commit
+from .exceptions import QueueFullException
+from .handlers import (drop_off_group, get_group_id, get_wait, locate_group,
+                       register_journey, wait_location)
+from .metrics import CONTENT_TYPE, render
+from .serializers import (DropOffResultSerializer, JourneyResultSerializer,
+                          LocationSerializer)
+from .services import (drop_offs, load_cars, request_available_cars,
+                       iter_cars_payload,
+                       process_dropoffs_payload, process_fleet_payload,
+                       process_journeys_payload, update_fleet)
+from .streaming import iter_json_array
 
 
 class StatusAPIView(APIView):
@@ -23,23 +31,49 @@ class StatusAPIView(APIView):
         return Response(status=status.HTTP_200_OK)
 
 
+class MetricsAPIView(APIView):
+    """
+    GET metrics of the process in the Prometheus text format
+
+    Every worker process answers its own numbers: counters add up across
+    workers, the gauges of the matching engine only hold for one process.
+    """
+    permission_classes = ()
+
+    def get(self, request):
+        return HttpResponse(render(), content_type=CONTENT_TYPE)
+
+
 class CarAPIView(APIView):
     """
-    PUT to add new cars
+    PUT to add new cars, PATCH to add, resize or retire some cars
     """
     permission_classes = ()
 
     def put(self, request):
-        cars = process_cars_payload(request.data)
-        clean_system()
+        cars = iter_cars_payload(
+            iter_json_array(request.stream, settings.CARS_STREAM_CHUNK_SIZE)
+        )
 
         try:
-            Car.objects.bulk_create(cars)
+            load_cars(cars)
+        except SuspiciousOperation:
+            raise
         except Exception:
             raise SuspiciousOperation("Incorrect field in payload")
 
         return Response(status=status.HTTP_200_OK)
 
+    def patch(self, request):
+        added, resized, retired = process_fleet_payload(request.data)
+
+        try:
+            update_fleet(added, resized, retired)
+        except IntegrityError:
+            raise SuspiciousOperation("Incorrect field in payload")
+
+        return Response(status=status.HTTP_200_OK)
+
 
 class JourneyAPIView(APIView):
     """
@@ -48,17 +82,33 @@ class JourneyAPIView(APIView):
     permission_classes = ()
 
     def post(self, request):
-        group = process_journey_payload(request.data)
-        if Group.objects.filter(id=group.id).exists():
-            raise SuspiciousOperation("Incorrect field in payload")
+        try:
+            group_commit.submit(register_journey, request.data)
+        except QueueFullException as error:
+            return Response(status=status.HTTP_429_TOO_MANY_REQUESTS,
+                            headers={'Retry-After': str(error.retry_after)})
+        return Response(status=status.HTTP_200_OK)
+
+
+class JourneysAPIView(APIView):
+    """
+    POST many new requests of journeys at once
+    """
+    permission_classes = ()
+
+    def post(self, request):
+        groups = process_journeys_payload(request.data)
 
         try:
-            group.save()
-        except Exception:
-            raise SuspiciousOperation("Incorrect field in payload")
+            results = request_available_cars(groups)
+        except QueueFullException as error:
+            return Response(status=status.HTTP_429_TOO_MANY_REQUESTS,
+                            headers={'Retry-After': str(error.retry_after)})
 
-        request_available_car(group)
-        return Response(status=status.HTTP_200_OK)
+        return Response(
+            JourneyResultSerializer(results, many=True).data,
+            status=status.HTTP_200_OK
+        )
 
 
 class DropOffAPIView(APIView):
@@ -68,16 +118,23 @@ class DropOffAPIView(APIView):
     permission_classes = ()
 
     def post(self, request):
-        group_id = request.GET.get('id')
-        if not group_id.isdigit():
-            raise SuspiciousOperation("Incorrect group id")
+        group_commit.submit(drop_off_group, get_group_id(request))
+        return Response(status=status.HTTP_200_OK)
 
-        group = get_object_or_404(Group, id=group_id)
-        group.finish_journey()
 
-        if hasattr(group, 'journey'):
-            get_available_group(group.journey.car)
-        return Response(status=status.HTTP_200_OK)
+class DropOffsAPIView(APIView):
+    """
+    POST drop off many groups at once
+    """
+    permission_classes = ()
+
+    def post(self, request):
+        group_ids = process_dropoffs_payload(request.data)
+        results = drop_offs(group_ids)
+        return Response(
+            DropOffResultSerializer(results, many=True).data,
+            status=status.HTTP_200_OK
+        )
 
 
 class LocateAPIView(APIView):
@@ -87,23 +144,23 @@ class LocateAPIView(APIView):
     permission_classes = ()
 
     def post(self, request):
-        group_id = request.GET.get('id')
-        if not group_id.isdigit():
-            raise SuspiciousOperation("Incorrect group id")
-
-        group = get_object_or_404(Group, id=group_id)
-
-        if group.is_in_car():
-            location = {
-                'group': group.id,
-                'car': group.get_car().id
-            }
-
-            return Response(
-                LocationSerializer(location).data,
-                status=status.HTTP_200_OK
-            )
-        elif group.is_already_drop_off():
-            raise Http404
-
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        location = locate_group(get_group_id(request))
+        if location is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(LocationSerializer(location).data,
+                        status=status.HTTP_200_OK)
+
+
+class LocateWaitAPIView(APIView):
+    """
+    POST to locate a group in a car, waiting up to `wait` seconds for a
+    change of its location if it is waiting
+    """
+    permission_classes = ()
+
+    def post(self, request):
+        location = wait_location(get_group_id(request), get_wait(request))
+        if location is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(LocationSerializer(location).data,
+                        status=status.HTTP_200_OK)